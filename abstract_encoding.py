@@ -0,0 +1,112 @@
+import argparse
+import csv
+import gzip
+import json
+import sys
+
+# abstract_inverted_index ({单词: [位置, ...]}) 的几种输出格式, 见 --abstracts:
+#   inline  works.abstract_inverted_index 里的 JSON 文本 (原来的格式)
+#   json    同样的 JSON 文本, 但写到单独的 works_abstracts 表
+#   text    还原出的摘要原文, 写到 works_abstracts
+#   binary  紧凑的二进制 (单词字典 + 位置数组), 写到 works_abstracts (bytea)
+#
+# binary 格式, 整数都是 unsigned LEB128 varint:
+#   单词数
+#   每个单词: utf-8 字节数, utf-8 字节, 位置个数, 位置 (升序, 存与前一个位置的差)
+# CSV 里写成 PostgreSQL bytea 的 hex 文本 \x..., \copy 可以直接导入 bytea 列.
+
+FORMATS = ['inline', 'json', 'text', 'binary']
+
+
+def to_text(index):
+    """把 inverted index 还原成摘要原文, 缺失的位置跳过."""
+    words = {}
+    for word, positions in index.items():
+        for position in positions:
+            words[position] = word
+    return ' '.join(words[position] for position in sorted(words))
+
+
+def _varint(value, out):
+    while value > 0x7f:
+        out.append(value & 0x7f | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _read_varint(data, pos):
+    value = shift = 0
+    while True:
+        byte = data[pos]
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if byte < 0x80:
+            return value, pos
+        shift += 7
+
+
+def encode_binary(index):
+    out = bytearray()
+    _varint(len(index), out)
+    for word, positions in index.items():
+        encoded = word.encode('utf-8')
+        _varint(len(encoded), out)
+        out += encoded
+        _varint(len(positions), out)
+        previous = 0
+        for position in sorted(positions):
+            _varint(position - previous, out)
+            previous = position
+    return bytes(out)
+
+
+def decode_binary(data):
+    index = {}
+    count, pos = _read_varint(data, 0)
+    for _ in range(count):
+        length, pos = _read_varint(data, pos)
+        word = data[pos:pos + length].decode('utf-8')
+        pos += length
+        n, pos = _read_varint(data, pos)
+        positions = []
+        position = 0
+        for _ in range(n):
+            delta, pos = _read_varint(data, pos)
+            position += delta
+            positions.append(position)
+        index[word] = positions
+    return index
+
+
+def encode_abstract(index, fmt):
+    """返回写进 CSV 的值."""
+    if fmt == 'text':
+        return to_text(index)
+    if fmt == 'binary':
+        return '\\x' + encode_binary(index).hex()
+    return json.dumps(index, ensure_ascii=False)
+
+
+def decode_abstract(value, fmt):
+    """CSV 里的值 -> inverted index (text 格式无法还原位置, 返回原文)."""
+    if fmt == 'text':
+        return value
+    if fmt == 'binary':
+        return decode_binary(bytes.fromhex(value[2:]))
+    return json.loads(value)
+
+
+if __name__ == '__main__':
+    # python abstract_encoding.py csv-files/works_abstracts.csv.gz --format binary
+    parser = argparse.ArgumentParser(description='Print abstracts from a works_abstracts.csv.gz file as text.')
+    parser.add_argument('path')
+    parser.add_argument('--format', choices=FORMATS[1:], default='binary')
+    parser.add_argument('--limit', type=int, default=10)
+    args = parser.parse_args()
+    with gzip.open(args.path, 'rt', encoding='utf-8', newline='') as f:
+        for i, row in enumerate(csv.DictReader(f)):
+            if i >= args.limit:
+                break
+            abstract = decode_abstract(row['abstract'], args.format)
+            text = abstract if args.format == 'text' else to_text(abstract)
+            sys.stdout.write(f"{row['work_id']}\t{text}\n")
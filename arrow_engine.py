@@ -0,0 +1,675 @@
+import argparse
+import gzip
+import io
+import json
+import os
+from itertools import islice
+
+from abstract_encoding import encode_abstract
+from gz_members import csv_fields, normalize_value, rows_to_member
+import progress
+from object_store import open_part
+from shard_manifest import ShardFile, table_name
+from works_extract import extract_file
+from year_partitions import table_key
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.csv as pa_csv
+    import pyarrow.json as pa_json
+except ImportError:  # pyarrow 是可选依赖, 只有 arrow 引擎需要
+    pa = None
+
+# 基于 Arrow 的列式展开引擎: 每个 part 文件按块交给 pyarrow 的多线程 JSON
+# reader 解析成 record batch, 再用 list 展开 / struct 取字段 / 过滤空 ID 等
+# 列式运算生成 csv_files 里的每个表, 不再逐条记录跑 Python 循环.
+#
+# 输出的列和 Python 路径一致, 值的写法略有不同 (布尔值为 true/false,
+# 字符串总是加引号), 对 \copy ... csv 来说是等价的. 空字符串和 Python 路径一样
+# 写成没有引号的空字段 (导入为 NULL), 而不是 "" (导入为空字符串). 用
+#   python arrow_engine.py compare <python 输出目录> <arrow 输出目录>
+# 可以逐表校验两种引擎的结果是否一致.
+#
+# works 的某个文件字段类型和下面的 schema 不符 (JSON reader 无法转换) 时,
+# 该文件自动退回 Python 路径 (works_extract) 处理.
+
+BLOCK_LINES = 50000  # 每次交给 JSON reader 的行数
+
+# 这些实体在 Python 路径里按 id 去重
+DEDUPLICATED = {'concepts', 'topics', 'institutions', 'publishers', 'sources'}
+
+
+def require_pyarrow():
+    if pa is None:
+        raise ImportError('the arrow engine needs pyarrow: pip install pyarrow')
+
+
+def use_arrow(config, entity):
+    # --arrow-entities works,authors 或 all
+    entities = {e.strip() for e in (config.get('arrow_entities') or '').split(',')}
+    return 'all' in entities or entity in entities
+
+
+def _struct(*fields):
+    return pa.struct(list(fields))
+
+
+def _counts_by_year(*columns):
+    return ('counts_by_year', pa.list_(_struct(*[(c, pa.int64()) for c in columns])))
+
+
+def entity_schema(entity):
+    """只声明展开时用到的字段, 其余字段由 JSON reader 忽略."""
+    s, i, f, b = pa.string(), pa.int64(), pa.float64(), pa.bool_()
+    id_only = _struct(('id', s))
+    location = _struct(('source', id_only), ('landing_page_url', s),
+                       ('pdf_url', s), ('is_oa', b), ('version', s),
+                       ('license', s))
+    fields = {
+        'authors': [
+            ('id', s), ('orcid', s), ('display_name', s),
+            ('display_name_alternatives', pa.list_(s)), ('works_count', i),
+            ('cited_by_count', i), ('last_known_institution', id_only),
+            ('works_api_url', s), ('updated_date', s),
+            ('ids', _struct(('openalex', s), ('orcid', s), ('scopus', s),
+                            ('twitter', s), ('wikipedia', s), ('mag', i))),
+            _counts_by_year('year', 'works_count', 'cited_by_count',
+                            'oa_works_count'),
+        ],
+        'concepts': [
+            ('id', s), ('wikidata', s), ('display_name', s), ('level', i),
+            ('description', s), ('works_count', i), ('cited_by_count', i),
+            ('image_url', s), ('image_thumbnail_url', s),
+            ('works_api_url', s), ('updated_date', s),
+            ('ids', _struct(('openalex', s), ('wikidata', s), ('wikipedia', s),
+                            ('umls_aui', pa.list_(s)),
+                            ('umls_cui', pa.list_(s)), ('mag', i))),
+            ('ancestors', pa.list_(id_only)),
+            _counts_by_year('year', 'works_count', 'cited_by_count',
+                            'oa_works_count'),
+            ('related_concepts', pa.list_(_struct(('id', s), ('score', f)))),
+        ],
+        'topics': [
+            ('id', s), ('display_name', s),
+            ('subfield', _struct(('id', s), ('display_name', s))),
+            ('field', _struct(('id', s), ('display_name', s))),
+            ('domain', _struct(('id', s), ('display_name', s))),
+            ('description', s), ('keywords', pa.list_(s)),
+            ('works_api_url', s), ('ids', _struct(('wikipedia', s))),
+            ('works_count', i), ('cited_by_count', i), ('updated', s),
+            ('siblings', pa.list_(_struct(('id', s), ('display_name', s)))),
+        ],
+        'institutions': [
+            ('id', s), ('ror', s), ('display_name', s), ('country_code', s),
+            ('type', s), ('homepage_url', s), ('image_url', s),
+            ('image_thumbnail_url', s),
+            ('display_name_acronyms', pa.list_(s)),
+            ('display_name_alternatives', pa.list_(s)),
+            ('works_count', i), ('cited_by_count', i), ('works_api_url', s),
+            ('updated_date', s),
+            ('ids', _struct(('openalex', s), ('ror', s), ('grid', s),
+                            ('wikipedia', s), ('wikidata', s), ('mag', i))),
+            ('geo', _struct(('city', s), ('geonames_city_id', s),
+                            ('region', s), ('country_code', s),
+                            ('country', s), ('latitude', f),
+                            ('longitude', f))),
+            ('associated_institutions',
+             pa.list_(_struct(('id', s), ('relationship', s)))),
+            ('associated_insitutions',  # typo in api
+             pa.list_(_struct(('id', s), ('relationship', s)))),
+            _counts_by_year('year', 'works_count', 'cited_by_count',
+                            'oa_works_count'),
+        ],
+        'publishers': [
+            ('id', s), ('display_name', s), ('alternate_titles', pa.list_(s)),
+            ('country_codes', pa.list_(s)), ('hierarchy_level', i),
+            ('parent_publisher', s), ('works_count', i),
+            ('cited_by_count', i), ('sources_api_url', s),
+            ('updated_date', s),
+            ('ids', _struct(('openalex', s), ('ror', s), ('wikidata', s))),
+            _counts_by_year('year', 'works_count', 'cited_by_count',
+                            'oa_works_count'),
+        ],
+        'sources': [
+            ('id', s), ('issn_l', s), ('issn', pa.list_(s)),
+            ('display_name', s), ('publisher', s), ('works_count', i),
+            ('cited_by_count', i), ('is_oa', b), ('is_in_doaj', b),
+            ('homepage_url', s), ('works_api_url', s), ('updated_date', s),
+            ('ids', _struct(('openalex', s), ('issn_l', s),
+                            ('issn', pa.list_(s)), ('mag', i),
+                            ('wikidata', s), ('fatcat', s))),
+            _counts_by_year('year', 'works_count', 'cited_by_count',
+                            'oa_works_count'),
+        ],
+        'works': [
+            ('id', s), ('doi', s), ('title', s), ('display_name', s),
+            ('publication_year', i), ('publication_date', s), ('type', s),
+            ('cited_by_count', i), ('is_retracted', b), ('is_paratext', b),
+            ('cited_by_api_url', s), ('language', s),
+            ('primary_location', location),
+            ('locations', pa.list_(location)),
+            ('best_oa_location', location),
+            ('authorships', pa.list_(_struct(
+                ('author_position', s), ('author', id_only),
+                ('institutions', pa.list_(id_only)),
+                ('raw_affiliation_string', s)))),
+            ('biblio', _struct(('volume', s), ('issue', s),
+                               ('first_page', s), ('last_page', s))),
+            ('topics', pa.list_(_struct(('id', s), ('score', f)))),
+            ('concepts', pa.list_(_struct(('id', s), ('score', f)))),
+            ('ids', _struct(('openalex', s), ('doi', s), ('mag', i),
+                            ('pmid', s), ('pmcid', s))),
+            ('mesh', pa.list_(_struct(
+                ('descriptor_ui', s), ('descriptor_name', s),
+                ('qualifier_ui', s), ('qualifier_name', s),
+                ('is_major_topic', b)))),
+            ('open_access', _struct(('is_oa', b), ('oa_status', s),
+                                    ('oa_url', s),
+                                    ('any_repository_has_fulltext', b))),
+            ('referenced_works', pa.list_(s)),
+            ('related_works', pa.list_(s)),
+            ('grants', pa.list_(_struct(('funder', s),
+                                        ('funder_display_name', s),
+                                        ('award_id', s)))),
+            _counts_by_year('year', 'cited_by_count'),
+            ('institutions_distinct_count', i),
+            ('countries_distinct_count', i), ('authors_count', i),
+            ('fwci', f),
+            ('citation_normalized_percentile', _struct(
+                ('value', f), ('is_in_top_1_percent', b),
+                ('is_in_top_10_percent', b))),
+        ],
+    }
+    return pa.schema(fields[entity])
+
+
+# ---- 列式运算的小工具 ----
+
+def field(array, *path):
+    for name in path:
+        array = pc.struct_field(array, name)
+    return array
+
+
+def explode(parent_ids, list_array):
+    """展开 list 列: 返回 (每个元素对应的父记录 id, 元素数组)."""
+    parents = pc.list_parent_indices(list_array)
+    return pc.take(parent_ids, parents), pc.list_flatten(list_array)
+
+
+def json_text(array, ensure_ascii=False):
+    # Arrow 没有把嵌套值序列化成 JSON 文本的 kernel, 这类列数量很少, 逐个值处理
+    return pa.array([json.dumps(value, ensure_ascii=ensure_ascii)
+                     for value in array.to_pylist()], pa.string())
+
+
+def arange(n):
+    return pc.indices_nonzero(pc.is_null(pa.nulls(n, pa.bool_())))
+
+
+def build(columns, values, mask=None):
+    table = pa.table(dict(zip(columns, values)))
+    return table.filter(mask) if mask is not None else table
+
+
+def id_table(parent_ids, struct_array, columns):
+    # 类似 ids / geo / biblio / open_access 这种一对一的子对象: 对象非空才输出一行
+    return build(columns,
+                 [parent_ids] + [field(struct_array, c) for c in columns[1:]],
+                 pc.is_valid(struct_array))
+
+
+def counts_table(parent_ids, counts, columns):
+    parents, flat = explode(parent_ids, counts)
+    return build(columns, [parents] + [field(flat, c) for c in columns[1:]])
+
+
+def link_table(parent_ids, items, columns, id_path=('id',), extra=()):
+    parents, flat = explode(parent_ids, items)
+    ids = field(flat, *id_path) if id_path else flat
+    values = [parents, ids] + [field(flat, c) for c in extra]
+    mask = pc.and_(pc.is_valid(ids), pc.not_equal(ids, ''))
+    return build(columns, values, mask)
+
+
+def location_table(parent_ids, locations, columns, exploded=False):
+    if exploded:
+        parent_ids, locations = explode(parent_ids, locations)
+    source_id = field(locations, 'source', 'id')
+    values = [parent_ids, source_id] + [field(locations, c) for c in columns[2:]]
+    return build(columns, values, pc.is_valid(source_id))
+
+
+def authorships_table(work_ids, authorships, columns):
+    work_ids, flat = explode(work_ids, authorships)
+    author_ids = field(flat, 'author', 'id')
+    keep = pc.is_valid(author_ids)
+    work_ids, flat, author_ids = (pc.filter(a, keep) for a in (work_ids, flat, author_ids))
+
+    # 每个 authorship 按有效 institution id 展开; 没有有效 id 的保留一行 NULL
+    institutions = field(flat, 'institutions')
+    parents = pc.list_parent_indices(institutions)
+    institution_ids = field(pc.list_flatten(institutions), 'id')
+    valid = pc.is_valid(institution_ids)
+    parents, institution_ids = pc.filter(parents, valid), pc.filter(institution_ids, valid)
+    indices = arange(len(flat))
+    empty = pc.filter(indices, pc.invert(pc.is_in(indices, value_set=parents)))
+
+    parents = pa.concat_arrays([pc.cast(parents, pa.int64()), pc.cast(empty, pa.int64())])
+    institution_ids = pa.concat_arrays([institution_ids, pa.nulls(len(empty), pa.string())])
+    order = pc.sort_indices(parents)  # 保持与 Python 路径相同的 authorship 顺序
+    parents, institution_ids = pc.take(parents, order), pc.take(institution_ids, order)
+    return build(columns, [
+        pc.take(work_ids, parents),
+        pc.take(field(flat, 'author_position'), parents),
+        pc.take(author_ids, parents),
+        institution_ids,
+        pc.take(field(flat, 'raw_affiliation_string'), parents),
+    ])
+
+
+def normalized_authorships_tables(work_ids, authorships, columns, institution_columns):
+    # 规范化输出: 每个 authorship 一行, 用在列表里的序号 (从 1 开始) 和机构链接表关联
+    lengths = pc.cast(pc.fill_null(pc.list_value_length(authorships), 0), pa.int64())
+    starts = pc.subtract(pc.cumulative_sum(lengths), lengths)
+    parents = pc.list_parent_indices(authorships)
+    work_ids, flat = explode(work_ids, authorships)
+    ordinals = pc.add(pc.subtract(pc.cast(arange(len(flat)), pa.int64()),
+                                  pc.take(starts, parents)), 1)
+    author_ids = field(flat, 'author', 'id')
+    keep = pc.is_valid(author_ids)
+    work_ids, flat, author_ids, ordinals = (pc.filter(a, keep)
+                                            for a in (work_ids, flat, author_ids, ordinals))
+
+    institutions = field(flat, 'institutions')
+    parents = pc.list_parent_indices(institutions)
+    institution_ids = field(pc.list_flatten(institutions), 'id')
+    return {
+        'authorships': build(columns, [
+            work_ids, ordinals, field(flat, 'author_position'), author_ids,
+            field(flat, 'raw_affiliation_string'),
+        ]),
+        'authorships_institutions': build(institution_columns, [
+            pc.take(work_ids, parents), pc.take(ordinals, parents), institution_ids,
+        ], pc.is_valid(institution_ids)),
+    }
+
+
+def abstract_column(lines, fmt=None):
+    # abstract_inverted_index 的 key 是任意单词, 不能声明成 struct;
+    # 只在原始行里定位这一个字段并解析它, 不做整条记录的 json.loads.
+    # fmt 见 abstract_encoding.py, 默认是 JSON 文本
+    decoder = json.JSONDecoder()
+    key = '"abstract_inverted_index":'
+    values = []
+    for line in lines:
+        text = line.decode('utf-8')
+        start = text.find(key)
+        while start > 0 and text[start - 1] == '\\':
+            start = text.find(key, start + 1)
+        if start < 0:
+            values.append(None)
+            continue
+        value_start = start + len(key)
+        while text[value_start] in ' \t':
+            value_start += 1
+        abstract, _ = decoder.raw_decode(text, value_start)
+        values.append(None if abstract is None else encode_abstract(abstract, fmt))
+    return pa.array(values, pa.string())
+
+
+# ---- 各实体的展开逻辑, 与 flatten-openalex-jsonl.py 中的 Python 实现一一对应 ----
+
+def flatten_authors(t, spec, lines):
+    ids = t['id']
+    return {
+        'authors': build(spec['authors']['columns'], [
+            ids, t['orcid'], t['display_name'],
+            json_text(t['display_name_alternatives']), t['works_count'],
+            t['cited_by_count'], field(t['last_known_institution'], 'id'),
+            t['works_api_url'], t['updated_date'],
+        ]),
+        'ids': id_table(ids, t['ids'], spec['ids']['columns']),
+        'counts_by_year': counts_table(ids, t['counts_by_year'],
+                                       spec['counts_by_year']['columns']),
+    }
+
+
+def flatten_concepts(t, spec, lines):
+    ids = t['id']
+    concept_ids = id_table(ids, t['ids'], spec['ids']['columns'])
+    for column in ('umls_aui', 'umls_cui'):
+        concept_ids = concept_ids.set_column(
+            concept_ids.schema.get_field_index(column), column,
+            json_text(concept_ids[column].combine_chunks()))
+    return {
+        'concepts': build(spec['concepts']['columns'],
+                          [t[c] for c in spec['concepts']['columns']]),
+        'ids': concept_ids,
+        'ancestors': link_table(ids, t['ancestors'],
+                                spec['ancestors']['columns']),
+        'counts_by_year': counts_table(ids, t['counts_by_year'],
+                                       spec['counts_by_year']['columns']),
+        'related_concepts': link_table(ids, t['related_concepts'],
+                                       spec['related_concepts']['columns'],
+                                       extra=('score',)),
+    }
+
+
+def flatten_topics(t, spec, lines):
+    keywords = pc.fill_null(pc.binary_join(t['keywords'], '; '), '')
+    values = {
+        'id': t['id'], 'display_name': t['display_name'],
+        'description': t['description'], 'keywords': keywords,
+        'works_api_url': t['works_api_url'],
+        'wikipedia_id': field(t['ids'], 'wikipedia'),
+        'works_count': t['works_count'],
+        'cited_by_count': t['cited_by_count'],
+        'updated_date': t['updated'],
+        'siblings': json_text(t['siblings'], ensure_ascii=True),
+    }
+    for key in ('subfield', 'field', 'domain'):
+        values[f'{key}_id'] = field(t[key], 'id')
+        values[f'{key}_display_name'] = field(t[key], 'display_name')
+    columns = spec['topics']['columns']
+    return {'topics': build(columns, [values[c] for c in columns])}
+
+
+def flatten_institutions(t, spec, lines):
+    ids = t['id']
+    values = {c: t[c] for c in spec['institutions']['columns']
+              if c not in ('display_name_acronyms', 'display_name_alternatives')}
+    values['display_name_acronyms'] = json_text(t['display_name_acronyms'])
+    values['display_name_alternatives'] = json_text(t['display_name_alternatives'])
+    associated = pc.if_else(pc.is_valid(t['associated_institutions']),
+                            t['associated_institutions'],
+                            t['associated_insitutions'])
+    return {
+        'institutions': build(spec['institutions']['columns'],
+                              [values[c] for c in spec['institutions']['columns']]),
+        'ids': id_table(ids, t['ids'], spec['ids']['columns']),
+        'geo': id_table(ids, t['geo'], spec['geo']['columns']),
+        'associated_institutions': link_table(
+            ids, associated, spec['associated_institutions']['columns'],
+            extra=('relationship',)),
+        'counts_by_year': counts_table(ids, t['counts_by_year'],
+                                       spec['counts_by_year']['columns']),
+    }
+
+
+def flatten_publishers(t, spec, lines):
+    ids = t['id']
+    values = {c: t[c] for c in spec['publishers']['columns']
+              if c not in ('alternate_titles', 'country_codes')}
+    values['alternate_titles'] = json_text(t['alternate_titles'])
+    values['country_codes'] = json_text(t['country_codes'])
+    return {
+        'publishers': build(spec['publishers']['columns'],
+                            [values[c] for c in spec['publishers']['columns']]),
+        'ids': id_table(ids, t['ids'], spec['ids']['columns']),
+        'counts_by_year': counts_table(ids, t['counts_by_year'],
+                                       spec['counts_by_year']['columns']),
+    }
+
+
+def flatten_sources(t, spec, lines):
+    ids = t['id']
+    values = {c: t[c] for c in spec['sources']['columns'] if c != 'issn'}
+    values['issn'] = json_text(t['issn'], ensure_ascii=True)
+    source_ids = id_table(ids, t['ids'], spec['ids']['columns'])
+    source_ids = source_ids.set_column(
+        source_ids.schema.get_field_index('issn'), 'issn',
+        json_text(source_ids['issn'].combine_chunks(), ensure_ascii=True))
+    return {
+        'sources': build(spec['sources']['columns'],
+                         [values[c] for c in spec['sources']['columns']]),
+        'ids': source_ids,
+        'counts_by_year': counts_table(ids, t['counts_by_year'],
+                                       spec['counts_by_year']['columns']),
+    }
+
+
+def flatten_works(t, spec, lines):
+    ids = t['id']
+    location_columns = spec['locations']['columns']
+    values = {c: t[c] for c in spec['works']['columns']
+              if c != 'abstract_inverted_index'}
+    if 'abstracts' in spec:
+        abstracts = abstract_column(lines, spec['abstracts']['format'])
+        abstracts = {'abstracts': build(spec['abstracts']['columns'], [ids, abstracts],
+                                        pc.is_valid(abstracts))}
+    else:
+        values['abstract_inverted_index'] = abstract_column(lines)
+        abstracts = {}
+    citation = t['citation_normalized_percentile']
+    more_info = spec['more_info']['columns']
+    if 'authorships_institutions' in spec:
+        authorships = normalized_authorships_tables(
+            ids, t['authorships'], spec['authorships']['columns'],
+            spec['authorships_institutions']['columns'])
+    else:
+        authorships = {'authorships': authorships_table(ids, t['authorships'],
+                                                        spec['authorships']['columns'])}
+    return {
+        'works': build(spec['works']['columns'],
+                       [values[c] for c in spec['works']['columns']]),
+        'primary_locations': location_table(ids, t['primary_location'],
+                                            location_columns),
+        'locations': location_table(ids, t['locations'], location_columns,
+                                    exploded=True),
+        'best_oa_locations': location_table(ids, t['best_oa_location'],
+                                            location_columns),
+        **authorships,
+        **abstracts,
+        'biblio': id_table(ids, t['biblio'], spec['biblio']['columns']),
+        'topics': link_table(ids, t['topics'], spec['topics']['columns'],
+                             extra=('score',)),
+        'concepts': link_table(ids, t['concepts'], spec['concepts']['columns'],
+                               extra=('score',)),
+        'ids': id_table(ids, t['ids'], spec['ids']['columns']),
+        'mesh': counts_table(ids, t['mesh'], spec['mesh']['columns']),
+        'open_access': id_table(ids, t['open_access'],
+                                spec['open_access']['columns']),
+        'referenced_works': link_table(ids, t['referenced_works'],
+                                       spec['referenced_works']['columns'],
+                                       id_path=()),
+        'related_works': link_table(ids, t['related_works'],
+                                    spec['related_works']['columns'],
+                                    id_path=()),
+        'grants': counts_table(ids, t['grants'], spec['grants']['columns']),
+        'counts_by_year': counts_table(ids, t['counts_by_year'],
+                                       spec['counts_by_year']['columns']),
+        'more_info': build(more_info, [
+            ids, t['institutions_distinct_count'],
+            t['countries_distinct_count'], t['authors_count'], t['fwci'],
+            field(citation, 'value'), field(citation, 'is_in_top_1_percent'),
+            field(citation, 'is_in_top_10_percent'),
+        ]),
+    }
+
+
+FLATTENERS = {
+    'authors': flatten_authors,
+    'concepts': flatten_concepts,
+    'topics': flatten_topics,
+    'institutions': flatten_institutions,
+    'publishers': flatten_publishers,
+    'sources': flatten_sources,
+    'works': flatten_works,
+}
+
+
+def read_block(lines, schema):
+    options = pa_json.ParseOptions(explicit_schema=schema,
+                                   unexpected_field_behavior='ignore')
+    table = pa_json.read_json(io.BytesIO(b'\n'.join(lines)),
+                              read_options=pa_json.ReadOptions(use_threads=True),
+                              parse_options=options)
+    return {name: table.column(name).combine_chunks()
+            for name in table.column_names}
+
+
+def deduplicate(t, lines, seen):
+    # 与 Python 路径一致: 跳过空 id, 同一 id 只保留第一次出现的记录.
+    # 直接查 Python set, 每块的开销只和块的大小有关, 与已经见过的 id 个数无关
+    keep = []
+    for record_id in t['id'].to_pylist():
+        new = record_id is not None and record_id not in seen
+        if new:
+            seen.add(record_id)
+        keep.append(new)
+    t = {name: pc.filter(column, pa.array(keep, pa.bool_())) for name, column in t.items()}
+    lines = [line for line, k in zip(lines, keep) if k]
+    return t, lines
+
+
+def flatten_block(entity, lines, file_spec, seen=None):
+    """把一块 JSON 行展开成 {表 key: pa.Table}."""
+    require_pyarrow()
+    t = read_block(lines, entity_schema(entity))
+    if seen is not None:
+        t, lines = deduplicate(t, lines, seen)
+    else:
+        keep = pc.is_valid(t['id'])
+        if keep.false_count:
+            t = {name: pc.filter(column, keep) for name, column in t.items()}
+            lines = [line for line, k in zip(lines, keep.to_pylist()) if k]
+    return FLATTENERS[entity](t, file_spec, lines)
+
+
+def empty_to_null(table):
+    # pyarrow 把 '' 写成 "", \copy 导入为空字符串; Python 的 csv 写成空字段, 导入为 NULL
+    for i, field in enumerate(table.schema):
+        if pa.types.is_string(field.type) or pa.types.is_large_string(field.type):
+            column = table.column(i)
+            empty = pc.equal(column, '')
+            if pc.any(empty).as_py():
+                table = table.set_column(i, field, pc.if_else(empty, pa.scalar(None, field.type), column))
+    return table
+
+
+def table_to_member(table, compresslevel=9):
+    table = empty_to_null(table)
+    buffer = io.BytesIO()
+    pa_csv.write_csv(table, buffer,
+                     pa_csv.WriteOptions(include_header=False,
+                                         quoting_style='needed'))
+    return gzip.compress(buffer.getvalue(), compresslevel)
+
+
+def iter_blocks(jsonl_file_name, block_lines=BLOCK_LINES, row_filter=None):
+    with open_part(jsonl_file_name, 'rb') as jsonl:
+        while True:
+            lines = [line.rstrip(b'\n') for line in islice(jsonl, block_lines)]
+            if not lines:
+                break
+            lines = [line for line in lines if line.strip()
+                     and (row_filter is None or row_filter(line))]
+            if lines:
+                yield lines
+
+
+def flatten_file_members(entity, jsonl_file_name, file_spec, compresslevel=9,
+                         seen=None, block_lines=BLOCK_LINES, row_filter=None,
+                         encoder=None, partitioner=None, output_spec=None):
+    """处理一个 part 文件, 返回 {表 key: [(行数, gzip member), ...]}.
+
+    encoder: dictionary_encoding.LocalEncoder, 把部分字符串列换成整数编码.
+    partitioner: year_partitions.YearPartitioner, 返回的 key 变成 (表 key, 年份区间).
+    output_spec: 输出的列定义 (编码/分区会改列), Python 回退路径按它格式化 CSV.
+    """
+    members = {key: [] for key in file_spec}
+    records = 0
+    try:
+        for lines in iter_blocks(jsonl_file_name, block_lines, row_filter):
+            tables = flatten_block(entity, lines, file_spec, seen)
+            progress.add('records', len(lines))
+            records += len(lines)
+            if encoder is not None:
+                tables = {key: encoder.encode_table(key, table) if table.num_rows else table
+                          for key, table in tables.items()}
+            if partitioner is not None:
+                tables = partitioner.split_tables(tables)
+            for key, table in tables.items():
+                if table.num_rows:
+                    members.setdefault(key, []).append((table.num_rows,
+                                                        table_to_member(table, compresslevel)))
+    except pa.ArrowInvalid as e:
+        # works 有共用的 Python 实现 (works_extract), 整个文件重新处理一遍
+        if entity != 'works':
+            raise
+        print(f'arrow engine cannot read {jsonl_file_name} ({e}), using python')
+        progress.add('records', -records)  # extract_file 会重新计数
+        results = extract_file(jsonl_file_name, file_spec, row_filter)
+        if encoder is not None:
+            results = {key: encoder.encode_rows(key, rows) for key, rows in results.items()}
+        if partitioner is not None:
+            results = partitioner.split_rows(results)
+        output_spec = output_spec or file_spec
+        members = {key: [(len(rows), rows_to_member(rows, output_spec[table_key(key)]['columns'],
+                                                    compresslevel))]
+                   for key, rows in results.items() if rows}
+    return members
+
+
+def flatten_entity(entity, jsonl_file_names, file_spec, compresslevel=9,
+                   row_filter=None):
+    """串行版本: 每个表写一个 .csv.gz, 返回 {表 key: manifest 分片条目}."""
+    require_pyarrow()
+    seen = set() if entity in DEDUPLICATED else None
+    outfiles = {key: ShardFile(spec['name'], spec['columns'], compresslevel)
+                for key, spec in file_spec.items()}
+    try:
+        for jsonl_file_name in jsonl_file_names:
+            print(jsonl_file_name)
+            members = flatten_file_members(entity, jsonl_file_name, file_spec,
+                                           compresslevel, seen,
+                                           row_filter=row_filter)
+            for key, table_members in members.items():
+                for rows, member in table_members:
+                    outfiles[key].write(member, rows)
+    finally:
+        entries = {key: outfile.close() for key, outfile in outfiles.items()}
+    return entries
+
+
+# ---- 两种引擎输出的等价性校验 ----
+
+def read_rows(path):
+    # 按原始文本解析: 空字段 (NULL) 和 "" (空字符串) 导入后不同, 这里也算不同
+    with gzip.open(path, 'rt', encoding='utf-8', newline='') as f:
+        rows = csv_fields(f.read())
+    header = rows[0] if rows else []
+    rows = sorted((tuple(normalize_value(v) for v in row) for row in rows[1:]),
+                  key=lambda row: [(v is not None, v or '') for v in row])
+    return header, rows
+
+
+def compare_outputs(dir_a, dir_b):
+    ok = True
+    for name in sorted(os.listdir(dir_a)):
+        if not name.endswith('.csv.gz'):
+            continue
+        path_b = os.path.join(dir_b, name)
+        if not os.path.exists(path_b):
+            print(f'{table_name(name)}: missing in {dir_b}')
+            ok = False
+            continue
+        header_a, rows_a = read_rows(os.path.join(dir_a, name))
+        header_b, rows_b = read_rows(path_b)
+        same = header_a == header_b and rows_a == rows_b
+        ok = ok and same
+        print(f"{table_name(name)}: {'ok' if same else 'DIFFERENT'} "
+              f'({len(rows_a)} / {len(rows_b)} rows)')
+    return ok
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Check that two flatten outputs contain the same rows.')
+    parser.add_argument('command', choices=['compare'])
+    parser.add_argument('dir_a')
+    parser.add_argument('dir_b')
+    args = parser.parse_args()
+    raise SystemExit(0 if compare_outputs(args.dir_a, args.dir_b) else 1)
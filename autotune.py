@@ -0,0 +1,125 @@
+import multiprocessing
+import os
+import time
+
+# reader/filter 进程数自动调整 (--autotune), 用于 multiprocess_works_add.py / multiprocess_authors.py:
+#   启动时按上限创建 reader 和 filter 进程, 但只有前 --readers / --parsers 个是活动的;
+#   reader 从共享计数器领取下一个文件, 只把数据轮询分给活动的 filter.
+#   不活动的进程只是在等待 (不占 CPU), 调整时改变活动个数即可, 不需要中途创建进程和 ring.
+#
+#   运行开始的 --autotune-seconds 秒内, 主进程每 INTERVAL 秒采样一次:
+#     队列占用  活动 filter 的 data_queue / 共享内存 ring 的占用比例
+#     利用率    reader 读取解压、filter 解析压缩的忙碌时间 / (采样间隔 * 活动进程数)
+#   filter 忙且 (队列不空或 reader 在等) -> 增加 filter;  队列空且 reader 忙 -> 增加 reader;
+#   队列空且 filter 闲 -> 减少 filter;  队列满且 reader 闲 -> 减少 reader.
+#   活动 reader + filter 不超过 CPU 核数. writer 每个输出文件一个, 不参与调整;
+#   writer 队列积压时说明瓶颈在磁盘, 不再增加 filter.
+#
+# 不加 --autotune 时上限就是 --readers / --parsers, 行为与原来相同, 只是文件改为动态领取.
+
+INTERVAL = 5
+HIGH = 0.5  # 队列占用超过这个比例算 "满"
+LOW = 0.05  # 低于这个比例算 "空"
+BUSY = 0.8
+IDLE = 0.5
+
+
+class StageState:
+    """reader/filter 共享的调度状态, 作为参数传给子进程."""
+
+    def __init__(self, readers, filters):
+        self.active = multiprocessing.Array('i', [readers, filters])
+        self.next_file = multiprocessing.Value('i', 0)
+        self.busy = multiprocessing.Array('d', 2)  # reader, filter 累计忙碌秒数
+
+    def readers(self):
+        return self.active[0]
+
+    def filters(self):
+        return self.active[1]
+
+    def claim_file(self, reader_index, total):
+        """领取下一个文件的序号; 没有文件了返回 None. 不活动的 reader 在这里等待."""
+        while True:
+            with self.next_file.get_lock():
+                if self.next_file.value >= total:
+                    return None
+                if reader_index < self.active[0]:
+                    self.next_file.value += 1
+                    return self.next_file.value - 1
+            time.sleep(0.2)
+
+    def add_busy(self, stage, seconds):
+        with self.busy.get_lock():
+            self.busy[stage] += seconds
+
+
+def limits(config, total_files):
+    """(reader 上限, filter 上限)."""
+    if not config['autotune']:
+        return config['readers'], config['parsers']
+    cpus = os.cpu_count() or 1
+    readers = max(config['readers'], min(total_files, max(cpus // 4, 1)))
+    return max(readers, 1), max(config['parsers'], cpus)
+
+
+class Tuner:
+
+    def __init__(self, state, data_queues, rings, table_queues, queue_size, max_readers, max_filters,
+                 duration=180, interval=INTERVAL):
+        self.state = state
+        self.data_queues = data_queues
+        self.rings = rings  # rings[reader][filter]
+        self.table_queues = table_queues
+        self.queue_size = queue_size
+        self.max_readers = max_readers
+        self.max_filters = max_filters
+        self.duration = duration
+        self.interval = interval
+        self.cpus = os.cpu_count() or 1
+
+    def occupancy(self, readers, filters):
+        # 消息只是 ring 里的偏移量, ring 通常先满, 两者取大
+        queues = max(self.data_queues[j].qsize() / self.queue_size for j in range(filters))
+        rings = max(self.rings[i][j].used() for i in range(readers) for j in range(filters))
+        return max(queues, rings)
+
+    def writers_backlogged(self):
+        return any(queue.qsize() / self.queue_size > HIGH for queue in self.table_queues)
+
+    def decide(self, occupancy, reader_busy, filter_busy, writers_backlogged):
+        readers, filters = self.state.readers(), self.state.filters()
+        room = readers + filters < self.cpus
+        if filter_busy > BUSY and (occupancy >= LOW or reader_busy < IDLE) and not writers_backlogged and room \
+                and filters < self.max_filters:
+            return readers, filters + 1
+        if occupancy < LOW and reader_busy > BUSY and room and readers < self.max_readers:
+            return readers + 1, filters
+        if occupancy < LOW and filter_busy < IDLE and filters > 1:
+            return readers, filters - 1
+        if occupancy > HIGH and reader_busy < IDLE and readers > 1:
+            return readers - 1, filters
+        return readers, filters
+
+    def run(self, finished):
+        """在主进程里调用, 到时间或 finished() 为真时返回."""
+        start = time.time()
+        previous = list(self.state.busy[:])
+        while time.time() - start < self.duration and not finished():
+            time.sleep(self.interval)
+            busy = list(self.state.busy[:])
+            readers, filters = self.state.readers(), self.state.filters()
+            reader_busy = (busy[0] - previous[0]) / (self.interval * readers)
+            filter_busy = (busy[1] - previous[1]) / (self.interval * filters)
+            previous = busy
+            occupancy = self.occupancy(readers, filters)
+            backlogged = self.writers_backlogged()
+            new_readers, new_filters = self.decide(occupancy, reader_busy, filter_busy, backlogged)
+            print(f'autotune: readers {readers}, parsers {filters}, queue {occupancy:.0%}, '
+                  f'reader busy {reader_busy:.0%}, parser busy {filter_busy:.0%}'
+                  + (', writers backlogged' if backlogged else '')
+                  + (f' -> readers {new_readers}, parsers {new_filters}'
+                     if (new_readers, new_filters) != (readers, filters) else ''))
+            self.state.active[0] = new_readers
+            self.state.active[1] = new_filters
+        print(f'autotune: done, readers {self.state.readers()}, parsers {self.state.filters()}')
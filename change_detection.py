@@ -0,0 +1,213 @@
+import gzip
+import hashlib
+import io
+import json
+import os
+import sqlite3
+import time
+
+from gz_members import csv_fields, normalize_value
+from object_store import stat
+from openalex_tables import long_id, short_id
+from shard_manifest import table_name
+from sort_output import csv_records
+from year_partitions import table_key
+
+# 记录级变更检测 (--change-store store.sqlite):
+#   每条记录展开出的所有行 (各个表的 CSV 字段值) 算一个 8 字节 blake2b 哈希,
+#   按 id 的数字部分保存在 sqlite 里. 增量运行时只处理大小/修改时间变了的 part 文件,
+#   只输出新增 (inserted) 和内容变化 (changed) 的记录的行, 其余记录的行丢弃.
+#   上次出现在本次重新处理的文件或已删除的文件里、这次没有再出现的记录算 deleted.
+#
+# <entity>_changes.csv.gz (id, change) 列出 inserted/changed/deleted 的 id,
+# changes-<entity>.sql 据此删除数据库里 changed/deleted 记录的旧行, 之后再执行导入脚本:
+#   psql -1 -f csv-files/changes-works.sql -f csv-files/load-works.sql
+#
+# 存储在运行成功结束时一次性提交; 提交前的中断不会改变存储, 重跑即可.
+# 哈希的是规范化后的字段值 (引号、True/true、2.0/2 这类写法不影响, NULL 和空字符串不同),
+# 两种引擎可以混用; 但两次运行要用同样的输出选项, 否则列不同, 所有记录都会算 changed.
+
+CHANGES_COLUMNS = ['id', 'change']
+LOOKUP_BATCH = 900  # sqlite 每条语句的参数个数上限是 999
+
+
+def check_options(config):
+    # 增量输出只包含部分记录, 聚合/引用图会不完整; 字典编码的全局编码每次运行都可能不同
+    conflicts = [key for key in ('dictionary_encode', 'aggregates', 'citation_graph') if config[key]]
+    if conflicts:
+        raise ValueError(f"--change-store cannot be combined with "
+                         f"{', '.join('--' + key.replace('_', '-') for key in conflicts)}")
+
+
+def connect(path, timeout=600):
+    db = sqlite3.connect(path, timeout=timeout)
+    # WAL: worker 读上一次提交的状态, 主进程同时写本次运行的结果
+    db.execute('PRAGMA journal_mode=WAL')
+    return db
+
+
+class ChangeStore:
+    """主进程使用: 决定要处理哪些文件, 记录哈希, 找出删除的记录, 最后提交."""
+
+    def __init__(self, path, entity, snapshot_dir):
+        self.path = path
+        self.entity = entity
+        self.snapshot_dir = snapshot_dir
+        self.db = connect(path)
+        self.db.executescript(f'''
+            CREATE TABLE IF NOT EXISTS files (
+                file_id INTEGER PRIMARY KEY, entity TEXT NOT NULL, path TEXT NOT NULL,
+                size INTEGER, mtime REAL, UNIQUE (entity, path));
+            CREATE TABLE IF NOT EXISTS runs (
+                run INTEGER PRIMARY KEY, entity TEXT NOT NULL, started TEXT);
+            CREATE TABLE IF NOT EXISTS records_{entity} (
+                id INTEGER PRIMARY KEY, hash INTEGER NOT NULL,
+                file_id INTEGER NOT NULL, run INTEGER NOT NULL);
+            CREATE INDEX IF NOT EXISTS records_{entity}_file ON records_{entity} (file_id);
+        ''')
+        self.db.commit()
+        self.run = self.db.execute('INSERT INTO runs (entity, started) VALUES (?, ?)',
+                                   (entity, time.strftime('%Y-%m-%dT%H:%M:%S'))).lastrowid
+        self.processed = set()
+
+    def _relpath(self, path):
+        return os.path.relpath(path, self.snapshot_dir)
+
+    def _file_id(self, path):
+        relpath = self._relpath(path)
+        row = self.db.execute('SELECT file_id FROM files WHERE entity = ? AND path = ?',
+                              (self.entity, relpath)).fetchone()
+        if row:
+            return row[0]
+        return self.db.execute('INSERT INTO files (entity, path) VALUES (?, ?)',
+                               (self.entity, relpath)).lastrowid
+
+    def plan(self, paths):
+        """返回需要处理的文件 (新增或大小/修改时间变了的), 并记下已从快照里消失的文件."""
+        known = {path: (file_id, size, mtime) for file_id, path, size, mtime in self.db.execute(
+            'SELECT file_id, path, size, mtime FROM files WHERE entity = ?', (self.entity,))}
+        changed = []
+        for path in paths:
+            entry = known.pop(self._relpath(path), None)
+            if entry is None or entry[1:] != stat(path):
+                changed.append(path)
+        self.removed = {file_id for file_id, _, _ in known.values()}
+        return changed
+
+    def record(self, path, hashes):
+        """记录一个处理完的文件: hashes 是 [(id, hash), ...], 本次看到的所有记录."""
+        file_id = self._file_id(path)
+        self.db.execute('UPDATE files SET size = ?, mtime = ? WHERE file_id = ?',
+                        (*stat(path), file_id))
+        self.db.executemany(
+            f'INSERT OR REPLACE INTO records_{self.entity} (id, hash, file_id, run) VALUES (?, ?, ?, ?)',
+            ((record_id, value, file_id, self.run) for record_id, value in hashes))
+        self.processed.add(file_id)
+
+    def deleted(self):
+        """找出删除的记录并从存储里去掉 (提交前不生效), 返回删除的 id (数字部分)."""
+        file_ids = sorted(self.processed | self.removed)
+        deleted = []
+        for start in range(0, len(file_ids), LOOKUP_BATCH):
+            batch = file_ids[start:start + LOOKUP_BATCH]
+            marks = ','.join('?' * len(batch))
+            deleted += [row[0] for row in self.db.execute(
+                f'SELECT id FROM records_{self.entity} WHERE file_id IN ({marks}) AND run <> ?',
+                batch + [self.run])]
+        self.db.executemany(f'DELETE FROM records_{self.entity} WHERE id = ?',
+                            ((record_id,) for record_id in deleted))
+        self.db.executemany('DELETE FROM files WHERE file_id = ?',
+                            ((file_id,) for file_id in self.removed))
+        return sorted(deleted)
+
+    def commit(self):
+        # 输出全部写完之后才提交, 中途失败时存储保持上一次运行的状态
+        self.db.commit()
+        self.db.close()
+
+
+def canonical_row(raw):
+    values = [normalize_value(value) for row in csv_fields(raw) for value in row]
+    return json.dumps(values, ensure_ascii=False).encode('utf-8')
+
+
+def record_hashes(members):
+    """{表 key: (行数, member)} -> ({id: hash}, {表 key: [(id, 原始行), ...]}).
+
+    同一条记录在各个表的行按表 key 排序后一起哈希.
+    """
+    digests = {}
+    records = {}
+    for key in sorted(members, key=str):
+        text = gzip.decompress(members[key][1]).decode('utf-8')
+        records[key] = list(csv_records(io.StringIO(text, newline='')))
+        name = f'{table_key(key)}\n'.encode('utf-8')
+        for record_id, raw in records[key]:
+            digest = digests.get(record_id)
+            if digest is None:
+                digest = digests[record_id] = hashlib.blake2b(digest_size=8)
+            digest.update(name)
+            digest.update(canonical_row(raw))
+    hashes = {record_id: int.from_bytes(digest.digest(), 'big', signed=True)
+              for record_id, digest in digests.items()}
+    return hashes, records
+
+
+def previous_hashes(store_path, entity, ids):
+    db = sqlite3.connect(f'file:{store_path}?mode=ro', uri=True, timeout=600)
+    try:
+        result = {}
+        for start in range(0, len(ids), LOOKUP_BATCH):
+            batch = ids[start:start + LOOKUP_BATCH]
+            marks = ','.join('?' * len(batch))
+            result.update(db.execute(f'SELECT id, hash FROM records_{entity} WHERE id IN ({marks})', batch))
+        return result
+    finally:
+        db.close()
+
+
+def filter_members(members, store_path, entity, compresslevel=9):
+    """在 worker 里调用: 只保留新增/变化的记录的行.
+
+    返回 (过滤后的 members, [(id 数字部分, hash)], [{'id': ..., 'change': ...}]).
+    """
+    hashes, records = record_hashes(members)
+    numeric = {record_id: short_id(record_id) for record_id in hashes}
+    # id 不是数字的记录 (不应出现) 不保存, 每次都算 changed
+    old = previous_hashes(store_path, entity,
+                          [value for value in numeric.values() if isinstance(value, int)])
+    changes = []
+    for record_id, value in hashes.items():
+        previous = old.get(numeric[record_id])
+        if previous is None:
+            changes.append({'id': record_id, 'change': 'inserted'})
+        elif previous != value:
+            changes.append({'id': record_id, 'change': 'changed'})
+    keep = {change['id'] for change in changes}
+
+    filtered = {}
+    for key, table_records in records.items():
+        kept = [raw for record_id, raw in table_records if record_id in keep]
+        if kept:
+            filtered[key] = (len(kept), gzip.compress(''.join(kept).encode('utf-8'), compresslevel))
+    stored = [(numeric[record_id], value) for record_id, value in hashes.items()
+              if isinstance(numeric[record_id], int)]
+    return filtered, stored, changes
+
+
+def deleted_rows(entity, ids):
+    return [{'id': long_id(entity, record_id), 'change': 'deleted'} for record_id in ids]
+
+
+def changes_script(changes_path, file_spec, schema='openalex'):
+    """删除 changed/deleted 记录旧行的 SQL, 在导入脚本之前执行."""
+    lines = [
+        'CREATE TEMP TABLE changes (id text PRIMARY KEY, change text);',
+        f"\\copy changes (id, change) from program 'gzip -d -c {changes_path}' csv header",
+    ]
+    for spec in file_spec.values():
+        table = table_name(spec['name'])
+        column = spec['columns'][0]
+        lines.append(f"DELETE FROM {schema}.{table} t USING changes c "
+                     f"WHERE t.{column} = c.id AND c.change <> 'inserted';")
+    return '\n'.join(lines) + '\n'
@@ -0,0 +1,285 @@
+import argparse
+import bisect
+import gzip
+import json
+import math
+import mmap
+import os
+import shutil
+import sys
+import time
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.csv as pa_csv
+except ImportError:  # pyarrow 是可选依赖, 只有引用图导出需要
+    pa = None
+
+# 把 works 的引用关系导出成 CSR (compressed sparse row) 二进制格式,
+# 可以直接 memory-map 给 PageRank / co-citation 之类的图算法使用:
+#
+#   <graph_dir>/ids.bin        int64, 第 i 个节点的 OpenAlex 数字 id (W 后面的数字), 升序
+#   <graph_dir>/offsets.bin    int64, 长度 nodes + 1; 节点 i 的出边是 neighbors[offsets[i]:offsets[i+1]]
+#   <graph_dir>/neighbors.bin  int32 (节点数超过 2^31 时为 int64), 被引用 work 的节点编号, 每个节点内升序
+#   <graph_dir>/meta.json      节点数、边数、dtype 等
+#
+# 节点是快照里所有 work 加上被引用但不在快照里的 id; 重复的边 (同一 work 出现在
+# 多个 updated_date 分区) 只保留一条.
+#
+# 两步完成, 内存占用有上限:
+#   1. 展开 works 时 (processpool_test.py --citation-graph DIR) 每个 part 文件
+#      写一组 run 文件: runs/<shard>.nodes / .src / .dst (int64)
+#   2. build_csr 把 run 按 id 分桶写到临时目录, 每次只在内存里处理一个桶,
+#      桶的数量按 --graph-memory 估算 (最多 MAX_BUCKETS 个). OpenAlex 的 id 分布很不均匀,
+#      桶的边界取抽样的分位数, 不是把 id 范围等分
+
+ID_PATTERN = r'^(?:.*/)?[A-Za-z]\d+$'
+READ_BYTES = 64 * 1024 * 1024
+SAMPLE_SIZE = 1000000  # 确定桶边界时大约抽样的 id 个数
+MAX_BUCKETS = 4096
+
+
+def require_pyarrow():
+    if pa is None:
+        raise ImportError('the citation graph export needs pyarrow: pip install pyarrow')
+
+
+def check_memory(memory_mb):
+    if memory_mb <= 0:
+        raise ValueError(f'--graph-memory must be a positive number of MB, got {memory_mb}')
+
+
+def numeric_ids(strings):
+    # https://openalex.org/W123 -> 123, 非标准的 id 丢弃
+    strings = pc.filter(strings, pc.match_substring_regex(strings, ID_PATTERN))
+    return pc.cast(pc.replace_substring_regex(strings, r'^(?:.*/)?[A-Za-z]', ''),
+                   pa.int64())
+
+
+def member_columns(member, columns, wanted):
+    table = pa_csv.read_csv(
+        pa.BufferReader(gzip.decompress(member)),
+        read_options=pa_csv.ReadOptions(column_names=columns),
+        convert_options=pa_csv.ConvertOptions(
+            include_columns=wanted,
+            column_types={c: pa.string() for c in wanted}))
+    return [table[c].combine_chunks() for c in wanted]
+
+
+def write_array(f, array):
+    # 只写数据 buffer (调用方保证没有 null)
+    size = array.type.byte_width
+    f.write(array.buffers()[1].slice(array.offset * size, len(array) * size))
+
+
+def read_array(path, start=0, count=None):
+    with open(path, 'rb') as f:
+        f.seek(start * 8)
+        data = f.read() if count is None else f.read(count * 8)
+    return pa.Array.from_buffers(pa.int64(), len(data) // 8, [None, pa.py_buffer(data)])
+
+
+def iter_chunks(path, values=READ_BYTES // 8):
+    size = os.path.getsize(path) // 8
+    for start in range(0, size, values):
+        yield read_array(path, start, values)
+
+
+def write_run(graph_dir, name, members, file_spec):
+    """在 worker 里调用: 从 works / referenced_works 的 gzip member 取出节点和边."""
+    require_pyarrow()
+    run_dir = os.path.join(graph_dir, 'runs')
+    os.makedirs(run_dir, exist_ok=True)
+    arrays = {'nodes': pa.array([], pa.int64()), 'src': pa.array([], pa.int64()),
+              'dst': pa.array([], pa.int64())}
+    if 'works' in members:
+        ids, = member_columns(members['works'][1], file_spec['works']['columns'], ['id'])
+        arrays['nodes'] = numeric_ids(ids)
+    if 'referenced_works' in members:
+        src, dst = member_columns(members['referenced_works'][1],
+                                  file_spec['referenced_works']['columns'],
+                                  ['work_id', 'referenced_work_id'])
+        keep = pc.and_(pc.match_substring_regex(src, ID_PATTERN),
+                       pc.match_substring_regex(dst, ID_PATTERN))
+        arrays['src'] = numeric_ids(pc.filter(src, keep))
+        arrays['dst'] = numeric_ids(pc.filter(dst, keep))
+    for suffix, array in arrays.items():
+        path = os.path.join(run_dir, f'{name}.{suffix}')
+        with open(path + '.tmp', 'wb') as f:
+            write_array(f, array)
+        os.replace(path + '.tmp', path)
+
+
+def arange(start, n):
+    indices = pc.indices_nonzero(pc.is_null(pa.nulls(n, pa.bool_())))
+    return pc.add(pc.cast(indices, pa.int64()), start)
+
+
+def int64_values(array):
+    # 没有 null 的 int64 数组的值, 可以按下标取 Python int (给 bisect 用)
+    return memoryview(array.buffers()[1]).cast('q')[array.offset:array.offset + len(array)]
+
+
+class Buckets:
+    """按边界把 int64 数组追加写到 len(bounds) + 1 个桶文件: 桶 i 是 bounds[i - 1] <= key < bounds[i]."""
+
+    def __init__(self, directory, prefix, bounds, columns):
+        self.bounds = bounds
+        self.paths = [[os.path.join(directory, f'{prefix}-{i}.{c}') for c in columns]
+                      for i in range(len(bounds) + 1)]
+        for paths in self.paths:
+            for path in paths:
+                open(path, 'wb').close()
+
+    def add(self, key, *arrays):
+        # 按 key 排序一次, 每个桶是连续的一段, 分界用二分查找 (与桶数基本无关)
+        order = pc.sort_indices(key)
+        arrays = [array.take(order) for array in arrays]
+        keys = int64_values(key.take(order))
+        cuts = [0] + [bisect.bisect_left(keys, bound) for bound in self.bounds] + [len(keys)]
+        for paths, start, end in zip(self.paths, cuts, cuts[1:]):
+            if start == end:
+                continue
+            # 写的时候才打开, 桶再多也不会占满文件描述符
+            for path, array in zip(paths, arrays):
+                with open(path, 'ab') as f:
+                    write_array(f, array.slice(start, end - start))
+
+
+def run_files(graph_dir, suffix):
+    run_dir = os.path.join(graph_dir, 'runs')
+    return sorted(os.path.join(run_dir, name) for name in os.listdir(run_dir)
+                  if name.endswith('.' + suffix))
+
+
+def build_csr(graph_dir, temp_dir=None, memory_mb=1024):
+    require_pyarrow()
+    check_memory(memory_mb)
+    start_time = time.time()
+    nodes_runs = run_files(graph_dir, 'nodes')
+    edge_runs = list(zip(run_files(graph_dir, 'src'), run_files(graph_dir, 'dst')))
+
+    # 总量决定桶数; 每隔 step 个 id 抽样一个, 抽样的分位数作为桶边界, 每个桶的数据量接近
+    paths = nodes_runs + [p for pair in edge_runs for p in pair]
+    total_bytes = sum(os.path.getsize(path) for path in paths)
+    step = max(1, total_bytes // 8 // SAMPLE_SIZE)
+    sample = []
+    for path in paths:
+        for chunk in iter_chunks(path):
+            sample.append(chunk.take(pc.multiply(arange(0, math.ceil(len(chunk) / step)), step)))
+    sample = pa.concat_arrays(sample) if sample else pa.array([], pa.int64())
+    sample = int64_values(sample.take(pc.sort_indices(sample)))
+    # 处理一个桶时大约需要桶内数据量 4 倍的内存 (排序/去重/映射)
+    n_buckets = min(MAX_BUCKETS, max(1, math.ceil(total_bytes * 4 / (memory_mb * 1024 * 1024))))
+    # 同一个 id 不能跨桶, 重复的边界去掉
+    bounds = sorted({sample[len(sample) * i // n_buckets] for i in range(1, n_buckets)}) if len(sample) else []
+    work_dir = os.path.join(temp_dir or graph_dir, 'csr-tmp')
+    os.makedirs(work_dir, exist_ok=True)
+
+    # 1. 节点按 id 分桶, 边按被引用 id (dst) 分桶
+    nodes = Buckets(work_dir, 'nodes', bounds, ['ids'])
+    for path in nodes_runs:
+        for chunk in iter_chunks(path):
+            nodes.add(chunk, chunk)
+    by_dst = Buckets(work_dir, 'by-dst', bounds, ['src', 'dst'])
+    for src_path, dst_path in edge_runs:
+        for src, dst in zip(iter_chunks(src_path), iter_chunks(dst_path)):
+            nodes.add(dst, dst)
+            by_dst.add(dst, src, dst)
+
+    # 2. 每个桶内去重排序得到节点编号, 同时把 dst 换成节点编号并按 src 重新分桶
+    bases = []
+    n_nodes = 0
+    by_src = Buckets(work_dir, 'by-src', bounds, ['src', 'dst'])
+    with open(os.path.join(graph_dir, 'ids.bin'), 'wb') as ids_file:
+        for i in range(len(bounds) + 1):
+            ids = pc.unique(read_array(nodes.paths[i][0]))
+            ids = pc.take(ids, pc.sort_indices(ids))
+            write_array(ids_file, ids)
+            bases.append((n_nodes, len(ids)))
+            src = read_array(by_dst.paths[i][0])
+            dst = pc.add(pc.cast(pc.index_in(read_array(by_dst.paths[i][1]), value_set=ids),
+                                 pa.int64()), n_nodes)
+            by_src.add(src, src, dst)
+            n_nodes += len(ids)
+            for path in nodes.paths[i] + by_dst.paths[i]:
+                os.remove(path)
+
+    # 3. 每个桶内按 (src, dst) 去重排序, 写 neighbors 和 offsets
+    neighbor_type = pa.int32() if n_nodes < 2 ** 31 else pa.int64()
+    n_edges = 0
+    with open(os.path.join(graph_dir, 'ids.bin'), 'rb') as ids_file, \
+            open(os.path.join(graph_dir, 'offsets.bin'), 'wb') as offsets_file, \
+            open(os.path.join(graph_dir, 'neighbors.bin'), 'wb') as neighbors_file:
+        write_array(offsets_file, pa.array([0], pa.int64()))
+        for i, (base, count) in enumerate(bases):
+            ids = read_array(ids_file.name, base, count)
+            src = pc.add(pc.cast(pc.index_in(read_array(by_src.paths[i][0]), value_set=ids),
+                                 pa.int64()), base)
+            edges = pa.table({'src': src, 'dst': read_array(by_src.paths[i][1])}) \
+                .filter(pc.is_valid(src)) \
+                .group_by(['src', 'dst'], use_threads=False).aggregate([]) \
+                .sort_by([('src', 'ascending'), ('dst', 'ascending')])
+            write_array(neighbors_file, pc.cast(edges['dst'].combine_chunks(), neighbor_type))
+
+            # 每个节点的出度: 把本桶所有节点编号各加一次再计数, 出度为 0 的节点也有一项
+            degrees = pa.table({'node': pa.concat_arrays([edges['src'].combine_chunks(),
+                                                          arange(base, count)])}) \
+                .group_by('node', use_threads=False).aggregate([('node', 'count')]) \
+                .sort_by('node')
+            degrees = pc.subtract(degrees['node_count'].combine_chunks(), 1)
+            if count:
+                write_array(offsets_file, pc.add(pc.cumulative_sum(degrees), n_edges))
+            n_edges += edges.num_rows
+            for path in by_src.paths[i]:
+                os.remove(path)
+    shutil.rmtree(work_dir)
+
+    meta = {
+        'nodes': n_nodes,
+        'edges': n_edges,
+        'id_prefix': 'https://openalex.org/W',
+        'ids_dtype': 'int64',
+        'offsets_dtype': 'int64',
+        'neighbors_dtype': 'int32' if neighbor_type == pa.int32() else 'int64',
+        'buckets': len(bounds) + 1,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+    with open(os.path.join(graph_dir, 'meta.json'), 'w', encoding='utf-8') as f:
+        json.dump(meta, f, indent=2)
+    print(f'citation graph: {n_nodes} nodes, {n_edges} edges, {len(bounds) + 1} buckets, '
+          f'{time.time() - start_time:.2f} seconds')
+    return meta
+
+
+def load_graph(graph_dir):
+    """零拷贝打开 CSR 文件, 返回 (meta, ids, offsets, neighbors) 三个 memoryview.
+
+    numpy 用户也可以直接 np.memmap(path, dtype=meta[...]) 打开.
+    """
+    with open(os.path.join(graph_dir, 'meta.json'), encoding='utf-8') as f:
+        meta = json.load(f)
+    views = []
+    for name, code in (('ids', 'q'), ('offsets', 'q'),
+                       ('neighbors', 'i' if meta['neighbors_dtype'] == 'int32' else 'q')):
+        with open(os.path.join(graph_dir, f'{name}.bin'), 'rb') as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                views.append(memoryview(b'').cast(code))
+                continue
+            views.append(memoryview(mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)).cast(code))
+    return (meta, *views)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Build the CSR citation graph from the runs written by the works flattener.')
+    parser.add_argument('graph_dir')
+    parser.add_argument('--temp-dir', default=None)
+    parser.add_argument('--graph-memory', type=int, default=1024,
+                        help='approximate memory budget in MB (default: 1024)')
+    args = parser.parse_args()
+    try:
+        build_csr(args.graph_dir, args.temp_dir, args.graph_memory)
+    except ValueError as e:
+        sys.exit(str(e))
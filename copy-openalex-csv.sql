@@ -43,6 +43,9 @@
 \copy openalex.works_locations (work_id, source_id, landing_page_url, pdf_url, is_oa, version, license) from program 'gzip -d -c E:/openalex_csv/works_locations.csv.gz' csv header
 \copy openalex.works_best_oa_locations (work_id, source_id, landing_page_url, pdf_url, is_oa, version, license) from program 'gzip -d -c E:/openalex_csv/works_best_oa_locations.csv.gz' csv header
 \copy openalex.works_authorships (work_id, author_position, author_id, institution_id, raw_affiliation_string) from program 'gzip -d -c E:/openalex_csv/works_authorships.csv.gz' csv header
+    -- with --normalize-authorships, instead of the line above:
+--\copy openalex.works_authorships (work_id, author_ordinal, author_position, author_id, raw_affiliation_string) from program 'gzip -d -c E:/openalex_csv/works_authorships.csv.gz' csv header
+--\copy openalex.works_authorships_institutions (work_id, author_ordinal, institution_id) from program 'gzip -d -c E:/openalex_csv/works_authorships_institutions.csv.gz' csv header
 \copy openalex.works_biblio (work_id, volume, issue, first_page, last_page) from program 'gzip -d -c E:/openalex_csv/works_biblio.csv.gz' csv header
 \copy openalex.works_topics (work_id, topic_id, score) from program 'gzip -d -c E:/openalex_csv/works_topics.csv.gz' csv header
 \copy openalex.works_concepts (work_id, concept_id, score) from program 'gzip -d -c E:/openalex_csv/works_concepts.csv.gz' csv header
@@ -0,0 +1,201 @@
+import csv
+import gzip
+import io
+import os
+import pickle
+import shutil
+
+from gz_members import rows_to_member
+from shard_manifest import ShardFile, table_name
+from year_partitions import table_key
+
+# 重复度很高的字符串列 (license, version, oa_status ...) 改成整数编码:
+# 事实表里写 <列名>_id, 字符串本身写到维表 dim_<维度> (id, value).
+#
+#   1. worker 展开一个 part 文件时用文件内的局部编码 (从 1 开始, 按首次出现顺序),
+#      编码后的 member 和局部字典溢写到临时目录
+#   2. 所有文件处理完后, 按分片名排序依次合并局部字典, 得到与调度顺序无关的全局编码
+#   3. 再并行把每个分片的局部编码换成全局编码, 写入最终的输出文件
+#
+# 空字符串和 null 不编码, 仍然是 NULL.
+# raw_affiliation_string 的不同取值很多, 合并时全局字典会占用较多内存.
+
+DIMENSIONS = {
+    'license': [('locations', 'license'), ('primary_locations', 'license'),
+                ('best_oa_locations', 'license')],
+    'version': [('locations', 'version'), ('primary_locations', 'version'),
+                ('best_oa_locations', 'version')],
+    'raw_affiliation_string': [('authorships', 'raw_affiliation_string')],
+    'oa_status': [('open_access', 'oa_status')],
+    'mesh_descriptor_name': [('mesh', 'descriptor_name')],
+}
+
+def parse_dimensions(value):
+    names = [name.strip() for name in (value or '').split(',') if name.strip()]
+    if 'all' in names:
+        return list(DIMENSIONS)
+    unknown = set(names) - set(DIMENSIONS)
+    if unknown:
+        raise ValueError(f"unknown dimensions: {', '.join(sorted(unknown))} "
+                         f"(choose from {', '.join(DIMENSIONS)} or all)")
+    return names
+
+
+def encoded_columns(dimensions):
+    """{表 key: {列名: 维度}}"""
+    columns = {}
+    for dimension in dimensions:
+        for key, column in DIMENSIONS[dimension]:
+            columns.setdefault(key, {})[column] = dimension
+    return columns
+
+
+def encoded_spec(file_spec, dimensions):
+    # 编码列改名为 <列名>_id
+    spec = {}
+    encoded = encoded_columns(dimensions)
+    for key, table_spec in file_spec.items():
+        columns = encoded.get(key, {})
+        spec[key] = dict(table_spec, columns=[f'{c}_id' if c in columns else c
+                                              for c in table_spec['columns']])
+    return spec
+
+
+class LocalEncoder:
+    """一个 part 文件内的局部编码."""
+
+    def __init__(self, dimensions):
+        self.columns = encoded_columns(dimensions)
+        self.codes = {dimension: {} for dimension in dimensions}
+
+    def code(self, dimension, value):
+        if value is None or value == '':
+            return None
+        codes = self.codes[dimension]
+        if value not in codes:
+            codes[value] = len(codes) + 1
+        return codes[value]
+
+    def encode_rows(self, key, rows):
+        for column, dimension in self.columns.get(key, {}).items():
+            for row in rows:
+                row[f'{column}_id'] = self.code(dimension, row.get(column))
+        return rows
+
+    def encode_table(self, key, table):
+        # arrow 引擎: 先 dictionary_encode, 只对不同的取值查编码
+        import pyarrow as pa
+        import pyarrow.compute as pc
+        for column, dimension in self.columns.get(key, {}).items():
+            encoded = pc.dictionary_encode(table[column].combine_chunks())
+            codes = pa.array([self.code(dimension, value)
+                              for value in encoded.dictionary.to_pylist()], pa.int64())
+            table = table.set_column(table.schema.get_field_index(column),
+                                     f'{column}_id', pc.take(codes, encoded.indices))
+        return table
+
+    def dictionaries(self):
+        # 局部编码 i 对应 values[i - 1]
+        return {dimension: list(codes) for dimension, codes in self.codes.items()}
+
+
+def spill_shard(spill_dir, shard, members, dictionaries):
+    """把一个分片的局部字典和编码表 member 写到 spill_dir/<shard>.pickle.
+
+    字典在前, 合并时只需读第一个对象.
+    """
+    os.makedirs(spill_dir, exist_ok=True)
+    path = os.path.join(spill_dir, f'{shard}.pickle')
+    with open(path + '.tmp', 'wb') as f:
+        pickle.dump(dictionaries, f, protocol=pickle.HIGHEST_PROTOCOL)
+        pickle.dump(members, f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(path + '.tmp', path)
+
+
+def spilled_shards(spill_dir):
+    if not os.path.isdir(spill_dir):
+        return []
+    return sorted(name[:-len('.pickle')] for name in os.listdir(spill_dir)
+                  if name.endswith('.pickle'))
+
+
+def load_dictionaries(spill_dir, shard):
+    with open(os.path.join(spill_dir, f'{shard}.pickle'), 'rb') as f:
+        return pickle.load(f)
+
+
+class GlobalDictionary:
+    """按分片名顺序合并局部字典, 编码按首次出现的顺序分配, 结果确定."""
+
+    def __init__(self, dimensions):
+        self.codes = {dimension: {} for dimension in dimensions}
+
+    def merge(self, dictionaries):
+        mapping = {}
+        for dimension, values in dictionaries.items():
+            codes = self.codes[dimension]
+            mapping[dimension] = [codes.setdefault(value, len(codes) + 1)
+                                  for value in values]
+        return mapping
+
+    def write(self, specs, compresslevel=9, batch=100000):
+        """写出各维表 (specs: csv_files['dimensions']), 返回 {维度: manifest 分片条目}."""
+        entries = {}
+        for dimension, codes in self.codes.items():
+            spec = specs[dimension]
+            outfile = ShardFile(spec['name'], spec['columns'], compresslevel)
+            try:
+                rows = [{'id': code, 'value': value} for value, code in codes.items()]
+                for start in range(0, len(rows), batch):
+                    chunk = rows[start:start + batch]
+                    outfile.write(rows_to_member(chunk, spec['columns'], compresslevel), len(chunk))
+            finally:
+                entries[dimension] = outfile.close()
+        return entries
+
+
+def remap_shard(spill_dir, shard, mapping, file_spec, dimensions, compresslevel=9):
+    """在 worker 里把一个分片的局部编码换成全局编码, 返回 (shard, {表 key: (行数, member)})."""
+    path = os.path.join(spill_dir, f'{shard}.pickle')
+    with open(path, 'rb') as f:
+        pickle.load(f)
+        members = pickle.load(f)
+    spec = encoded_spec(file_spec, dimensions)
+    encoded = encoded_columns(dimensions)
+    result = {}
+    for key, (rows, member) in members.items():
+        columns = spec[table_key(key)]['columns']
+        positions = [(columns.index(f'{column}_id'), mapping[dimension])
+                     for column, dimension in encoded[table_key(key)].items()]
+        buffer = io.StringIO()
+        writer = csv.writer(buffer, lineterminator='\n')
+        reader = csv.reader(io.StringIO(gzip.decompress(member).decode('utf-8')))
+        for row in reader:
+            for position, codes in positions:
+                if row[position]:
+                    row[position] = codes[int(row[position]) - 1]
+            writer.writerow(row)
+        result[key] = (rows, gzip.compress(buffer.getvalue().encode('utf-8'), compresslevel))
+    os.remove(path)
+    return shard, result
+
+
+def dictionary_schema(dimensions, csv_files, schema='openalex'):
+    """维表的建表语句, 以及把事实表的编码列改成 integer <列名>_id 的 ALTER 语句.
+
+    在 openalex-pg-schema.sql 之后、导入数据之前执行.
+    """
+    lines = []
+    for dimension in dimensions:
+        lines.append(f'CREATE TABLE {schema}.dim_{dimension} (id integer PRIMARY KEY, value text);')
+    for key, columns in encoded_columns(dimensions).items():
+        table = table_name(csv_files['works'][key]['name'])
+        for column in columns:
+            lines.append(f'ALTER TABLE {schema}.{table} RENAME COLUMN {column} TO {column}_id;')
+            lines.append(f'ALTER TABLE {schema}.{table} ALTER COLUMN {column}_id '
+                         f'TYPE integer USING {column}_id::integer;')
+    return '\n'.join(lines) + '\n'
+
+
+def clear_spill(spill_dir):
+    shutil.rmtree(spill_dir, ignore_errors=True)
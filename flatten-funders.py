@@ -1,34 +1,27 @@
 import csv
-import glob
 import gzip
 import json
 import os
 import time
 
-SNAPSHOT_DIR = 'D:/openalex_data'
-CSV_DIR = 'D:/openalex-documentation-scripts-main/outputfile'
+from object_store import open_part
+from openalex_config import load_config, snapshot_files
+from openalex_tables import build_csv_files
+from row_filter import compile_filter
 
-csv_files = {
-    'funders': {
-        'funders': {
-            'name': os.path.join(CSV_DIR, 'funders.csv.gz'),
-            'columns': ['id', 'display_name', 'country_code', 'country_id',
-                        'description', 'grants_count', 'works_count','homepage_url',
-                        ]
-        },
-        'funders_id': {
-            'name': os.path.join(CSV_DIR, 'funders_id.csv.gz'),
-            'columns': ['funder_id', 'crossref_id', 'doi', 'ror', 'wikidata']
-        }
-    }
-}
+config = load_config(description='Flatten OpenAlex funders into CSV files.')
+SNAPSHOT_DIR = config['snapshot_dir']
+CSV_DIR = config['csv_dir']
+ROW_FILTER = compile_filter(config['where'])
+
+csv_files = build_csv_files(CSV_DIR)
 
 def flatten_funders():
     file_spec = csv_files['funders']
     with gzip.open(file_spec['funders']['name'], 'wt',
-                encoding='utf-8') as funders_csv, \
+                encoding='utf-8', compresslevel=config['compresslevel']) as funders_csv, \
         gzip.open(file_spec['funders_id']['name'], 'wt',
-                    encoding='utf-8') as funders_id_csv:
+                    encoding='utf-8', compresslevel=config['compresslevel']) as funders_id_csv:
         
         funders_writer = csv.DictWriter(funders_csv, fieldnames=file_spec['funders']['columns'], lineterminator='\n')
         funders_writer.writeheader()
@@ -37,12 +30,14 @@ def flatten_funders():
         funders_id_writer.writeheader()
 
 
-        for jsonl_file_name in glob.glob(os.path.join(SNAPSHOT_DIR, 'funders', '*', '*.gz')):
+        for jsonl_file_name in snapshot_files(config, 'funders'):
             print(jsonl_file_name)
-            with gzip.open(jsonl_file_name, 'r') as funders_jsonl:
+            with open_part(jsonl_file_name, 'r') as funders_jsonl:
                 for funders_json in funders_jsonl:
                     if not funders_json.strip():
                         continue
+                    if ROW_FILTER and not ROW_FILTER(funders_json):
+                        continue
                     funder = json.loads(funders_json)
 
 
@@ -72,4 +67,5 @@ def flatten_funders():
                         })
 
 if __name__ == '__main__':
+    os.makedirs(CSV_DIR, exist_ok=True)
     flatten_funders()
\ No newline at end of file
@@ -1,264 +1,59 @@
 import csv
-import glob
 import gzip
 import json
 import os
 import time
-
-SNAPSHOT_DIR = 'E:/openalex_data'
-CSV_DIR = 'E:/openalex_csv'
+from contextlib import ExitStack
+
+import arrow_engine
+import merged_ids
+from object_store import open_part
+from openalex_config import build_parser, load_config, snapshot_files
+from openalex_tables import build_csv_files
+from row_filter import compile_filter
+from threaded_io import ThreadedReader, ThreadedWriter
+from works_extract import abstract_format, extract_work, new_results
+
+parser = build_parser('Flatten the OpenAlex snapshot into CSV files.')
+parser.add_argument('--entities', nargs='+', default=['topics'],
+                    choices=['authors', 'topics', 'concepts', 'institutions',
+                             'publishers', 'sources', 'works'],
+                    help='entities to flatten (default: topics)')
+config = load_config(parser=parser)
+SNAPSHOT_DIR = config['snapshot_dir']
+CSV_DIR = config['csv_dir']
+COMPRESSLEVEL = config['compresslevel']
+WHERE_FILTER = compile_filter(config['where'])
+# 当前实体的过滤器: --where, 以及 --merged-ids 时该实体被合并掉的 id, 见 flatten_entity
+ROW_FILTER = WHERE_FILTER
 
 if not os.path.exists(CSV_DIR):
-    os.mkdir(CSV_DIR)
-
-FILES_PER_ENTITY = int(os.environ.get('OPENALEX_DEMO_FILES_PER_ENTITY', '0'))
-
-csv_files = {
-    'authors': {
-        'authors': {
-            'name': os.path.join(CSV_DIR, 'authors.csv.gz'),
-            'columns': [
-                'id', 'orcid', 'display_name', 'display_name_alternatives',
-                'works_count', 'cited_by_count',
-                'last_known_institution', 'works_api_url', 'updated_date',
-            ]
-        },
-        'ids': {
-            'name': os.path.join(CSV_DIR, 'authors_ids.csv.gz'),
-            'columns': [
-                'author_id', 'openalex', 'orcid', 'scopus', 'twitter',
-                'wikipedia', 'mag'
-            ]
-        },
-        'counts_by_year': {
-            'name': os.path.join(CSV_DIR, 'authors_counts_by_year.csv.gz'),
-            'columns': [
-                'author_id', 'year', 'works_count', 'cited_by_count',
-                'oa_works_count'
-            ]
-        }
-    },
-    'concepts': {
-        'concepts': {
-            'name': os.path.join(CSV_DIR, 'concepts.csv.gz'),
-            'columns': [
-                'id', 'wikidata', 'display_name', 'level', 'description',
-                'works_count', 'cited_by_count', 'image_url',
-                'image_thumbnail_url', 'works_api_url', 'updated_date'
-            ]
-        },
-        'ancestors': {
-            'name': os.path.join(CSV_DIR, 'concepts_ancestors.csv.gz'),
-            'columns': ['concept_id', 'ancestor_id']
-        },
-        'counts_by_year': {
-            'name': os.path.join(CSV_DIR, 'concepts_counts_by_year.csv.gz'),
-            'columns': ['concept_id', 'year', 'works_count', 'cited_by_count',
-                        'oa_works_count']
-        },
-        'ids': {
-            'name': os.path.join(CSV_DIR, 'concepts_ids.csv.gz'),
-            'columns': ['concept_id', 'openalex', 'wikidata', 'wikipedia',
-                        'umls_aui', 'umls_cui', 'mag']
-        },
-        'related_concepts': {
-            'name': os.path.join(CSV_DIR, 'concepts_related_concepts.csv.gz'),
-            'columns': ['concept_id', 'related_concept_id', 'score']
-        }
-    },
-    'topics': {
-        'topics': {
-            'name': os.path.join(CSV_DIR, 'topics.csv.gz'),
-            'columns': ['id', 'display_name', 'subfield_id',
-                        'subfield_display_name', 'field_id',
-                        'field_display_name',
-                        'domain_id', 'domain_display_name', 'description',
-                        'keywords', 'works_api_url', 'wikipedia_id',
-                        'works_count', 'cited_by_count', 'updated_date', 'siblings']
-        }
-    },
-    'institutions': {
-        'institutions': {
-            'name': os.path.join(CSV_DIR, 'institutions.csv.gz'),
-            'columns': [
-                'id', 'ror', 'display_name', 'country_code', 'type',
-                'homepage_url', 'image_url', 'image_thumbnail_url',
-                'display_name_acronyms', 'display_name_alternatives',
-                'works_count', 'cited_by_count', 'works_api_url',
-                'updated_date'
-            ]
-        },
-        'ids': {
-            'name': os.path.join(CSV_DIR, 'institutions_ids.csv.gz'),
-            'columns': [
-                'institution_id', 'openalex', 'ror', 'grid', 'wikipedia',
-                'wikidata', 'mag'
-            ]
-        },
-        'geo': {
-            'name': os.path.join(CSV_DIR, 'institutions_geo.csv.gz'),
-            'columns': [
-                'institution_id', 'city', 'geonames_city_id', 'region',
-                'country_code', 'country', 'latitude',
-                'longitude'
-            ]
-        },
-        'associated_institutions': {
-            'name': os.path.join(CSV_DIR,
-                                 'institutions_associated_institutions.csv.gz'),
-            'columns': [
-                'institution_id', 'associated_institution_id', 'relationship'
-            ]
-        },
-        'counts_by_year': {
-            'name': os.path.join(CSV_DIR, 'institutions_counts_by_year.csv.gz'),
-            'columns': [
-                'institution_id', 'year', 'works_count', 'cited_by_count',
-                'oa_works_count'
-            ]
-        }
-    },
-    'publishers': {
-        'publishers': {
-            'name': os.path.join(CSV_DIR, 'publishers.csv.gz'),
-            'columns': [
-                'id', 'display_name', 'alternate_titles', 'country_codes',
-                'hierarchy_level', 'parent_publisher',
-                'works_count', 'cited_by_count', 'sources_api_url',
-                'updated_date'
-            ]
-        },
-        'counts_by_year': {
-            'name': os.path.join(CSV_DIR, 'publishers_counts_by_year.csv.gz'),
-            'columns': ['publisher_id', 'year', 'works_count', 'cited_by_count',
-                        'oa_works_count']
-        },
-        'ids': {
-            'name': os.path.join(CSV_DIR, 'publishers_ids.csv.gz'),
-            'columns': ['publisher_id', 'openalex', 'ror', 'wikidata']
-        },
-    },
-    'sources': {
-        'sources': {
-            'name': os.path.join(CSV_DIR, 'sources.csv.gz'),
-            'columns': [
-                'id', 'issn_l', 'issn', 'display_name', 'publisher',
-                'works_count', 'cited_by_count', 'is_oa',
-                'is_in_doaj', 'homepage_url', 'works_api_url', 'updated_date'
-            ]
-        },
-        'ids': {
-            'name': os.path.join(CSV_DIR, 'sources_ids.csv.gz'),
-            'columns': ['source_id', 'openalex', 'issn_l', 'issn', 'mag',
-                        'wikidata', 'fatcat']
-        },
-        'counts_by_year': {
-            'name': os.path.join(CSV_DIR, 'sources_counts_by_year.csv.gz'),
-            'columns': ['source_id', 'year', 'works_count', 'cited_by_count',
-                        'oa_works_count']
-        },
-    },
-    'works': {
-        'works': {
-            'name': os.path.join(CSV_DIR, 'works.csv.gz'),
-            'columns': [
-                'id', 'doi', 'title', 'display_name', 'publication_year',
-                'publication_date', 'type', 'cited_by_count',
-                'is_retracted', 'is_paratext', 'cited_by_api_url',
-                'abstract_inverted_index', 'language'
-            ]
-        },
-        'primary_locations': {
-            'name': os.path.join(CSV_DIR, 'works_primary_locations.csv.gz'),
-            'columns': [
-                'work_id', 'source_id', 'landing_page_url', 'pdf_url', 'is_oa',
-                'version', 'license'
-            ]
-        },
-        'locations': {
-            'name': os.path.join(CSV_DIR, 'works_locations.csv.gz'),
-            'columns': [
-                'work_id', 'source_id', 'landing_page_url', 'pdf_url', 'is_oa',
-                'version', 'license'
-            ]
-        },
-        'best_oa_locations': {
-            'name': os.path.join(CSV_DIR, 'works_best_oa_locations.csv.gz'),
-            'columns': [
-                'work_id', 'source_id', 'landing_page_url', 'pdf_url', 'is_oa',
-                'version', 'license'
-            ]
-        },
-        'authorships': {
-            'name': os.path.join(CSV_DIR, 'works_authorships.csv.gz'),
-            'columns': [
-                'work_id', 'author_position', 'author_id', 'institution_id',
-                'raw_affiliation_string'
-            ]
-        },
-        'biblio': {
-            'name': os.path.join(CSV_DIR, 'works_biblio.csv.gz'),
-            'columns': [
-                'work_id', 'volume', 'issue', 'first_page', 'last_page'
-            ]
-        },
-        'topics': {
-            'name': os.path.join(CSV_DIR, 'works_topics.csv.gz'),
-            'columns': [
-                'work_id', 'topic_id', 'score'
-            ]
-        },
-        'concepts': {
-            'name': os.path.join(CSV_DIR, 'works_concepts.csv.gz'),
-            'columns': [
-                'work_id', 'concept_id', 'score'
-            ]
-        },
-        'ids': {
-            'name': os.path.join(CSV_DIR, 'works_ids.csv.gz'),
-            'columns': [
-                'work_id', 'openalex', 'doi', 'mag', 'pmid', 'pmcid'
-            ]
-        },
-        'mesh': {
-            'name': os.path.join(CSV_DIR, 'works_mesh.csv.gz'),
-            'columns': [
-                'work_id', 'descriptor_ui', 'descriptor_name', 'qualifier_ui',
-                'qualifier_name', 'is_major_topic'
-            ]
-        },
-        'open_access': {
-            'name': os.path.join(CSV_DIR, 'works_open_access.csv.gz'),
-            'columns': [
-                'work_id', 'is_oa', 'oa_status', 'oa_url',
-                'any_repository_has_fulltext'
-            ]
-        },
-        'referenced_works': {
-            'name': os.path.join(CSV_DIR, 'works_referenced_works.csv.gz'),
-            'columns': [
-                'work_id', 'referenced_work_id'
-            ]
-        },
-        'related_works': {
-            'name': os.path.join(CSV_DIR, 'works_related_works.csv.gz'),
-            'columns': [
-                'work_id', 'related_work_id'
-            ]
-        },
-    },
-}
+    os.makedirs(CSV_DIR)
+
+FILES_PER_ENTITY = config['files_per_entity']
+
+# 解压输入和压缩输出放到后台线程, 主线程只做解析 (见 threaded_io.py)
+IO_THREADS = config['io_threads']
+
+csv_files = build_csv_files(CSV_DIR, config['normalize_authorships'], config['abstracts'])
+
+
+def open_input(jsonl_file_name):
+    return ThreadedReader(jsonl_file_name) if IO_THREADS else open_part(jsonl_file_name, 'r')
+
+
+def open_output(path):
+    if IO_THREADS:
+        return ThreadedWriter(path, COMPRESSLEVEL)
+    return gzip.open(path, 'wt', encoding='utf-8', compresslevel=COMPRESSLEVEL)
 
 
 def flatten_authors():
     file_spec = csv_files['authors']
 
-    with gzip.open(file_spec['authors']['name'], 'wt',
-                   encoding='utf-8') as authors_csv, \
-            gzip.open(file_spec['ids']['name'], 'wt',
-                      encoding='utf-8') as ids_csv, \
-            gzip.open(file_spec['counts_by_year']['name'], 'wt',
-                      encoding='utf-8') as counts_by_year_csv:
+    with open_output(file_spec['authors']['name']) as authors_csv, \
+            open_output(file_spec['ids']['name']) as ids_csv, \
+            open_output(file_spec['counts_by_year']['name']) as counts_by_year_csv:
 
         authors_writer = csv.DictWriter(
             authors_csv, fieldnames=file_spec['authors']['columns'],
@@ -275,13 +70,14 @@ def flatten_authors():
         counts_by_year_writer.writeheader()
 
         files_done = 0
-        for jsonl_file_name in glob.glob(
-                os.path.join(SNAPSHOT_DIR, 'data', 'authors', '*', '*.gz')):
+        for jsonl_file_name in snapshot_files(config, 'authors'):
             print(jsonl_file_name)
-            with gzip.open(jsonl_file_name, 'r') as authors_jsonl:
+            with open_input(jsonl_file_name) as authors_jsonl:
                 for author_json in authors_jsonl:
                     if not author_json.strip():
                         continue
+                    if ROW_FILTER and not ROW_FILTER(author_json):
+                        continue
 
                     author = json.loads(author_json)
 
@@ -313,8 +109,7 @@ def flatten_authors():
 
 
 def flatten_topics():
-    with gzip.open(csv_files['topics']['topics']['name'], 'wt',
-                   encoding='utf-8') as topics_csv:
+    with open_output(csv_files['topics']['topics']['name']) as topics_csv:
         topics_writer = csv.DictWriter(topics_csv,
                                        fieldnames=csv_files['topics']['topics'][
                                            'columns'],lineterminator='\n')
@@ -322,13 +117,14 @@ def flatten_topics():
 
         seen_topic_ids = set()
         files_done = 0
-        for jsonl_file_name in glob.glob(
-                os.path.join(SNAPSHOT_DIR, 'data', 'topics', '*', '*.gz')):
+        for jsonl_file_name in snapshot_files(config, 'topics'):
             print(jsonl_file_name)
-            with gzip.open(jsonl_file_name, 'r') as topics_jsonl:
+            with open_input(jsonl_file_name) as topics_jsonl:
                 for line in topics_jsonl:
                     if not line.strip():
                         continue
+                    if ROW_FILTER and not ROW_FILTER(line):
+                        continue
                     topic = json.loads(line)
                     topic['keywords'] = '; '.join(topic.get('keywords', ''))
                     if not (
@@ -352,16 +148,11 @@ def flatten_topics():
 
 
 def flatten_concepts():
-    with gzip.open(csv_files['concepts']['concepts']['name'], 'wt',
-                   encoding='utf-8') as concepts_csv, \
-            gzip.open(csv_files['concepts']['ancestors']['name'], 'wt',
-                      encoding='utf-8') as ancestors_csv, \
-            gzip.open(csv_files['concepts']['counts_by_year']['name'], 'wt',
-                      encoding='utf-8') as counts_by_year_csv, \
-            gzip.open(csv_files['concepts']['ids']['name'], 'wt',
-                      encoding='utf-8') as ids_csv, \
-            gzip.open(csv_files['concepts']['related_concepts']['name'], 'wt',
-                      encoding='utf-8') as related_concepts_csv:
+    with open_output(csv_files['concepts']['concepts']['name']) as concepts_csv, \
+            open_output(csv_files['concepts']['ancestors']['name']) as ancestors_csv, \
+            open_output(csv_files['concepts']['counts_by_year']['name']) as counts_by_year_csv, \
+            open_output(csv_files['concepts']['ids']['name']) as ids_csv, \
+            open_output(csv_files['concepts']['related_concepts']['name']) as related_concepts_csv:
 
         concepts_writer = csv.DictWriter(
             concepts_csv,
@@ -393,13 +184,14 @@ def flatten_concepts():
         seen_concept_ids = set()
 
         files_done = 0
-        for jsonl_file_name in glob.glob(
-                os.path.join(SNAPSHOT_DIR, 'data', 'concepts', '*', '*.gz')):
+        for jsonl_file_name in snapshot_files(config, 'concepts'):
             print(jsonl_file_name)
-            with gzip.open(jsonl_file_name, 'r') as concepts_jsonl:
+            with open_input(jsonl_file_name) as concepts_jsonl:
                 for concept_json in concepts_jsonl:
                     if not concept_json.strip():
                         continue
+                    if ROW_FILTER and not ROW_FILTER(concept_json):
+                        continue
 
                     concept = json.loads(concept_json)
 
@@ -449,16 +241,11 @@ def flatten_concepts():
 def flatten_institutions():
     file_spec = csv_files['institutions']
 
-    with gzip.open(file_spec['institutions']['name'], 'wt',
-                   encoding='utf-8') as institutions_csv, \
-            gzip.open(file_spec['ids']['name'], 'wt',
-                      encoding='utf-8') as ids_csv, \
-            gzip.open(file_spec['geo']['name'], 'wt',
-                      encoding='utf-8') as geo_csv, \
-            gzip.open(file_spec['associated_institutions']['name'], 'wt',
-                      encoding='utf-8') as associated_institutions_csv, \
-            gzip.open(file_spec['counts_by_year']['name'], 'wt',
-                      encoding='utf-8') as counts_by_year_csv:
+    with open_output(file_spec['institutions']['name']) as institutions_csv, \
+            open_output(file_spec['ids']['name']) as ids_csv, \
+            open_output(file_spec['geo']['name']) as geo_csv, \
+            open_output(file_spec['associated_institutions']['name']) as associated_institutions_csv, \
+            open_output(file_spec['counts_by_year']['name']) as counts_by_year_csv:
 
         institutions_writer = csv.DictWriter(
             institutions_csv, fieldnames=file_spec['institutions']['columns'],
@@ -487,14 +274,14 @@ def flatten_institutions():
         seen_institution_ids = set()
 
         files_done = 0
-        for jsonl_file_name in glob.glob(
-                os.path.join(SNAPSHOT_DIR, 'data', 'institutions', '*',
-                             '*.gz')):
+        for jsonl_file_name in snapshot_files(config, 'institutions'):
             print(jsonl_file_name)
-            with gzip.open(jsonl_file_name, 'r') as institutions_jsonl:
+            with open_input(jsonl_file_name) as institutions_jsonl:
                 for institution_json in institutions_jsonl:
                     if not institution_json.strip():
                         continue
+                    if ROW_FILTER and not ROW_FILTER(institution_json):
+                        continue
 
                     institution = json.loads(institution_json)
 
@@ -551,12 +338,9 @@ def flatten_institutions():
 
 
 def flatten_publishers():
-    with gzip.open(csv_files['publishers']['publishers']['name'], 'wt',
-                   encoding='utf-8') as publishers_csv, \
-            gzip.open(csv_files['publishers']['counts_by_year']['name'], 'wt',
-                      encoding='utf-8') as counts_by_year_csv, \
-            gzip.open(csv_files['publishers']['ids']['name'], 'wt',
-                      encoding='utf-8') as ids_csv:
+    with open_output(csv_files['publishers']['publishers']['name']) as publishers_csv, \
+            open_output(csv_files['publishers']['counts_by_year']['name']) as counts_by_year_csv, \
+            open_output(csv_files['publishers']['ids']['name']) as ids_csv:
 
         publishers_writer = csv.DictWriter(
             publishers_csv,
@@ -577,13 +361,14 @@ def flatten_publishers():
         seen_publisher_ids = set()
 
         files_done = 0
-        for jsonl_file_name in glob.glob(
-                os.path.join(SNAPSHOT_DIR, 'data', 'publishers', '*', '*.gz')):
+        for jsonl_file_name in snapshot_files(config, 'publishers'):
             print(jsonl_file_name)
-            with gzip.open(jsonl_file_name, 'r') as concepts_jsonl:
+            with open_input(jsonl_file_name) as concepts_jsonl:
                 for publisher_json in concepts_jsonl:
                     if not publisher_json.strip():
                         continue
+                    if ROW_FILTER and not ROW_FILTER(publisher_json):
+                        continue
 
                     publisher = json.loads(publisher_json)
 
@@ -615,12 +400,9 @@ def flatten_publishers():
 
 
 def flatten_sources():
-    with gzip.open(csv_files['sources']['sources']['name'], 'wt',
-                   encoding='utf-8') as sources_csv, \
-            gzip.open(csv_files['sources']['ids']['name'], 'wt',
-                      encoding='utf-8') as ids_csv, \
-            gzip.open(csv_files['sources']['counts_by_year']['name'], 'wt',
-                      encoding='utf-8') as counts_by_year_csv:
+    with open_output(csv_files['sources']['sources']['name']) as sources_csv, \
+            open_output(csv_files['sources']['ids']['name']) as ids_csv, \
+            open_output(csv_files['sources']['counts_by_year']['name']) as counts_by_year_csv:
 
         sources_writer = csv.DictWriter(
             sources_csv, fieldnames=csv_files['sources']['sources']['columns'],
@@ -640,13 +422,14 @@ def flatten_sources():
         seen_source_ids = set()
 
         files_done = 0
-        for jsonl_file_name in glob.glob(
-                os.path.join(SNAPSHOT_DIR, 'data', 'sources', '*', '*.gz')):
+        for jsonl_file_name in snapshot_files(config, 'sources'):
             print(jsonl_file_name)
-            with gzip.open(jsonl_file_name, 'r') as sources_jsonl:
+            with open_input(jsonl_file_name) as sources_jsonl:
                 for source_json in sources_jsonl:
                     if not source_json.strip():
                         continue
+                    if ROW_FILTER and not ROW_FILTER(source_json):
+                        continue
 
                     source = json.loads(source_json)
 
@@ -677,204 +460,32 @@ def flatten_sources():
 def flatten_works():
     file_spec = csv_files['works']
 
-    with gzip.open(file_spec['works']['name'], 'wt',
-                   encoding='utf-8') as works_csv, \
-            gzip.open(file_spec['primary_locations']['name'], 'wt',
-                      encoding='utf-8') as primary_locations_csv, \
-            gzip.open(file_spec['locations']['name'], 'wt',
-                      encoding='utf-8') as locations, \
-            gzip.open(file_spec['best_oa_locations']['name'], 'wt',
-                      encoding='utf-8') as best_oa_locations, \
-            gzip.open(file_spec['authorships']['name'], 'wt',
-                      encoding='utf-8') as authorships_csv, \
-            gzip.open(file_spec['biblio']['name'], 'wt',
-                      encoding='utf-8') as biblio_csv, \
-            gzip.open(file_spec['topics']['name'], 'wt',
-                      encoding='utf-8') as topics_csv, \
-            gzip.open(file_spec['concepts']['name'], 'wt',
-                      encoding='utf-8') as concepts_csv, \
-            gzip.open(file_spec['ids']['name'], 'wt',
-                      encoding='utf-8') as ids_csv, \
-            gzip.open(file_spec['mesh']['name'], 'wt',
-                      encoding='utf-8') as mesh_csv, \
-            gzip.open(file_spec['open_access']['name'], 'wt',
-                      encoding='utf-8') as open_access_csv, \
-            gzip.open(file_spec['referenced_works']['name'], 'wt',
-                      encoding='utf-8') as referenced_works_csv, \
-            gzip.open(file_spec['related_works']['name'], 'wt',
-                      encoding='utf-8') as related_works_csv:
-
-        works_writer = init_dict_writer(works_csv, file_spec['works'],
-                                        extrasaction='ignore',lineterminator='\n')
-        primary_locations_writer = init_dict_writer(primary_locations_csv,
-                                                    file_spec[
-                                                        'primary_locations'],lineterminator='\n')
-        locations_writer = init_dict_writer(locations, file_spec['locations'],lineterminator='\n')
-        best_oa_locations_writer = init_dict_writer(best_oa_locations,
-                                                    file_spec[
-                                                        'best_oa_locations'],lineterminator='\n')
-        authorships_writer = init_dict_writer(authorships_csv,
-                                              file_spec['authorships'],lineterminator='\n')
-        biblio_writer = init_dict_writer(biblio_csv, file_spec['biblio'],lineterminator='\n')
-        topics_writer = init_dict_writer(topics_csv, file_spec['topics'],lineterminator='\n')
-        concepts_writer = init_dict_writer(concepts_csv, file_spec['concepts'],lineterminator='\n')
-        ids_writer = init_dict_writer(ids_csv, file_spec['ids'],
-                                      extrasaction='ignore',lineterminator='\n')
-        mesh_writer = init_dict_writer(mesh_csv, file_spec['mesh'],lineterminator='\n')
-        open_access_writer = init_dict_writer(open_access_csv,
-                                              file_spec['open_access'],lineterminator='\n')
-        referenced_works_writer = init_dict_writer(referenced_works_csv,
-                                                   file_spec[
-                                                       'referenced_works'],lineterminator='\n')
-        related_works_writer = init_dict_writer(related_works_csv,
-                                                file_spec['related_works'],lineterminator='\n')
+    # 一次读取 works 快照, 同时写出全部 16 个表 (包括 grants/counts_by_year/more_info)
+    with ExitStack() as stack:
+        writers = {}
+        for key, spec in file_spec.items():
+            csv_file = stack.enter_context(open_output(spec['name']))
+            writers[key] = init_dict_writer(csv_file, spec,
+                                            extrasaction='ignore',
+                                            lineterminator='\n')
 
         files_done = 0
-        for jsonl_file_name in glob.glob(
-                os.path.join(SNAPSHOT_DIR, 'data', 'works', '*', '*.gz')):
+        for jsonl_file_name in snapshot_files(config, 'works'):
             print(jsonl_file_name)
-            with gzip.open(jsonl_file_name, 'r') as works_jsonl:
+            with open_input(jsonl_file_name) as works_jsonl:
                 for work_json in works_jsonl:
                     if not work_json.strip():
                         continue
-
-                    work = json.loads(work_json)
-
-                    if not (work_id := work.get('id')):
+                    if ROW_FILTER and not ROW_FILTER(work_json):
                         continue
 
-                    # works
-                    if (abstract := work.get(
-                            'abstract_inverted_index')) is not None:
-                        work['abstract_inverted_index'] = json.dumps(abstract,
-                                                                     ensure_ascii=False)
-
-                    works_writer.writerow(work)
-
-                    # primary_locations
-                    if primary_location := (work.get('primary_location') or {}):
-                        if primary_location.get(
-                                'source') and primary_location.get(
-                                'source').get('id'):
-                            primary_locations_writer.writerow({
-                                'work_id': work_id,
-                                'source_id': primary_location['source']['id'],
-                                'landing_page_url': primary_location.get(
-                                    'landing_page_url'),
-                                'pdf_url': primary_location.get('pdf_url'),
-                                'is_oa': primary_location.get('is_oa'),
-                                'version': primary_location.get('version'),
-                                'license': primary_location.get('license'),
-                            })
-
-                    # locations
-                    if locations := work.get('locations'):
-                        for location in locations:
-                            if location.get('source') and location.get(
-                                    'source').get('id'):
-                                locations_writer.writerow({
-                                    'work_id': work_id,
-                                    'source_id': location['source']['id'],
-                                    'landing_page_url': location.get(
-                                        'landing_page_url'),
-                                    'pdf_url': location.get('pdf_url'),
-                                    'is_oa': location.get('is_oa'),
-                                    'version': location.get('version'),
-                                    'license': location.get('license'),
-                                })
-
-                    # best_oa_locations
-                    if best_oa_location := (work.get('best_oa_location') or {}):
-                        if best_oa_location.get(
-                                'source') and best_oa_location.get(
-                                'source').get('id'):
-                            best_oa_locations_writer.writerow({
-                                'work_id': work_id,
-                                'source_id': best_oa_location['source']['id'],
-                                'landing_page_url': best_oa_location.get(
-                                    'landing_page_url'),
-                                'pdf_url': best_oa_location.get('pdf_url'),
-                                'is_oa': best_oa_location.get('is_oa'),
-                                'version': best_oa_location.get('version'),
-                                'license': best_oa_location.get('license'),
-                            })
-
-                    # authorships
-                    if authorships := work.get('authorships'):
-                        for authorship in authorships:
-                            if author_id := authorship.get('author', {}).get(
-                                    'id'):
-                                institutions = authorship.get('institutions')
-                                institution_ids = [i.get('id') for i in
-                                                   institutions]
-                                institution_ids = [i for i in institution_ids if
-                                                   i]
-                                institution_ids = institution_ids or [None]
-
-                                for institution_id in institution_ids:
-                                    authorships_writer.writerow({
-                                        'work_id': work_id,
-                                        'author_position': authorship.get(
-                                            'author_position'),
-                                        'author_id': author_id,
-                                        'institution_id': institution_id,
-                                        'raw_affiliation_string': authorship.get(
-                                            'raw_affiliation_string'),
-                                    })
-
-                    # biblio
-                    if biblio := work.get('biblio'):
-                        biblio['work_id'] = work_id
-                        biblio_writer.writerow(biblio)
-
-                    # topics
-                    for topic in work.get('topics', []):
-                        if topic_id := topic.get('id'):
-                            topics_writer.writerow({
-                                'work_id': work_id,
-                                'topic_id': topic_id,
-                                'score': topic.get('score')
-                            })
-
-                    # concepts
-                    for concept in work.get('concepts'):
-                        if concept_id := concept.get('id'):
-                            concepts_writer.writerow({
-                                'work_id': work_id,
-                                'concept_id': concept_id,
-                                'score': concept.get('score'),
-                            })
+                    results = new_results(file_spec)
+                    if not extract_work(json.loads(work_json), results, abstract_format(file_spec)):
+                        continue
 
-                    # ids
-                    if ids := work.get('ids'):
-                        ids['work_id'] = work_id
-                        ids_writer.writerow(ids)
-
-                    # mesh
-                    for mesh in work.get('mesh'):
-                        mesh['work_id'] = work_id
-                        mesh_writer.writerow(mesh)
-
-                    # open_access
-                    if open_access := work.get('open_access'):
-                        open_access['work_id'] = work_id
-                        open_access_writer.writerow(open_access)
-
-                    # referenced_works
-                    for referenced_work in work.get('referenced_works'):
-                        if referenced_work:
-                            referenced_works_writer.writerow({
-                                'work_id': work_id,
-                                'referenced_work_id': referenced_work
-                            })
-
-                    # related_works
-                    for related_work in work.get('related_works'):
-                        if related_work:
-                            related_works_writer.writerow({
-                                'work_id': work_id,
-                                'related_work_id': related_work
-                            })
+                    for key, rows in results.items():
+                        if rows:
+                            writers[key].writerows(rows)
 
             files_done += 1
             if FILES_PER_ENTITY and files_done >= FILES_PER_ENTITY:
@@ -889,15 +500,22 @@ def init_dict_writer(csv_file, file_spec, **kwargs):
     return writer
 
 
+def flatten_entity(entity):
+    global ROW_FILTER
+    ROW_FILTER = merged_ids.entity_filter(config, entity, WHERE_FILTER)
+    if arrow_engine.use_arrow(config, entity):
+        arrow_engine.flatten_entity(entity, snapshot_files(config, entity),
+                                    csv_files[entity], COMPRESSLEVEL,
+                                    ROW_FILTER)
+    else:
+        globals()[f'flatten_{entity}']()
+    if config['merged_ids']:
+        merged_ids.write_entity_deletes(config, entity, csv_files[entity], ROW_FILTER)
+
+
 if __name__ == '__main__':
-    # flatten_authors()
-
-    flatten_topics()
-    # flatten_concepts()
-    # flatten_institutions()
-    # flatten_publishers()
-    # flatten_sources()
-    # start = time.time()
-    # flatten_works()
-    # end = time.time()
-    # print(f"Time taken: {(end - start) / 60}  minutes")
+    for entity in config['args'].entities:
+        start = time.time()
+        flatten_entity(entity)
+        end = time.time()
+        print(f"{entity}: {(end - start) / 60}  minutes")
@@ -0,0 +1,86 @@
+import csv
+import gzip
+import io
+
+# 在 filter/worker 进程里把行格式化成 CSV 并压缩成独立的 gzip member,
+# writer 只需要把 member 依次 write() 到同一个文件.
+# 多个 gzip member 首尾相接仍是合法的 .gz 文件, gzip/zcat/\copy 都能直接读.
+
+
+def rows_to_csv_bytes(rows, columns, header=False):
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=columns, extrasaction='ignore',
+                            lineterminator='\n')
+    if header:
+        writer.writeheader()
+    writer.writerows(rows)
+    return buffer.getvalue().encode('utf-8')
+
+
+def rows_to_member(rows, columns, compresslevel=9):
+    return gzip.compress(rows_to_csv_bytes(rows, columns), compresslevel)
+
+
+def header_member(columns, compresslevel=9):
+    return gzip.compress(rows_to_csv_bytes([], columns, header=True),
+                         compresslevel)
+
+
+def _field(text, i):
+    # 从 i 开始读一个字段, 返回 (值, 字段之后的位置); 没有引号的空字段是 None
+    n = len(text)
+    if i < n and text[i] == '"':
+        parts = []
+        i += 1
+        while True:
+            end = text.find('"', i)
+            if end < 0:
+                parts.append(text[i:])
+                return ''.join(parts), n
+            parts.append(text[i:end])
+            if text.startswith('"', end + 1):  # "" 表示一个引号
+                parts.append('"')
+                i = end + 2
+            else:
+                return ''.join(parts), end + 1
+    end = i
+    while end < n and text[end] not in ',\r\n':
+        end += 1
+    return text[i:end] or None, end
+
+
+def csv_fields(text):
+    """解析 CSV 文本, 与 csv.reader 相同, 但区分 NULL 和空字符串.
+
+    \\copy ... csv 把没有引号的空字段当作 NULL, 把 "" 当作空字符串;
+    这里前者返回 None, 后者返回 ''. 空行跳过.
+    """
+    rows = []
+    i, n = 0, len(text)
+    while i < n:
+        row = []
+        while True:
+            value, i = _field(text, i)
+            row.append(value)
+            if i < n and text[i] == ',':
+                i += 1
+            else:
+                break
+        i += 2 if text.startswith('\r\n', i) else 1
+        if row != [None]:
+            rows.append(row)
+    return rows
+
+
+def normalize_value(value):
+    # 两种引擎对同一个值的写法可能不同 (True/true, 2.0/2), 比较和哈希前统一
+    if value is None:
+        return None
+    if value in ('True', 'true'):
+        return 'true'
+    if value in ('False', 'false'):
+        return 'false'
+    try:
+        return repr(float(value)) if any(ch in value for ch in '.eE') else value
+    except ValueError:
+        return value
@@ -0,0 +1,438 @@
+import ctypes
+import ctypes.util
+import gzip
+import os
+import re
+import sqlite3
+import sys
+import time
+import zlib
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from openalex_config import build_parser, load_config, snapshot_files
+from openalex_tables import short_id
+from row_filter import top_level_values
+
+# 快照 .gz 文件的随机访问索引, 按 OpenAlex id 直接取出单条记录:
+#
+#   python gzip_index.py build works              # 建索引 (已索引且未变化的文件跳过)
+#   python gzip_index.py get works W2741809807    # 打印记录的原始 JSON
+#   python gzip_index.py extract works --ids-file ids.txt --out openalex-subset
+#
+# 索引是一个 sqlite 文件 (<index_dir>/<entity>.sqlite):
+#   records: id -> (part 文件, 解压后的偏移, 长度)
+#   points:  每个 part 文件里每隔 --span MB 解压数据的一个访问点
+#            (压缩流中 deflate block 边界的位置 + 之前 32KB 的解压窗口)
+# 和 zlib 的 examples/zran.c 一样: 从最近的访问点开始 inflate, 最多只需
+# 解压 span 大小的数据, 不需要从文件开头解压.
+# 标准库 zlib 模块没有暴露 Z_BLOCK / inflatePrime, 所以通过 ctypes 调用 libz.
+#
+# extract 把一组 id 的记录按快照的目录结构写到 --out, 可以直接作为
+# --snapshot-dir 交给各个展开脚本, 只重新处理这些记录.
+# 同一个 id 在多个 updated_date 分区出现时, 按文件路径顺序全部返回 (最新的在最后).
+
+WINDOW_SIZE = 32768
+CHUNK_SIZE = 1 << 18
+
+Z_OK, Z_STREAM_END, Z_NEED_DICT, Z_BUF_ERROR = 0, 1, 2, -5
+Z_NO_FLUSH, Z_BLOCK = 0, 5
+
+ID_PREFIX = re.compile(rb'^\s*\{\s*"id"\s*:\s*"([^"\\]*)"')
+
+
+class ZStream(ctypes.Structure):
+    _fields_ = [
+        ('next_in', ctypes.c_void_p), ('avail_in', ctypes.c_uint),
+        ('total_in', ctypes.c_ulong),
+        ('next_out', ctypes.c_void_p), ('avail_out', ctypes.c_uint),
+        ('total_out', ctypes.c_ulong),
+        ('msg', ctypes.c_char_p), ('state', ctypes.c_void_p),
+        ('zalloc', ctypes.c_void_p), ('zfree', ctypes.c_void_p),
+        ('opaque', ctypes.c_void_p),
+        ('data_type', ctypes.c_int), ('adler', ctypes.c_ulong),
+        ('reserved', ctypes.c_ulong),
+    ]
+
+
+_libz = None
+
+
+def libz():
+    global _libz
+    if _libz is None:
+        path = ctypes.util.find_library('z')
+        if not path:
+            raise OSError('gzip_index needs the zlib shared library (libz)')
+        _libz = ctypes.CDLL(path)
+        _libz.zlibVersion.restype = ctypes.c_char_p
+        for name in ('inflateInit2_', 'inflate', 'inflateEnd', 'inflateReset',
+                     'inflateReset2', 'inflatePrime', 'inflateSetDictionary'):
+            getattr(_libz, name).restype = ctypes.c_int
+    return _libz
+
+
+class Inflater:
+    """对 libz inflate 的最小封装, 输入从文件按块读取."""
+
+    def __init__(self, infile, window_bits):
+        self.z = libz()
+        self.infile = infile
+        self.strm = ZStream()
+        self.inbuf = ctypes.create_string_buffer(CHUNK_SIZE)
+        self.outbuf = ctypes.create_string_buffer(CHUNK_SIZE)
+        version = self.z.zlibVersion()
+        self._check(self.z.inflateInit2_(ctypes.byref(self.strm), window_bits,
+                                         version, ctypes.sizeof(ZStream)))
+        self.in_offset = infile.tell()  # 已被 inflate 消费的压缩字节在文件中的位置
+
+    def _check(self, ret):
+        if ret not in (Z_OK, Z_STREAM_END, Z_BUF_ERROR):
+            msg = self.strm.msg.decode() if self.strm.msg else ret
+            raise zlib.error(f'inflate failed: {msg}')
+        return ret
+
+    def prime(self, bits, value):
+        self._check(self.z.inflatePrime(ctypes.byref(self.strm), bits, value))
+
+    def set_dictionary(self, window):
+        if window:
+            self._check(self.z.inflateSetDictionary(ctypes.byref(self.strm),
+                                                    window, len(window)))
+
+    def reset(self, window_bits=None):
+        if window_bits is None:
+            self._check(self.z.inflateReset(ctypes.byref(self.strm)))
+        else:
+            self._check(self.z.inflateReset2(ctypes.byref(self.strm), window_bits))
+
+    def fill(self):
+        if self.strm.avail_in == 0:
+            data = self.infile.read(CHUNK_SIZE)
+            if not data:
+                return False
+            ctypes.memmove(self.inbuf, data, len(data))
+            self.strm.next_in = ctypes.addressof(self.inbuf)
+            self.strm.avail_in = len(data)
+        return True
+
+    def skip_input(self, n):
+        # 跳过 n 个压缩字节 (raw deflate 结束后的 gzip trailer)
+        while n:
+            if not self.fill():
+                return
+            step = min(n, self.strm.avail_in)
+            self.strm.next_in += step
+            self.strm.avail_in -= step
+            self.in_offset += step
+            n -= step
+
+    def inflate(self, flush=Z_NO_FLUSH):
+        """解压一步, 返回 (输出字节, 返回码); 没有更多输入时返回 (b'', None)."""
+        if not self.fill():
+            return b'', None
+        self.strm.next_out = ctypes.addressof(self.outbuf)
+        self.strm.avail_out = CHUNK_SIZE
+        avail_in = self.strm.avail_in
+        ret = self._check(self.z.inflate(ctypes.byref(self.strm), flush))
+        self.in_offset += avail_in - self.strm.avail_in
+        return self.outbuf.raw[:CHUNK_SIZE - self.strm.avail_out], ret
+
+    def has_input(self):
+        return self.fill()
+
+    def close(self):
+        self.z.inflateEnd(ctypes.byref(self.strm))
+
+
+# ---- 建索引 ----
+
+def scan_file(jsonl_file_name, span):
+    """解压一个 part 文件, 返回 (访问点列表, [(id, 偏移, 长度), ...])."""
+    points = []
+    records = []
+    window = bytearray()
+    out_offset = 0
+    last_point = 0
+    pending = bytearray()  # 还没遇到换行的半行
+    pending_offset = 0
+
+    with open(jsonl_file_name, 'rb') as infile:
+        inflater = Inflater(infile, 47)  # 自动识别 gzip/zlib 头
+        try:
+            while True:
+                data, ret = inflater.inflate(Z_BLOCK)
+                if ret is None:
+                    break
+                if data:
+                    pos = 0
+                    while (end := data.find(b'\n', pos)) >= 0:
+                        pending += data[pos:end]
+                        add_record(records, pending, pending_offset)
+                        pending_offset = out_offset + end + 1
+                        pending.clear()
+                        pos = end + 1
+                    pending += data[pos:]
+                    out_offset += len(data)
+                    window += data
+                    if len(window) > WINDOW_SIZE:
+                        del window[:-WINDOW_SIZE]
+
+                data_type = inflater.strm.data_type
+                if ret == Z_STREAM_END:
+                    # 多 member 的 gzip: 继续解析下一个 member 的头
+                    if not inflater.has_input():
+                        break
+                    inflater.reset()
+                elif data_type & 128 and not data_type & 64 and \
+                        (out_offset == 0 or out_offset - last_point >= span):
+                    points.append((out_offset, inflater.in_offset, data_type & 7,
+                                   zlib.compress(bytes(window))))
+                    last_point = out_offset
+        finally:
+            inflater.close()
+    add_record(records, pending, pending_offset)
+    return points, records
+
+
+def add_record(records, line, offset):
+    if not line.strip():
+        return
+    if match := ID_PREFIX.match(line):
+        record_id = match.group(1).decode('utf-8')
+    else:
+        record_id = top_level_values(line.decode('utf-8'), {'id'}).get('id')
+    if record_id:
+        records.append((short_id(record_id), offset, len(line)))
+
+
+def index_part(jsonl_file_name, part_db, span):
+    # 在 worker 进程里把一个文件的索引写进临时 sqlite, 主进程再合并
+    points, records = scan_file(jsonl_file_name, span)
+    db = sqlite3.connect(part_db)
+    db.execute('CREATE TABLE points (out_offset, in_offset, bits, window)')
+    db.execute('CREATE TABLE records (id, offset, length)')
+    db.executemany('INSERT INTO points VALUES (?, ?, ?, ?)', points)
+    db.executemany('INSERT INTO records VALUES (?, ?, ?)', records)
+    db.commit()
+    db.close()
+    return jsonl_file_name, part_db, len(records), len(points)
+
+
+def open_index(path):
+    os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+    db = sqlite3.connect(path)
+    db.executescript('''
+        CREATE TABLE IF NOT EXISTS files (
+            file_id INTEGER PRIMARY KEY, path TEXT UNIQUE, size INTEGER, mtime REAL);
+        CREATE TABLE IF NOT EXISTS points (
+            file_id INTEGER, out_offset INTEGER, in_offset INTEGER, bits INTEGER,
+            window BLOB, PRIMARY KEY (file_id, out_offset));
+        CREATE TABLE IF NOT EXISTS records (
+            id, file_id INTEGER, offset INTEGER, length INTEGER);
+    ''')
+    return db
+
+
+def build_index(config, entity, index_path, span):
+    db = open_index(index_path)
+    files = snapshot_files(config, entity)
+    indexed = {path: (size, mtime) for path, size, mtime in
+               db.execute('SELECT path, size, mtime FROM files')}
+
+    todo = []
+    for path in files:
+        stat = os.stat(path)
+        if indexed.get(os.path.abspath(path)) == (stat.st_size, stat.st_mtime):
+            continue
+        remove_file(db, os.path.abspath(path))
+        todo.append(path)
+    print(f'{entity}: {len(files) - len(todo)} files already indexed, {len(todo)} to index')
+
+    parts_dir = index_path + '.parts'
+    os.makedirs(parts_dir, exist_ok=True)
+    with ProcessPoolExecutor(max_workers=config['workers']) as executor:
+        futures = [executor.submit(index_part, path,
+                                   os.path.join(parts_dir, f'{i}.sqlite'), span)
+                   for i, path in enumerate(todo)]
+        for future in as_completed(futures):
+            path, part_db, n_records, n_points = future.result()
+            stat = os.stat(path)
+            file_id = db.execute('INSERT INTO files (path, size, mtime) VALUES (?, ?, ?)',
+                                 (os.path.abspath(path), stat.st_size,
+                                  stat.st_mtime)).lastrowid
+            db.execute('ATTACH DATABASE ? AS part', (part_db,))
+            db.execute('INSERT INTO points SELECT ?, * FROM part.points', (file_id,))
+            db.execute('INSERT INTO records SELECT id, ?, offset, length FROM part.records',
+                       (file_id,))
+            db.commit()
+            db.execute('DETACH DATABASE part')
+            os.remove(part_db)
+            print(f'{path}: {n_records} records, {n_points} access points')
+    os.rmdir(parts_dir)
+
+    db.execute('CREATE INDEX IF NOT EXISTS records_id ON records (id)')
+    db.commit()
+    db.close()
+
+
+def remove_file(db, path):
+    row = db.execute('SELECT file_id FROM files WHERE path = ?', (path,)).fetchone()
+    if row:
+        for table in ('points', 'records', 'files'):
+            db.execute(f'DELETE FROM {table} WHERE file_id = ?', row)
+
+
+# ---- 按偏移读取 ----
+
+class IndexedGzipFile:
+    """按解压后的偏移读取 .gz 文件, 从最近的访问点开始解压."""
+
+    def __init__(self, path, points, span):
+        self.path = path
+        self.points = points  # [(out_offset, in_offset, bits, window)], 按 out_offset 排序
+        self.span = span
+        self.infile = open(path, 'rb')
+        self.inflater = None
+        self.raw = True
+        self.position = None  # 下一个解压字节的偏移
+        self.buffer = b''
+
+    def _restore(self, offset):
+        point = max((p for p in self.points if p[0] <= offset), key=lambda p: p[0])
+        out_offset, in_offset, bits, window = point
+        if self.inflater:
+            self.inflater.close()
+        self.infile.seek(in_offset - (1 if bits else 0))
+        prime = self.infile.read(1)[0] if bits else None
+        self.inflater = Inflater(self.infile, -15)  # 访问点在 deflate 流中间, 用 raw inflate
+        if bits:
+            self.inflater.prime(bits, prime >> (8 - bits))
+        self.inflater.set_dictionary(zlib.decompress(window))
+        self.raw = True
+        self.position = out_offset
+        self.buffer = b''
+
+    def _more(self):
+        while True:
+            data, ret = self.inflater.inflate()
+            if ret == Z_STREAM_END and self.inflater.has_input():
+                # 当前 member 结束, 下一个 member 按 gzip 头解析;
+                # 从访问点开始的 raw inflate 不会读 trailer, 需要跳过 8 字节
+                if self.raw:
+                    self.inflater.skip_input(8)
+                    self.inflater.reset(47)
+                    self.raw = False
+                else:
+                    self.inflater.reset()
+            if data or ret is None:
+                return data
+
+    def read(self, offset, length):
+        # 目标在当前位置之后且不远时继续解压, 否则回到最近的访问点
+        if self.position is None or not \
+                self.position <= offset <= self.position + len(self.buffer) + self.span:
+            self._restore(offset)
+        while self.position + len(self.buffer) < offset + length:
+            if self.position + len(self.buffer) <= offset:
+                self.position += len(self.buffer)
+                self.buffer = b''
+            data = self._more()
+            if not data:
+                break
+            self.buffer += data
+        start = offset - self.position
+        self.position = offset
+        self.buffer = self.buffer[start:]
+        return self.buffer[:length]
+
+    def close(self):
+        if self.inflater:
+            self.inflater.close()
+        self.infile.close()
+
+
+def lookup(db, ids):
+    """返回 {file_id: [(offset, length, id), ...]}, 每个文件内按偏移排序."""
+    found = {}
+    for record_id in ids:
+        for file_id, offset, length in db.execute(
+                'SELECT file_id, offset, length FROM records WHERE id = ?',
+                (short_id(record_id),)):
+            found.setdefault(file_id, []).append((offset, length, record_id))
+    for locations in found.values():
+        locations.sort()
+    return found
+
+
+def read_records(db, ids, span):
+    """按 (文件路径, 记录) 顺序生成 (path, line)."""
+    found = lookup(db, ids)
+    paths = dict(db.execute('SELECT file_id, path FROM files'))
+    for file_id in sorted(found, key=lambda f: paths[f]):
+        points = db.execute('SELECT out_offset, in_offset, bits, window FROM points '
+                            'WHERE file_id = ? ORDER BY out_offset', (file_id,)).fetchall()
+        indexed = IndexedGzipFile(paths[file_id], points, span)
+        try:
+            for offset, length, _ in found[file_id]:
+                yield paths[file_id], indexed.read(offset, length)
+        finally:
+            indexed.close()
+
+
+def extract(db, ids, snapshot_dir, out_dir, span, compresslevel):
+    # 按快照的相对路径写出, 结果可以直接作为 --snapshot-dir
+    outfiles = {}
+    try:
+        for path, line in read_records(db, ids, span):
+            if path not in outfiles:
+                out_path = os.path.join(out_dir, os.path.relpath(path, os.path.abspath(snapshot_dir)))
+                os.makedirs(os.path.dirname(out_path), exist_ok=True)
+                outfiles[path] = gzip.open(out_path, 'wb', compresslevel=compresslevel)
+            outfiles[path].write(line + b'\n')
+    finally:
+        for outfile in outfiles.values():
+            outfile.close()
+    return len(outfiles)
+
+
+def read_ids(ids, ids_file):
+    ids = list(ids)
+    if ids_file:
+        with open(ids_file, encoding='utf-8') as f:
+            ids += [line.strip() for line in f if line.strip()]
+    return ids
+
+
+if __name__ == '__main__':
+    parser = build_parser('Random-access index from OpenAlex id to snapshot records.')
+    parser.add_argument('command', choices=['build', 'get', 'extract'])
+    parser.add_argument('entity')
+    parser.add_argument('ids', nargs='*', help='ids to get or extract')
+    parser.add_argument('--ids-file', help='file with one id per line')
+    parser.add_argument('--index-dir', default='openalex-index',
+                        help='directory of the <entity>.sqlite index files')
+    parser.add_argument('--span', type=float, default=1,
+                        help='MB of decompressed data between access points (default: 1)')
+    parser.add_argument('--out', default='openalex-subset',
+                        help='output snapshot root for extract')
+    config = load_config(parser=parser)
+    args = config['args']
+    index_path = os.path.join(args.index_dir, f'{args.entity}.sqlite')
+    span = int(args.span * 1024 * 1024)
+
+    start = time.time()
+    if args.command == 'build':
+        build_index(config, args.entity, index_path, span)
+    else:
+        if not os.path.exists(index_path):
+            sys.exit(f'no index at {index_path}, run: python gzip_index.py build {args.entity}')
+        db = sqlite3.connect(index_path)
+        ids = read_ids(args.ids, args.ids_file)
+        if args.command == 'get':
+            for _, line in read_records(db, ids, span):
+                sys.stdout.buffer.write(line + b'\n')
+        else:
+            n = extract(db, ids, config['snapshot_dir'], args.out, span,
+                        config['compresslevel'])
+            print(f'{len(ids)} ids extracted into {n} files under {args.out}')
+    print(f"Time taken: {time.time() - start:.3f} seconds.", file=sys.stderr)
@@ -0,0 +1,231 @@
+import csv
+import heapq
+import os
+import re
+from array import array
+from bisect import bisect_left
+
+from gz_members import rows_to_member
+from object_store import find_files, open_part
+from openalex_config import build_parser, load_config
+from openalex_tables import build_csv_files, long_id, short_id
+from row_filter import top_level_values
+from shard_manifest import ShardFile, table_name
+
+# 快照里的 merged_ids/<entity>/*.csv.gz (merge_date, id, merge_into_id) 列出被合并掉的 id.
+# --merged-ids 时:
+#   展开过程中丢弃这些 id 的记录 (只看行首的 id, 不做 json.loads)
+#   写出 merged_<entity>.csv.gz (id, merge_into_id) 和 delete-merged-<entity>.sql, 后者把列表
+#   \copy 进临时表, 然后
+#     对该实体自己的表 (<entity> / <entity>_*, 以该实体 id 为第一列) 执行 DELETE ... USING
+#     对 openalex-pg-schema.sql 里其他引用该实体的列 (REFERENCE_COLUMNS, 例如
+#     works_referenced_works.referenced_work_id, works_authorships.author_id) 执行
+#     UPDATE ... FROM 改成 merge_into_id; 没有 merge_into_id 时, 实体表 (第一列是 id,
+#     例如 authors.last_known_institution) 里置为 NULL, 其他表删除该行
+#
+# 增量导入时在所有导入脚本之后执行 delete-merged-<entity>.sql, 新导入的行里
+# 指向被合并 id 的引用也会一起改掉, 不需要整库重建.
+# 只有删除列表时 (不重新展开) 可以单独运行:
+#   python merged_ids.py --entities works authors
+
+ID_PREFIX = re.compile(rb'^\s*\{\s*"id"\s*:\s*"([^"\\]*)"')
+COLUMNS = ['id', 'merge_into_id']
+BATCH_ROWS = 50000
+NO_TARGET = -1  # merge_into_id 为空
+
+SCHEMA_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'openalex-pg-schema.sql')
+CREATE_TABLE = re.compile(r'^CREATE TABLE (\w+)\.(\w+) \((.*?)\);', re.MULTILINE | re.DOTALL)
+
+# 引用其他实体 id 的列名 -> 被引用的实体
+REFERENCE_COLUMNS = {
+    'work_id': 'works',
+    'referenced_work_id': 'works',
+    'related_work_id': 'works',
+    'author_id': 'authors',
+    'coauthor_id': 'authors',
+    'institution_id': 'institutions',
+    'associated_institution_id': 'institutions',
+    'last_known_institution': 'institutions',
+    'concept_id': 'concepts',
+    'ancestor_id': 'concepts',
+    'related_concept_id': 'concepts',
+    'source_id': 'sources',
+    'publisher_id': 'publishers',
+    'parent_publisher': 'publishers',
+    'topic_id': 'topics',
+}
+
+
+def merged_files(snapshot_dir, entity):
+    return find_files(snapshot_dir, f'merged_ids/{entity}/*.csv.gz')
+
+
+def read_merged(path):
+    # (id, merge_into_id) 只取数字部分, 不是 <字母><数字> 形式的 id 忽略
+    with open_part(path, 'rt', encoding='utf-8', newline='') as f:
+        for row in csv.DictReader(f):
+            value = short_id(row.get('id'))
+            if isinstance(value, int):
+                target = short_id(row.get('merge_into_id'))
+                yield value, target if isinstance(target, int) else NO_TARGET
+
+
+class MergedIds:
+    """一个实体被合并掉的 id: 排好序的 8 字节整数数组, 二分查找; targets 是对应的 merge_into_id."""
+
+    def __init__(self, entity, ids=(), targets=()):
+        self.entity = entity
+        self.ids = array('q', ids)
+        self.targets = array('q', targets)
+
+    @classmethod
+    def from_snapshot(cls, snapshot_dir, entity):
+        # 每个文件读成一个排好序的 (id, merge_into_id) 数组对, 再归并去重 (同一 id 保留第一个);
+        # 归并时所有文件的数组同时在内存里, 每个 id 16 字节, 比 Python 的 list/set 小得多
+        runs = []
+        for path in merged_files(snapshot_dir, entity):
+            pairs = sorted(read_merged(path))
+            runs.append((array('q', (value for value, _ in pairs)), array('q', (target for _, target in pairs))))
+        merged = cls(entity)
+        previous = None
+        for value, target in heapq.merge(*(zip(ids, targets) for ids, targets in runs)):
+            if value != previous:
+                merged.ids.append(value)
+                merged.targets.append(target)
+                previous = value
+        return merged
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, openalex_id):
+        value = short_id(openalex_id)
+        if not isinstance(value, int):
+            return False
+        i = bisect_left(self.ids, value)
+        return i < len(self.ids) and self.ids[i] == value
+
+    def __iter__(self):
+        # (id, merge_into_id), 没有 merge_into_id 时为 NO_TARGET
+        return zip(self.ids, self.targets)
+
+
+class MergedFilter:
+    """与 --where 过滤器组合, 接口相同: line -> 是否保留."""
+
+    def __init__(self, merged, row_filter=None):
+        self.merged = merged
+        self.row_filter = row_filter
+
+    def __call__(self, line):
+        raw = line.encode('utf-8') if isinstance(line, str) else line
+        if match := ID_PREFIX.match(raw):
+            record_id = match.group(1).decode('utf-8')
+        else:
+            record_id = top_level_values(raw.decode('utf-8'), {'id'}).get('id')
+        if record_id in self.merged:
+            return False
+        return self.row_filter is None or self.row_filter(line)
+
+
+def entity_filter(config, entity, row_filter=None):
+    """--merged-ids 时返回去掉合并 id 的过滤器 (没有 merged_ids 文件时原样返回)."""
+    if not config['merged_ids']:
+        return row_filter
+    merged = MergedIds.from_snapshot(config['snapshot_dir'], entity)
+    print(f'{entity}: {len(merged)} merged id(s)')
+    return MergedFilter(merged, row_filter) if len(merged) else row_filter
+
+
+def schema_tables(path=SCHEMA_PATH):
+    """openalex-pg-schema.sql 里的 {表名: [列名]}."""
+    with open(path, encoding='utf-8') as f:
+        text = f.read()
+    tables = {}
+    for _, table, body in CREATE_TABLE.findall(text):
+        body = re.sub(r'--[^\n]*', '', body)
+        # 按不在括号里的逗号切分 (numeric(10, 2) 这样的类型不切)
+        tables[table] = [part.split()[0] for part in re.split(r',(?![^()]*\))', body) if part.strip()]
+    return tables
+
+
+def own_tables(entity, file_spec, tables):
+    """该实体自己的 {表: 第一列}: file_spec 里的表, 加上 schema 里 <entity>_* 且第一列是该实体 id 的表."""
+    own = {table_name(spec['name']): spec['columns'][0] for spec in file_spec.values()}
+    for table, columns in tables.items():
+        if (table == entity or table.startswith(f'{entity}_')) and columns and \
+                (columns[0] == 'id' or REFERENCE_COLUMNS.get(columns[0]) == entity):
+            own.setdefault(table, columns[0])
+    return own
+
+
+def references(entity, own, tables):
+    """引用 entity 的 [(表, 列)], 不含该实体自己的表的第一列."""
+    return [(table, column)
+            for table, columns in tables.items()
+            for column in columns
+            if REFERENCE_COLUMNS.get(column) == entity and own.get(table) != column]
+
+
+def delete_script(ids_path, file_spec, entity, schema='openalex', tables=None):
+    tables = tables if tables is not None else schema_tables()
+    # 多个实体的脚本可以在同一个 psql 会话里依次执行
+    lines = [
+        'DROP TABLE IF EXISTS pg_temp.merged_ids;',
+        'CREATE TEMP TABLE merged_ids (id text PRIMARY KEY, merge_into_id text);',
+        f"\\copy merged_ids (id, merge_into_id) from program 'gzip -d -c {ids_path}' csv header",
+    ]
+    own = own_tables(entity, file_spec, tables)
+    for table, column in own.items():
+        lines.append(f"DELETE FROM {schema}.{table} t USING merged_ids m WHERE t.{column} = m.id;")
+    # 其他表里的引用改成合并后的 id; 没有合并目标时实体表里置空, 链接表里删除该行
+    for table, column in references(entity, own, tables):
+        lines.append(f"UPDATE {schema}.{table} t SET {column} = m.merge_into_id FROM merged_ids m "
+                     f"WHERE t.{column} = m.id AND m.merge_into_id IS NOT NULL;")
+        if tables[table][0] == 'id':
+            lines.append(f"UPDATE {schema}.{table} t SET {column} = NULL FROM merged_ids m WHERE t.{column} = m.id;")
+        else:
+            lines.append(f"DELETE FROM {schema}.{table} t USING merged_ids m WHERE t.{column} = m.id;")
+    return '\n'.join(lines) + '\n'
+
+
+def write_deletes(merged, file_spec, csv_dir, compresslevel=9):
+    """写出删除列表和 delete-merged-<entity>.sql, 返回两个路径."""
+    ids_path = os.path.join(csv_dir, f'merged_{merged.entity}.csv.gz')
+    outfile = ShardFile(ids_path, COLUMNS, compresslevel)
+    batch = []
+    for value, target in merged:
+        batch.append({'id': long_id(merged.entity, value),
+                      'merge_into_id': long_id(merged.entity, target) if target != NO_TARGET else None})
+        if len(batch) >= BATCH_ROWS:
+            outfile.write(rows_to_member(batch, COLUMNS, compresslevel), len(batch))
+            batch = []
+    if batch:
+        outfile.write(rows_to_member(batch, COLUMNS, compresslevel), len(batch))
+    outfile.close()
+    script_path = os.path.join(csv_dir, f'delete-merged-{merged.entity}.sql')
+    with open(script_path, 'w', encoding='utf-8') as f:
+        f.write(delete_script(ids_path, file_spec, merged.entity))
+    return ids_path, script_path
+
+
+def write_entity_deletes(config, entity, file_spec, row_filter):
+    # 展开脚本结束时调用: 复用过滤器里已经加载的 id, 没有则重新读取
+    merged = row_filter.merged if isinstance(row_filter, MergedFilter) else \
+        MergedIds.from_snapshot(config['snapshot_dir'], entity)
+    return write_deletes(merged, file_spec, config['csv_dir'], config['compresslevel'])
+
+
+if __name__ == '__main__':
+    parser = build_parser('Write delete lists and DELETE ... USING scripts for merged OpenAlex ids.')
+    parser.add_argument('--entities', nargs='+', default=['works', 'authors'],
+                        choices=['authors', 'topics', 'concepts', 'institutions',
+                                 'publishers', 'sources', 'works'])
+    config = load_config(parser=parser)
+    os.makedirs(config['csv_dir'], exist_ok=True)
+    csv_files = build_csv_files(config['csv_dir'], config['normalize_authorships'], config['abstracts'])
+    for entity in config['args'].entities:
+        merged = MergedIds.from_snapshot(config['snapshot_dir'], entity)
+        ids_path, script_path = write_deletes(merged, csv_files[entity], config['csv_dir'],
+                                              config['compresslevel'])
+        print(f'{entity}: {len(merged)} merged id(s) -> {ids_path}, {script_path}')
@@ -0,0 +1,214 @@
+import argparse
+import glob
+import gzip
+import hashlib
+import json
+import os
+import re
+import shutil
+import sys
+
+from object_store import client, find_files, is_remote, split_url, stat
+from shard_manifest import generate_load_scripts, merge_manifests, read_manifest, write_manifest
+
+# 多机展开 (--node-index i --node-count N), 不需要协调服务:
+#   每个节点列出同一个快照的 part 文件, 用同样的确定性算法分配:
+#   按大小从大到小 (大小相同按路径), 每个文件分给当前总字节数最小的节点 (相同时取编号小的).
+#   各节点的文件互不重叠, 合起来正好是全部文件, 字节数接近均衡.
+#   大小取快照自带的 data/<entity>/manifest 里的 content_length, 没有时逐个 stat.
+#
+#   每个节点把输出和 manifest-*.json 写到 <csv_dir>/node-<i>/. 所有节点完成后
+#   (不在同一个共享目录时先把各节点的 node-<i>/ 复制到一起):
+#     python multi_node.py merge csv-files --node-count 4 --jobs 8
+#   检查每个节点的 manifest 都在、分片文件都存在, 合并成 <csv_dir>/manifest-*.json 和 load-*.sql.
+#   --merged-ids 的删除列表每个节点都一样 (来自完整的 merged_ids/), 合并时确认一致后只保留一份:
+#   <csv_dir>/merged_<entity>.csv.gz 和 delete-merged-<entity>.sql; *-schema.sql 同样复制一份.
+#   只有写 manifest 的脚本 (processpool_test.py, multiprocess_*.py) 支持分节点.
+#   查看分配结果: python multi_node.py plan openalex-snapshot works --node-count 4
+#   在一台机器上测试时, 同时启动 N 个进程, 各自使用不同的 --node-index 即可.
+
+# 各节点只看到部分记录: 聚合/引用图不完整, 字典编码的编码各节点不同, 排序只在节点内有效,
+# 变化检测会把其他节点的文件当成已删除
+CONFLICTS = ('aggregates', 'citation_graph', 'dictionary_encode', 'sort_output', 'change_store')
+
+
+def node_dir(csv_dir, index):
+    return os.path.join(csv_dir, f'node-{index:03d}')
+
+
+def check_options(config, multi_node_output=False):
+    if not multi_node_output:
+        raise ValueError('--node-count is only supported by processpool_test.py, multiprocess_works_add.py and '
+                         'multiprocess_authors.py, which write the manifests that multi_node.py merges')
+    index, count = config['node_index'], config['node_count']
+    if not 0 <= index < count:
+        raise ValueError(f'--node-index must be between 0 and {count - 1}, got {index}')
+    conflicts = [key for key in CONFLICTS if config[key]]
+    if conflicts:
+        raise ValueError(f"--node-count cannot be combined with "
+                         f"{', '.join('--' + key.replace('_', '-') for key in conflicts)}")
+
+
+def snapshot_sizes(snapshot_dir, entity):
+    """快照 manifest 里记录的 {相对路径: 字节数}, 例如 data/works/updated_date=.../part_000.gz."""
+    path = f"{snapshot_dir.rstrip('/')}/data/{entity}/manifest"
+    try:
+        if is_remote(path):
+            s3 = client()
+            bucket, key = split_url(path)
+            size, _ = s3.head(bucket, key)
+            manifest = json.loads(s3.get_range(bucket, key, 0, size - 1))
+        else:
+            with open(path, encoding='utf-8') as f:
+                manifest = json.load(f)
+    except (OSError, ValueError):
+        return {}
+    sizes = {}
+    for entry in manifest.get('entries', []):
+        url = entry.get('url', '')
+        length = (entry.get('meta') or {}).get('content_length')
+        if '/data/' in url and length is not None:
+            sizes['data/' + url.split('/data/', 1)[1]] = int(length)
+    return sizes
+
+
+def file_sizes(snapshot_dir, entity, files):
+    sizes = snapshot_sizes(snapshot_dir, entity)
+    prefix = len(snapshot_dir.rstrip('/')) + 1
+    return [sizes[path[prefix:]] if path[prefix:] in sizes else stat(path)[0] for path in files]
+
+
+def assign(files, sizes, node_count):
+    """把文件分成 node_count 组, 每组 [(路径, 字节数)], 组内按路径排序."""
+    nodes = [[0, i, []] for i in range(node_count)]
+    for size, path in sorted(zip(sizes, files), key=lambda item: (-item[0], item[1])):
+        node = min(nodes, key=lambda n: (n[0], n[1]))
+        node[0] += size
+        node[2].append((path, size))
+    return [sorted(files) for _, _, files in nodes]
+
+
+def node_files(config, entity, files):
+    """本节点负责的文件 (不分节点时原样返回)."""
+    if config['node_count'] <= 1:
+        return files
+    assigned = assign(files, file_sizes(config['snapshot_dir'], entity, files), config['node_count'])
+    return [path for path, _ in assigned[config['node_index']]]
+
+
+def rebase(path, index, csv_dir):
+    # 节点上写的路径 .../node-002/works_locations.csv.gz 换成合并目录下的路径
+    marker = f'node-{index:03d}/'
+    rest = path.replace(os.sep, '/').split(marker, 1)[-1]
+    return os.path.join(node_dir(csv_dir, index), *rest.split('/'))
+
+
+def merge(csv_dir, node_count, jobs=1, schema='openalex'):
+    """合并各节点的 manifest, 返回写出的 manifest 路径列表."""
+    extra = [path for path in glob.glob(os.path.join(csv_dir, 'node-*'))
+             if int(os.path.basename(path)[len('node-'):]) >= node_count]
+    if extra:
+        raise ValueError(f'{", ".join(sorted(extra))} not covered by --node-count {node_count}')
+    names = sorted({os.path.basename(path) for path in glob.glob(os.path.join(csv_dir, 'node-*', 'manifest-*.json'))})
+    if not names:
+        raise ValueError(f'no node manifests under {csv_dir}')
+
+    written = []
+    for name in names:
+        manifests = []
+        for index in range(node_count):
+            path = os.path.join(node_dir(csv_dir, index), name)
+            if not os.path.exists(path):
+                raise ValueError(f'{path} is missing, node {index} has not finished')
+            manifest = read_manifest(path)
+            for table_entry in manifest['tables'].values():
+                for entry in table_entry['shards']:
+                    entry['path'] = rebase(entry['path'], index, csv_dir)
+                    if not os.path.exists(entry['path']):
+                        raise ValueError(f"{entry['path']} listed in {path} does not exist")
+            manifests.append(manifest)
+        merged = merge_manifests(manifests)
+        out_path = os.path.join(csv_dir, name)
+        write_manifest(merged, out_path)
+        # manifest-works.json -> load-works.sql
+        load_path = os.path.join(csv_dir, os.path.splitext(name.replace('manifest', 'load', 1))[0] + '.sql')
+        generate_load_scripts(merged, load_path, jobs, schema)
+        written.append(out_path)
+    return written + merge_node_files(csv_dir, node_count)
+
+
+def content_digest(path):
+    # .gz 比较解压后的内容 (gzip 头里有写入时间)
+    digest = hashlib.sha256()
+    with (gzip.open if path.endswith('.gz') else open)(path, 'rb') as f:
+        while block := f.read(1024 * 1024):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def same_on_every_node(csv_dir, node_count, name):
+    """各节点的同名文件都存在且内容相同时返回 node-000 的路径."""
+    paths = [os.path.join(node_dir(csv_dir, index), name) for index in range(node_count)]
+    missing = [path for path in paths if not os.path.exists(path)]
+    if missing:
+        raise ValueError(f'{missing[0]} is missing, node {paths.index(missing[0])} has not finished')
+    if len({content_digest(path) for path in paths}) > 1:
+        raise ValueError(f'{name} differs between nodes; were they run with the same options?')
+    return paths[0]
+
+
+def merge_node_files(csv_dir, node_count):
+    # 删除列表和 schema 文件每个节点都一样, 只在合并目录里保留一份
+    written = []
+    first = node_dir(csv_dir, 0)
+    for script in sorted(glob.glob(os.path.join(first, 'delete-merged-*.sql'))):
+        entity = os.path.basename(script)[len('delete-merged-'):-len('.sql')]
+        ids_name = f'merged_{entity}.csv.gz'
+        ids_path = os.path.join(csv_dir, ids_name)
+        shutil.copyfile(same_on_every_node(csv_dir, node_count, ids_name), ids_path)
+        # 脚本里的路径各节点不同, 只用 node-000 的
+        with open(script, encoding='utf-8') as f:
+            text = f.read()
+        # \copy 的路径换成合并目录里的那一份
+        text = re.sub(r"(from program 'gzip -d -c )[^']*(')", lambda m: m.group(1) + ids_path + m.group(2), text)
+        out_path = os.path.join(csv_dir, os.path.basename(script))
+        with open(out_path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        written += [ids_path, out_path]
+    for schema_file in sorted(glob.glob(os.path.join(first, '*-schema.sql'))):
+        out_path = os.path.join(csv_dir, os.path.basename(schema_file))
+        shutil.copyfile(same_on_every_node(csv_dir, node_count, os.path.basename(schema_file)), out_path)
+        written.append(out_path)
+    return written
+
+
+def print_plan(snapshot_dir, entity, node_count):
+    files = find_files(snapshot_dir, f'data/{entity}/*/*.gz')
+    for index, assigned in enumerate(assign(files, file_sizes(snapshot_dir, entity, files), node_count)):
+        print(f'node {index}: {len(assigned)} files, {sum(size for _, size in assigned) / 1e9:.2f} GB')
+        for path, size in assigned:
+            print(f'  {path} {size}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Plan or merge a flatten run split across several nodes.')
+    commands = parser.add_subparsers(dest='command', required=True)
+    plan_parser = commands.add_parser('plan', help='show which part files each node flattens')
+    plan_parser.add_argument('snapshot_dir')
+    plan_parser.add_argument('entity')
+    plan_parser.add_argument('--node-count', type=int, required=True)
+    merge_parser = commands.add_parser('merge', help='merge the node manifests into one load plan')
+    merge_parser.add_argument('csv_dir')
+    merge_parser.add_argument('--node-count', type=int, required=True)
+    merge_parser.add_argument('--jobs', type=int, default=1)
+    merge_parser.add_argument('--schema', default='openalex')
+    args = parser.parse_args()
+
+    if args.command == 'plan':
+        print_plan(args.snapshot_dir, args.entity, args.node_count)
+    else:
+        try:
+            for path in merge(args.csv_dir, args.node_count, args.jobs, args.schema):
+                print(path)
+        except ValueError as e:
+            sys.exit(str(e))
@@ -1,84 +1,84 @@
-import csv
 import gzip
 import json
 import os
 import time
 from multiprocessing import Process, Queue
 from itertools import islice
-import glob
 
-# 全局路径配置
-SNAPSHOT_DIR = 'D:/postgreSQL_project/test_prj/inputfile'
-CSV_DIR = 'D:/postgreSQL_project/test_prj/output'
+import autotune
+import merged_ids
+import progress
+from gz_members import rows_to_member
+from object_store import open_part, stat
+from openalex_config import load_config, snapshot_files
+from openalex_tables import build_csv_files
+from row_filter import compile_filter
+from shard_manifest import (ShardFile, add_shard, generate_load_scripts,
+                            new_manifest, table_name, write_manifest)
+from shm_ring import ShmRing, flush_queues, put_chunk, get_chunk, iter_lines, release_chunk, ring_bytes
+
+# 全局路径配置 (命令行 / 环境变量 / 配置文件, 见 openalex_config.py)
+config = load_config(description='Flatten OpenAlex authors with reader/filter/writer processes.',
+                     defaults={'readers': 1, 'parsers': 2, 'chunk_size': 50, 'queue_size': 500000},
+                     multi_node_output=True)
+SNAPSHOT_DIR = config['snapshot_dir']
+CSV_DIR = config['csv_dir']
+COMPRESSLEVEL = config['compresslevel']
+ROW_FILTER = merged_ids.entity_filter(config, 'authors', compile_filter(config['where']))
 
 # CSV 文件配置
-csv_files = {
-    'authors': {
-        'authors': {
-            'name': os.path.join(CSV_DIR, 'authors.csv.gz'),
-            'columns': [
-                'id', 'orcid', 'display_name', 'display_name_alternatives',
-                'works_count', 'cited_by_count',
-                'last_known_institution', 'works_api_url', 'updated_date',
-            ]
-        },
-        'ids': {
-            'name': os.path.join(CSV_DIR, 'authors_ids.csv.gz'),
-            'columns': [
-                'author_id', 'openalex', 'orcid', 'scopus', 'twitter',
-                'wikipedia', 'mag'
-            ]
-        },
-        'counts_by_year': {
-            'name': os.path.join(CSV_DIR, 'authors_counts_by_year.csv.gz'),
-            'columns': [
-                'author_id', 'year', 'works_count', 'cited_by_count',
-                'oa_works_count'
-            ]
-        }
-    }
-}
+csv_files = build_csv_files(CSV_DIR)
 
 file_spec = csv_files['authors']
 
-def reader(file_paths, data_queues, coordinator_queue, chunk_size):
+def reader(file_paths, data_queues, rings, reader_index, coordinator_queue, chunk_size, counters, stages):
     print("Reader Started.")
     queue_index = 0  # 用于轮询分发数据
 
-    for file_path in file_paths:
+    # 从共享计数器领取下一个文件, --autotune 调整 reader 个数时不需要重新划分文件
+    while (file_index := stages.claim_file(reader_index, len(file_paths))) is not None:
+        file_path = file_paths[file_index]
         print(f"Reading file: {file_path}")
-        with gzip.open(file_path, "rt", encoding='utf-8', newline='') as infile:
+        with open_part(file_path, "rb") as infile:
             while True:
-                data_chunk = list(islice(infile, chunk_size))
+                started = time.perf_counter()
+                data_chunk = b''.join(islice(infile, chunk_size))
+                stages.add_busy(0, time.perf_counter() - started)
                 if not data_chunk:
                     break  # 当前文件读取完成，继续读取下一个文件
 
-                # 将数据块分发到对应的 data_queue
-                data_queues[queue_index].put(data_chunk)
+                # 写入 (reader, filter) 对应的共享内存 ring, 队列里只传偏移量
+                queue_index %= stages.filters()
+                put_chunk(rings[queue_index], reader_index, data_queues[queue_index], data_chunk)
 
-                # 更新 queue_index，轮询分发数据
-                queue_index = (queue_index + 1) % len(data_queues)
+                # 更新 queue_index，轮询分发数据 (只分给活动的 filter)
+                queue_index += 1
+        counters.add('files')
+        counters.add('bytes', stat(file_path)[0])
 
-    # 所有文件读取完成，向所有 data_queue 发送 DONE 信号
-    for data_queue in data_queues:
-        data_queue.put('DONE')
+    # 所有文件读取完成，由 coordinator 在所有 reader 结束后向 data_queue 发送 DONE
+    flush_queues(data_queues)
     coordinator_queue.put('READ_DONE')
 
 
-def filter(data_queue, authors_queue, authors_ids_queue, counts_queue, coordinator_queue):
+def filter(data_queue, rings, authors_queue, authors_ids_queue, counts_queue, coordinator_queue, counters, stages):
     print("filter Started.")
     while True:
-        data_chunk = data_queue.get()
-        if data_chunk == 'DONE':
+        message = data_queue.get()
+        if message == 'DONE':
             coordinator_queue.put('FILTER_DONE')
             break
+        started = time.perf_counter()
+        data_chunk = get_chunk(rings, message)  # 共享内存上的 memoryview, 不复制
         # 处理数据
         authors = []
         authors_ids = []
         counts = []
-        for line in data_chunk:
+        for line in iter_lines(data_chunk):
             if not line.strip():
                 continue
+            if ROW_FILTER and not ROW_FILTER(line):
+                continue
             author = json.loads(line)
             if not (author_id := author.get('id')):
                 continue
@@ -92,35 +92,45 @@ def filter(data_queue, authors_queue, authors_ids_queue, counts_queue, coordinat
                 for count_by_year in counts_by_year:
                     count_by_year['author_id'] = author_id
                     counts.append(count_by_year)
-        authors_queue.put(authors)
-        authors_ids_queue.put(authors_ids)
-        counts_queue.put(counts)
-
-
-def write_to_gz(queue, file_path, columns, coordinator_queue):
+        release_chunk(rings, message)  # 解析完再释放, reader 才能覆盖这块共享内存
+        counters.add('records', len(authors))
+        # 在 filter 里完成 CSV 格式化和压缩, writer 只负责写文件
+        if authors:
+            authors_queue.put((len(authors), rows_to_member(authors, file_spec['authors']['columns'], COMPRESSLEVEL)))
+        if authors_ids:
+            authors_ids_queue.put((len(authors_ids), rows_to_member(authors_ids, file_spec['ids']['columns'], COMPRESSLEVEL)))
+        if counts:
+            counts_queue.put((len(counts), rows_to_member(counts, file_spec['counts_by_year']['columns'], COMPRESSLEVEL)))
+        stages.add_busy(1, time.perf_counter() - started)
+
+
+def write_to_gz(queue, file_path, columns, coordinator_queue, counters):
     print(f"Writer Started for {file_path}.")
-    with gzip.open(file_path, 'wt', encoding='utf-8', newline="") as outfile:
-        writer = csv.DictWriter(outfile, fieldnames=columns, extrasaction='ignore', lineterminator='\n')
-        writer.writeheader()  # 写入表头
-
-        while True:
-            data = queue.get()
-            if data == 'DONE':
-                coordinator_queue.put('WRITE_DONE')
-                break
-            writer.writerows(data)  # 写入数据
+    table = table_name(file_path)
+    outfile = ShardFile(file_path, columns, COMPRESSLEVEL)  # 写入表头
+
+    while True:
+        data = queue.get()
+        if data == 'DONE':
+            # 把该表的行数/字节数/校验和交给 coordinator 写入 manifest
+            coordinator_queue.put(('WRITE_DONE', table, columns, outfile.close()))
+            break
+        rows, member = data
+        outfile.write(member, rows)  # filter 已经格式化并压缩好, 这里只做 I/O
+        counters.add(f'rows:{table}', rows)
 
-def coordinator(coordinator_queue, authors_queue, authors_ids_queue, counts_queue):
+def coordinator(coordinator_queue, data_queues, authors_queue, authors_ids_queue, counts_queue, active_readers, active_filters):
     print("Coordinator Started.")
-    active_readers = 1  # 只有一个 reader 进程
-    active_filters = 2  # 有两个 filter 进程
-    active_writers = 3  # 有三个 writer 进程
+    manifest = new_manifest()
+    active_writers = 3  # 每个表一个 writer 进程
 
     while True:
         queue_message = coordinator_queue.get()
         if queue_message == 'READ_DONE':
             active_readers -= 1
             if active_readers == 0:
+                for data_queue in data_queues:
+                    data_queue.put('DONE')
                 print("reader done")
         elif queue_message == 'FILTER_DONE':
             active_filters -= 1
@@ -132,56 +142,77 @@ def coordinator(coordinator_queue, authors_queue, authors_ids_queue, counts_queu
                 authors_ids_queue.put('DONE')
                 counts_queue.put('DONE')
                 print("All filters done.")
-        elif queue_message == 'WRITE_DONE':
+        elif queue_message[0] == 'WRITE_DONE':
+            add_shard(manifest, *queue_message[1:])
             active_writers -= 1
             print(f"Writer done. Active writers: {active_writers}")
             if active_writers == 0:
                 print("All writers done.")
                 break
 
-    with open('D:/postgreSQL_project/test_prj/output/log.json', 'w', encoding="utf-8") as f:
+    write_manifest(manifest, os.path.join(CSV_DIR, 'manifest-authors.json'))
+    generate_load_scripts(manifest, os.path.join(CSV_DIR, 'load-authors.sql'))
+    if config['merged_ids']:
+        merged_ids.write_entity_deletes(config, 'authors', file_spec, ROW_FILTER)
+
+    with open(config['log_path'], 'w', encoding="utf-8") as f:
         for queue in [authors_queue, authors_ids_queue, counts_queue]:
             while not queue.empty():
-                content = queue.get()
-                for i in content:
-                    f.write(json.dumps(i, ensure_ascii=False) + '\n')
+                rows, content = queue.get()
+                f.write(json.dumps(gzip.decompress(content).decode('utf-8'), ensure_ascii=False) + '\n')
                     # print(i)
             
 
 if __name__ == '__main__':
-    # 创建多个 data_queue
-    data_queue_1 = Queue(500000)
-    data_queue_2 = Queue(500000)
-    data_queues = [data_queue_1, data_queue_2]  # 将 data_queue 放入列表中
+    os.makedirs(CSV_DIR, exist_ok=True)
+    input_files = snapshot_files(config, 'authors')
+    # --autotune 时按上限创建进程, 开始只启用 --readers / --parsers 个, 见 autotune.py
+    num_readers, num_filters = autotune.limits(config, len(input_files))
+    stages = autotune.StageState(min(config['readers'], num_readers), config['parsers'])
+
+    # 每个 filter 一个 data_queue
+    data_queues = [Queue(config['queue_size']) for _ in range(num_filters)]
+    # 每个 (reader, filter) 组合一个共享内存 ring, 保证单生产者单消费者
+    # --autotune 时 ring 个数是上限的乘积, 合计大小受 --ring-memory 限制
+    ring_size = ring_bytes(config['ring_size'], config['ring_memory'], num_readers * num_filters)
+    rings = [[ShmRing(ring_size) for _ in data_queues] for _ in range(num_readers)]
 
     # 创建其他队列
-    authors_queue = Queue(500000)
-    authors_ids_queue = Queue(500000)
-    counts_queue = Queue(500000)
+    authors_queue = Queue(config['queue_size'])
+    authors_ids_queue = Queue(config['queue_size'])
+    counts_queue = Queue(config['queue_size'])
 
     # 创建 coordinator_queue
     coordinator_queue = Queue()
-    # input_files = glob.glob(os.path.join(SNAPSHOT_DIR, 'data', 'authors', '*', '*.gz'))
-    input_files = glob.glob(os.path.join(SNAPSHOT_DIR, '*', '*.gz'))
-    # 创建 reader 进程
-    readers = Process(target=reader, args=(input_files, data_queues, coordinator_queue, 50))
+
+    # 进度计数器在共享内存里, 作为参数传给各个进程
+    counters = progress.Counters([table_name(spec['name']) for spec in file_spec.values()])
+    reporter = progress.Reporter(counters, 'authors', len(input_files),
+                                 sum(stat(path)[0] for path in input_files),
+                                 config['progress_interval'], config['metrics_port'])
+    # 创建 reader 进程, 从 input_files 里依次领取文件
+    readers = [
+        Process(target=reader, args=(input_files, data_queues, rings[i], i, coordinator_queue, config['chunk_size'], counters, stages))
+        for i in range(num_readers)
+    ]
 
     # 创建 filter 进程
     filters = [
-        Process(target=filter, args=(data_queue_1, authors_queue, authors_ids_queue, counts_queue, coordinator_queue)),
-        Process(target=filter, args=(data_queue_2, authors_queue, authors_ids_queue, counts_queue, coordinator_queue))
+        Process(target=filter, args=(data_queues[j], [r[j] for r in rings], authors_queue, authors_ids_queue, counts_queue, coordinator_queue, counters, stages))
+        for j in range(num_filters)
     ]
 
     # 创建 writer 进程
     writers = [
-        Process(target=write_to_gz, args=(authors_queue, file_spec['authors']['name'], file_spec['authors']['columns'], coordinator_queue)),
-        Process(target=write_to_gz, args=(authors_ids_queue, file_spec['ids']['name'], file_spec['ids']['columns'], coordinator_queue)),
-        Process(target=write_to_gz, args=(counts_queue, file_spec['counts_by_year']['name'], file_spec['counts_by_year']['columns'], coordinator_queue))
+        Process(target=write_to_gz, args=(authors_queue, file_spec['authors']['name'], file_spec['authors']['columns'], coordinator_queue, counters)),
+        Process(target=write_to_gz, args=(authors_ids_queue, file_spec['ids']['name'], file_spec['ids']['columns'], coordinator_queue, counters)),
+        Process(target=write_to_gz, args=(counts_queue, file_spec['counts_by_year']['name'], file_spec['counts_by_year']['columns'], coordinator_queue, counters))
     ]
 
     # 创建 coordinator 进程
-    coordinator_p = Process(target=coordinator, args=(coordinator_queue,authors_queue, authors_ids_queue, counts_queue))
+    coordinator_p = Process(target=coordinator, args=(coordinator_queue, data_queues, authors_queue, authors_ids_queue, counts_queue, num_readers, num_filters))
     start = time.time()
+    reporter.start()
     # 启动 reader、filter 和 writer 进程
     
     for proc in filters:
@@ -189,16 +220,26 @@ if __name__ == '__main__':
     for proc in writers:
         proc.start()
     coordinator_p.start()
-    readers.start()
+    for proc in readers:
+        proc.start()
 
+    if config['autotune']:
+        autotune.Tuner(stages, data_queues, rings, [authors_queue, authors_ids_queue, counts_queue], config['queue_size'],
+                       num_readers, num_filters, config['autotune_seconds']).run(
+            lambda: not any(proc.is_alive() for proc in readers))
 
     # 等待 reader、filter 和 writer 进程结束
-    readers.join()
+    for proc in readers:
+        proc.join()
     for proc in filters:
         proc.join()
     for proc in writers:
         proc.join()
     coordinator_p.join()
+    reporter.stop()
+    for reader_rings in rings:
+        for ring in reader_rings:
+            ring.close()
 
     end = time.time()
     print("All processes done, it took", (end - start)/60, "minutes.")
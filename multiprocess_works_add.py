@@ -1,147 +1,119 @@
-import csv
 import gzip
 import json
 import os
 import time
 from multiprocessing import Process, Queue
 from itertools import islice
-import glob
-
-# 全局路径配置
-SNAPSHOT_DIR = 'E:/openalex_data'
-CSV_DIR = 'E:/openalex_csv'
-
-
-# works中可以考虑增加的信息:
-# citation_normalized_percentile counts_by_year fwci grants institutions_distinct_count
-# countries_distinct_count authors_count
-
-# CSV 文件配置
-csv_files = {
-    'works': {
-        'grants': {
-            'name': os.path.join(CSV_DIR, 'works_grants.csv.gz'),
-            'columns': [
-                'work_id', 'funder', 'funder_display_name', 'award_id',
-            ]
-        },
-        'counts_by_year': {
-            'name': os.path.join(CSV_DIR, 'works_counts_by_year.csv.gz'),
-            'columns': [
-                'work_id', 'year', 'cited_by_count'
-                ]
-        },
-        'more_info': {
-            'name': os.path.join(CSV_DIR, 'works_more_info.csv.gz'),
-            'columns': [
-                'work_id', 'institutions_distinct_count',
-                'countries_distinct_count', 'authors_count','fwci', 'citation_normalized_percentile',
-                'top1_percentile', 'top10_percentile'
-            ]
-        }
-    }
-}
-
-file_spec = csv_files['works']
-
-def reader(file_paths, data_queues, coordinator_queue, chunk_size):
+
+import autotune
+import merged_ids
+import progress
+from gz_members import rows_to_member
+from object_store import open_part, stat
+from openalex_config import build_parser, load_config, snapshot_files
+from openalex_tables import build_csv_files
+from row_filter import compile_filter
+from shard_manifest import (ShardFile, add_shard, generate_load_scripts,
+                            new_manifest, table_name, write_manifest)
+from shm_ring import ShmRing, flush_queues, put_chunk, get_chunk, iter_lines, release_chunk, ring_bytes
+from works_extract import abstract_format, extract_work, new_results
+
+# 全局路径配置 (命令行 / 环境变量 / 配置文件, 见 openalex_config.py)
+parser = build_parser('Flatten OpenAlex works in one pass with reader/filter/writer processes.')
+parser.add_argument('--tables', nargs='+', default=None,
+                    help='works tables to write (default: all 16, e.g. grants counts_by_year more_info)')
+config = load_config(parser=parser,
+                     defaults={'readers': 2, 'parsers': 3, 'chunk_size': 150, 'queue_size': 50000},
+                     multi_node_output=True)
+SNAPSHOT_DIR = config['snapshot_dir']
+CSV_DIR = config['csv_dir']
+COMPRESSLEVEL = config['compresslevel']
+ROW_FILTER = merged_ids.entity_filter(config, 'works', compile_filter(config['where']))
+
+# CSV 文件配置: 一次读取 works 快照即可写出 csv_files['works'] 的全部 16 个表,
+# 不再需要先跑 flatten_works 再单独跑一遍 grants/counts_by_year/more_info
+csv_files = build_csv_files(CSV_DIR, config['normalize_authorships'], config['abstracts'])
+
+file_spec = {key: spec for key, spec in csv_files['works'].items()
+             if not config['args'].tables or key in config['args'].tables}
+
+def reader(file_paths, data_queues, rings, reader_index, coordinator_queue, chunk_size, counters, stages):
     print("Reader Started.")
     queue_index = 0  # 用于轮询分发数据
 
-    for file_path in file_paths:
+    # 从共享计数器领取下一个文件, --autotune 调整 reader 个数时不需要重新划分文件
+    while (file_index := stages.claim_file(reader_index, len(file_paths))) is not None:
+        file_path = file_paths[file_index]
         print(f"Reading file: {file_path}")
-        with gzip.open(file_path, "rt", encoding='utf-8', newline='') as infile:
+        with open_part(file_path, "rb") as infile:
             while True:
-                data_chunk = list(islice(infile, chunk_size))
+                started = time.perf_counter()
+                data_chunk = b''.join(islice(infile, chunk_size))
+                stages.add_busy(0, time.perf_counter() - started)
                 if not data_chunk:
                     break  # 当前文件读取完成，继续读取下一个文件
 
-                # 将数据块分发到对应的 data_queue
-                data_queues[queue_index].put(data_chunk)
+                # 写入 (reader, filter) 对应的共享内存 ring, 队列里只传偏移量
+                queue_index %= stages.filters()
+                put_chunk(rings[queue_index], reader_index, data_queues[queue_index], data_chunk)
 
-                # 更新 queue_index，轮询分发数据
-                queue_index = (queue_index + 1) % len(data_queues)
+                # 更新 queue_index，轮询分发数据 (只分给活动的 filter)
+                queue_index += 1
+        counters.add('files')
+        counters.add('bytes', stat(file_path)[0])
 
     # 所有文件读取完成，向所有 coordinator_queue 发送 READ_DONE 信号
+    flush_queues(data_queues)
     coordinator_queue.put('READ_DONE')
 
 
-def filter(data_queue, grants_queue, counts_queue, add_queue, coordinator_queue):
+def filter(data_queue, rings, table_queues, coordinator_queue, counters, stages):
     print("filter Started.")
     while True:
-        data_chunk = data_queue.get()
-        if data_chunk == 'DONE':
+        message = data_queue.get()
+        if message == 'DONE':
             coordinator_queue.put('FILTER_DONE')
             break
+        started = time.perf_counter()
+        data_chunk = get_chunk(rings, message)  # 共享内存上的 memoryview, 不复制
         # 处理数据
-        grants_list = []
-        counts_list = []
-        add_list = []
-        for line in data_chunk:
+        results = new_results(file_spec)
+        for line in iter_lines(data_chunk):
             if not line.strip():
                 continue
-            work = json.loads(line)
-            if not (work_id := work.get('id')):
+            if ROW_FILTER and not ROW_FILTER(line):
                 continue
-            info_add = {}
-            
-            # grants
-            if grants := work.get('grants'):  # 如果 grants 为空列表,则不执行
-                for grant in grants:
-                    grant['work_id'] = work_id
-                    grants_list.append(grant)
-
-            # counts_by_year
-            if counts := work.get('counts_by_year'):
-                for info in counts:
-                    info['work_id'] = work_id
-                    counts_list.append(info)
-            # more_info
-            info_add['work_id'] = work_id
-            info_add['institutions_distinct_count'] = work.get('institutions_distinct_count')
-            info_add['countries_distinct_count'] = work.get('countries_distinct_count')
-            info_add['authors_count'] = work.get('authors_count')
-            info_add['fwci'] = work.get('fwci')
-
-            # 假设 info_add 是你用来存储提取数据的字典
-            # 假设 info_add 是你用来存储提取数据的字典
-            citation_info = work.get('citation_normalized_percentile')  # 获取 citation_normalized_percentile
-
-            # 如果 citation_normalized_percentile 是 None，则将其视为空字典
-            if citation_info is None:
-                citation_info = {}
-
-            # 提取字段，如果字段不存在则使用默认值 None
-            info_add['citation_normalized_percentile'] = citation_info.get('value')
-            info_add['top1_percentile'] = citation_info.get('is_in_top_1_percent')
-            info_add['top10_percentile'] = citation_info.get('is_in_top_10_percent')
-
-            add_list.append(info_add)
-
-        grants_queue.put(grants_list)
-        counts_queue.put(counts_list)
-        add_queue.put(add_list)
-
-
-def write_to_gz(queue, file_path, columns, coordinator_queue):
+            extract_work(json.loads(line), results, abstract_format(file_spec))
+        release_chunk(rings, message)  # 解析完再释放, reader 才能覆盖这块共享内存
+        counters.add('records', len(results['works']) if 'works' in results else 0)
+
+        # 在 filter 里完成 CSV 格式化和压缩, writer 只负责写文件
+        for key, rows in results.items():
+            if rows:
+                table_queues[key].put((len(rows), rows_to_member(rows, file_spec[key]['columns'], COMPRESSLEVEL)))
+        stages.add_busy(1, time.perf_counter() - started)
+
+
+def write_to_gz(queue, file_path, columns, coordinator_queue, counters):
     print(f"Writer Started for {file_path}.")
-    with gzip.open(file_path, 'wt', encoding='utf-8', newline="") as outfile:
-        writer = csv.DictWriter(outfile, fieldnames=columns, extrasaction='ignore', lineterminator='\n')
-        writer.writeheader()  # 写入表头
-
-        while True:
-            data = queue.get()
-            if data == 'DONE':
-                coordinator_queue.put('WRITE_DONE')
-                break
-            writer.writerows(data)  # 写入数据
+    table = table_name(file_path)
+    outfile = ShardFile(file_path, columns, COMPRESSLEVEL)  # 写入表头
+
+    while True:
+        data = queue.get()
+        if data == 'DONE':
+            # 把该表的行数/字节数/校验和交给 coordinator 写入 manifest
+            coordinator_queue.put(('WRITE_DONE', table, columns, outfile.close()))
+            break
+        rows, member = data
+        outfile.write(member, rows)  # filter 已经格式化并压缩好, 这里只做 I/O
+        counters.add(f'rows:{table}', rows)
 
 
-def coordinator(coordinator_queue, data_queues,grants_queue, counts_queue, add_queue):
+def coordinator(coordinator_queue, data_queues, table_queues, active_readers, active_filters):
     print("Coordinator Started.")
-    active_readers = 2  # 有两个 reader 进程
-    active_filters = 3  # 有三个 filter 进程
-    active_writers = 3  # 有三个 writer 进程
+    manifest = new_manifest()
+    active_writers = len(table_queues)  # 每个表一个 writer 进程
 
     while True:
         queue_message = coordinator_queue.get()
@@ -156,73 +128,82 @@ def coordinator(coordinator_queue, data_queues,grants_queue, counts_queue, add_q
             active_filters -= 1
             print(f"Filter done. Active filters: {active_filters}")
             if active_filters == 0:
-                while not add_queue.qsize() == 0:
+                while any(queue.qsize() for queue in table_queues.values()):
                     continue
-                grants_queue.put('DONE')
-                counts_queue.put('DONE')
-                add_queue.put('DONE')
+                for queue in table_queues.values():
+                    queue.put('DONE')
                 print("All filters done.")
-        elif queue_message == 'WRITE_DONE':
+        elif queue_message[0] == 'WRITE_DONE':
+            add_shard(manifest, *queue_message[1:])
             active_writers -= 1
             print(f"Writer done. Active writers: {active_writers}")
             if active_writers == 0:
                 print("All writers done.")
                 break
 
-    with open('D:/postgreSQL_project/test_prj/output/log.json', 'w', encoding="utf-8") as f:
-        for queue in [grants_queue, counts_queue, add_queue]:
+    write_manifest(manifest, os.path.join(CSV_DIR, 'manifest-works-add.json'))
+    generate_load_scripts(manifest, os.path.join(CSV_DIR, 'load-works-add.sql'))
+    if config['merged_ids']:
+        merged_ids.write_entity_deletes(config, 'works', file_spec, ROW_FILTER)
+
+    with open(config['log_path'], 'w', encoding="utf-8") as f:
+        for queue in table_queues.values():
             while not queue.empty():
-                content = queue.get()
-                for i in content:
-                    f.write(json.dumps(i, ensure_ascii=False) + '\n')
+                rows, content = queue.get()
+                f.write(json.dumps(gzip.decompress(content).decode('utf-8'), ensure_ascii=False) + '\n')
                     # print(i)
 
 
 if __name__ == '__main__':
-    # 创建多个 data_queue
-    data_queue_1 = Queue(50000)
-    data_queue_2 = Queue(50000)
-    data_queue_3 = Queue(50000)
-    data_queues = [data_queue_1, data_queue_2, data_queue_3]  # 将 data_queue 放入列表中
+    os.makedirs(CSV_DIR, exist_ok=True)
+    input_files = snapshot_files(config, 'works')
+    # --autotune 时按上限创建进程, 开始只启用 --readers / --parsers 个, 见 autotune.py
+    num_readers, num_filters = autotune.limits(config, len(input_files))
+    stages = autotune.StageState(min(config['readers'], num_readers), config['parsers'])
+
+    # 每个 filter 一个 data_queue
+    data_queues = [Queue(config['queue_size']) for _ in range(num_filters)]
 
-    # 创建其他队列
-    grants_queue = Queue(100000)
-    counts_queue = Queue(100000)
-    add_queue = Queue(1500000)
+    # 每个表一个 writer 队列
+    table_queues = {key: Queue(config['queue_size']) for key in file_spec}
 
     # 创建 coordinator_queue
     coordinator_queue = Queue()
-    # input_files = glob.glob(os.path.join(SNAPSHOT_DIR, 'data', 'works', '*', '*.gz'))
-    input_files = glob.glob(os.path.join(SNAPSHOT_DIR, 'data', 'works', '*', '*.gz'))
-    # 创建 reader 进程
-    # readers = Process(target=reader, args=(input_files, data_queues, coordinator_queue, 150))
 
-    # 将input_files划分为多个子列表，每个reader进程处理一个子列表
-    num_readers = 2
-
-    sub_files_1 = input_files[0::num_readers]
-    reader_1 = Process(target=reader, args=(sub_files_1, data_queues, coordinator_queue, 150))
-    sub_files_2 = input_files[1::num_readers]
-    reader_2 = Process(target=reader, args=(sub_files_2, data_queues, coordinator_queue, 150))
+    # 进度计数器在共享内存里, 作为参数传给各个进程
+    counters = progress.Counters([table_name(spec['name']) for spec in file_spec.values()])
+    reporter = progress.Reporter(counters, 'works', len(input_files),
+                                 sum(stat(path)[0] for path in input_files),
+                                 config['progress_interval'], config['metrics_port'])
+
+    # 每个 (reader, filter) 组合一个共享内存 ring, 保证单生产者单消费者
+    # --autotune 时 ring 个数是上限的乘积, 合计大小受 --ring-memory 限制
+    ring_size = ring_bytes(config['ring_size'], config['ring_memory'], num_readers * num_filters)
+    rings = [[ShmRing(ring_size) for _ in data_queues] for _ in range(num_readers)]
+
+    # reader 进程从 input_files 里依次领取文件
+    readers = [
+        Process(target=reader, args=(input_files, data_queues, rings[i], i, coordinator_queue, config['chunk_size'], counters, stages))
+        for i in range(num_readers)
+    ]
 
     # 创建 filter 进程
     filters = [
-        Process(target=filter, args=(data_queue_1, grants_queue, counts_queue, add_queue, coordinator_queue)),
-        Process(target=filter, args=(data_queue_2, grants_queue, counts_queue, add_queue, coordinator_queue)),
-        Process(target=filter, args=(data_queue_3, grants_queue, counts_queue, add_queue, coordinator_queue)),
+        Process(target=filter, args=(data_queues[j], [r[j] for r in rings], table_queues, coordinator_queue, counters, stages))
+        for j in range(num_filters)
     ]
 
     # 创建 writer 进程
     writers = [
-        Process(target=write_to_gz, args=(grants_queue, file_spec['grants']['name'], file_spec['grants']['columns'], coordinator_queue)),
-        Process(target=write_to_gz, args=(counts_queue, file_spec['counts_by_year']['name'], file_spec['counts_by_year']['columns'], coordinator_queue)),
-        Process(target=write_to_gz, args=(add_queue, file_spec['more_info']['name'], file_spec['more_info']['columns'], coordinator_queue))
+        Process(target=write_to_gz, args=(table_queues[key], spec['name'], spec['columns'], coordinator_queue, counters))
+        for key, spec in file_spec.items()
     ]
 
     # 创建 coordinator 进程
-    coordinator_p = Process(target=coordinator, args=(coordinator_queue, data_queues,grants_queue, counts_queue, add_queue))
+    coordinator_p = Process(target=coordinator, args=(coordinator_queue, data_queues, table_queues, num_readers, num_filters))
 
     start = time.time()
+    reporter.start()
     # 启动 reader、filter 和 writer 进程
     
     for proc in filters:
@@ -230,24 +211,33 @@ if __name__ == '__main__':
     for proc in writers:
         proc.start()
     coordinator_p.start()
-    reader_1.start()
-    reader_2.start()
+    for proc in readers:
+        proc.start()
 
     print(
-        f"Reader: {reader_1.pid} and {reader_2.pid}, \
-        Filter: {filters[0].pid}, {filters[1].pid} and {filters[2].pid} \
-        Writer: {writers[0].pid}, {writers[1].pid}, {writers[2].pid}, \
+        f"Reader: {[proc.pid for proc in readers]}, \
+        Filter: {[proc.pid for proc in filters]} \
+        Writer: {[proc.pid for proc in writers]}, \
         Coordinator: {coordinator_p.pid}"
     )
 
+    if config['autotune']:
+        autotune.Tuner(stages, data_queues, rings, list(table_queues.values()), config['queue_size'],
+                       num_readers, num_filters, config['autotune_seconds']).run(
+            lambda: not any(proc.is_alive() for proc in readers))
+
     # 等待 reader、filter 和 writer 进程结束
-    reader_1.join()
-    reader_2.join()
+    for proc in readers:
+        proc.join()
     for proc in filters:
         proc.join()
     for proc in writers:
         proc.join()
     coordinator_p.join()
+    reporter.stop()
+    for reader_rings in rings:
+        for ring in reader_rings:
+            ring.close()
 
     end = time.time()
-    print("All processes done, it took", (end - start)/60, "minutes.")
\ No newline at end of file
+    print("All processes done, it took", (end - start)/60, "minutes.")
@@ -0,0 +1,333 @@
+import argparse
+import datetime
+import email.utils
+import fnmatch
+import glob
+import gzip
+import hashlib
+import hmac
+import io
+import os
+import time
+import urllib.error
+import urllib.request
+import xml.etree.ElementTree as ET
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, quote, unquote, urlsplit
+
+# 直接从 S3 兼容的对象存储读取快照, 不用先下载到本地:
+#   --snapshot-dir s3://openalex-mirror/openalex --s3-endpoint http://minio.internal:9000
+#
+# 只依赖标准库: ListObjectsV2 列出 part 文件, HEAD 取大小, 按 --prefetch-size 分块发 Range GET.
+# 每个文件最多 --prefetch-requests 个请求同时在途, 解压读到的总是已经下载好的块.
+# 凭据取自 AWS_ACCESS_KEY_ID / AWS_SECRET_ACCESS_KEY (/ AWS_SESSION_TOKEN), 用 SigV4 签名;
+# 没有凭据时发匿名请求. 使用 path-style 地址 (<endpoint>/<bucket>/<key>), MinIO 等都支持.
+#
+# 本地测试用的简易 S3 服务 (只支持上面用到的请求, 不校验签名):
+#   python object_store.py serve /data/mirror --port 9000
+#   # /data/mirror/<bucket>/<key>
+
+EMPTY_SHA256 = hashlib.sha256(b'').hexdigest()
+RETRIES = 3
+
+# 由 openalex_config.load_config 设置; fork 出的 worker 直接继承
+SETTINGS = {'endpoint': '', 'region': 'us-east-1', 'prefetch_size': 8, 'prefetch_requests': 4}
+_clients = {}
+
+
+def is_remote(path):
+    return str(path).startswith('s3://')
+
+
+def configure(config):
+    SETTINGS.update(endpoint=config['s3_endpoint'], region=config['s3_region'],
+                    prefetch_size=config['prefetch_size'], prefetch_requests=config['prefetch_requests'])
+
+
+def split_url(url):
+    # s3://bucket/a/b -> ('bucket', 'a/b')
+    bucket, _, key = url[len('s3://'):].partition('/')
+    return bucket, key
+
+
+class S3Client:
+
+    def __init__(self, endpoint, region='us-east-1', access_key=None, secret_key=None, session_token=None):
+        self.endpoint = endpoint.rstrip('/')
+        self.region = region
+        self.access_key = access_key
+        self.secret_key = secret_key
+        self.session_token = session_token
+        self.host = urlsplit(self.endpoint).netloc
+
+    @classmethod
+    def from_settings(cls):
+        region = SETTINGS['region']
+        return cls(SETTINGS['endpoint'] or f'https://s3.{region}.amazonaws.com', region,
+                   os.environ.get('AWS_ACCESS_KEY_ID'), os.environ.get('AWS_SECRET_ACCESS_KEY'),
+                   os.environ.get('AWS_SESSION_TOKEN'))
+
+    def _sign(self, method, path, query, headers):
+        now = datetime.datetime.now(datetime.timezone.utc)
+        amz_date = now.strftime('%Y%m%dT%H%M%SZ')
+        headers['x-amz-date'] = amz_date
+        headers['x-amz-content-sha256'] = EMPTY_SHA256
+        if self.session_token:
+            headers['x-amz-security-token'] = self.session_token
+        if not (self.access_key and self.secret_key):
+            return
+        signed = {'host': self.host, **{k.lower(): v for k, v in headers.items() if k.lower().startswith('x-amz-')}}
+        names = ';'.join(sorted(signed))
+        canonical = '\n'.join([
+            method, path, query,
+            ''.join(f'{name}:{signed[name].strip()}\n' for name in sorted(signed)),
+            names, EMPTY_SHA256,
+        ])
+        scope = f"{now.strftime('%Y%m%d')}/{self.region}/s3/aws4_request"
+        to_sign = '\n'.join(['AWS4-HMAC-SHA256', amz_date, scope,
+                             hashlib.sha256(canonical.encode('utf-8')).hexdigest()])
+        key = ('AWS4' + self.secret_key).encode('utf-8')
+        for part in scope.split('/'):
+            key = hmac.new(key, part.encode('utf-8'), hashlib.sha256).digest()
+        signature = hmac.new(key, to_sign.encode('utf-8'), hashlib.sha256).hexdigest()
+        headers['Authorization'] = (f'AWS4-HMAC-SHA256 Credential={self.access_key}/{scope}, '
+                                    f'SignedHeaders={names}, Signature={signature}')
+
+    def request(self, method, bucket, key='', params=None, headers=None):
+        """返回 (响应头, body); 网络错误和 5xx 重试几次."""
+        path = '/' + quote(bucket, safe='') + ('/' + quote(key, safe='/~') if key else '')
+        query = '&'.join(f"{quote(k, safe='-_.~')}={quote(str(v), safe='-_.~')}"
+                         for k, v in sorted((params or {}).items()))
+        for attempt in range(RETRIES):
+            headers_ = dict(headers or {})
+            self._sign(method, path, query, headers_)
+            url = self.endpoint + path + ('?' + query if query else '')
+            try:
+                with urllib.request.urlopen(urllib.request.Request(url, method=method, headers=headers_),
+                                            timeout=60) as response:
+                    return response.headers, response.read()
+            except urllib.error.HTTPError as e:
+                if e.code < 500 or attempt == RETRIES - 1:
+                    raise
+            except (urllib.error.URLError, OSError):
+                if attempt == RETRIES - 1:
+                    raise
+            time.sleep(2 ** attempt)
+
+    def list(self, bucket, prefix):
+        """列出 prefix 下所有对象, 返回 [(key, 大小)]."""
+        objects = []
+        params = {'list-type': 2, 'prefix': prefix}
+        while True:
+            _, body = self.request('GET', bucket, params=params)
+            root = ET.fromstring(body)
+            for element in root.iter():
+                element.tag = element.tag.rsplit('}', 1)[-1]  # 去掉 XML 命名空间
+            for item in root.iter('Contents'):
+                objects.append((item.findtext('Key'), int(item.findtext('Size'))))
+            token = root.findtext('NextContinuationToken')
+            if root.findtext('IsTruncated') != 'true' or not token:
+                return objects
+            params['continuation-token'] = token
+
+    def head(self, bucket, key):
+        """返回 (大小, 修改时间 (unix 时间戳))."""
+        headers, _ = self.request('HEAD', bucket, key)
+        modified = headers.get('Last-Modified')
+        mtime = email.utils.parsedate_to_datetime(modified).timestamp() if modified else 0.0
+        return int(headers['Content-Length']), mtime
+
+    def get_range(self, bucket, key, start, end):
+        # end 包含在内, 与 HTTP Range 一致
+        _, body = self.request('GET', bucket, key, headers={'Range': f'bytes={start}-{end}'})
+        return body
+
+
+def client():
+    # 每个进程一个 client (fork 之后不共用)
+    pid = os.getpid()
+    if pid not in _clients:
+        _clients[pid] = S3Client.from_settings()
+    return _clients[pid]
+
+
+class PrefetchReader(io.RawIOBase):
+    """顺序读一个对象: 同时有 requests 个 Range GET 在途, 按顺序交给调用方."""
+
+    def __init__(self, s3, bucket, key, size, chunk_size, requests):
+        self.s3 = s3
+        self.bucket = bucket
+        self.key = key
+        self.size = size
+        self.chunk_size = chunk_size
+        self.requests = requests
+        self.executor = ThreadPoolExecutor(max_workers=requests)
+        self.pending = deque()
+        self.offset = 0  # 下一个要请求的位置
+        self.buffer = memoryview(b'')
+        self._fill()
+
+    def _fill(self):
+        while len(self.pending) < self.requests and self.offset < self.size:
+            end = min(self.offset + self.chunk_size, self.size) - 1
+            self.pending.append(self.executor.submit(self.s3.get_range, self.bucket, self.key, self.offset, end))
+            self.offset = end + 1
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        if not self.buffer:
+            if not self.pending:
+                return 0
+            self.buffer = memoryview(self.pending.popleft().result())
+            self._fill()
+        n = min(len(b), len(self.buffer))
+        b[:n] = self.buffer[:n]
+        self.buffer = self.buffer[n:]
+        return n
+
+    def close(self):
+        if not self.closed:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+            self.pending.clear()
+        super().close()
+
+
+def open_part(path, mode='rb', **kwargs):
+    """打开一个快照里的 .gz 文件 (本地路径或 s3:// URL), 参数同 gzip.open."""
+    if not is_remote(path):
+        return gzip.open(path, mode, **kwargs)
+    s3 = client()
+    bucket, key = split_url(path)
+    size, _ = s3.head(bucket, key)
+    raw = PrefetchReader(s3, bucket, key, size, SETTINGS['prefetch_size'] * 1024 * 1024,
+                         SETTINGS['prefetch_requests'])
+    # gzip 不负责关闭传入的 fileobj, 关闭时一起关掉预取线程
+    stream = gzip.open(io.BufferedReader(raw, 1024 * 1024), mode, **kwargs)
+    close = stream.close
+
+    def close_all():
+        close()
+        raw.close()
+    stream.close = close_all
+    return stream
+
+
+def find_files(root, pattern):
+    """root 下匹配 pattern (例如 data/works/*/*.gz) 的文件, 排好序; root 可以是 s3:// URL."""
+    if not is_remote(root):
+        return sorted(glob.glob(os.path.join(root, pattern)))
+    bucket, prefix = split_url(root.rstrip('/'))
+    parts = pattern.split('/')
+    # 第一个通配符之前的部分作为 ListObjects 的前缀
+    fixed = []
+    for part in parts:
+        if any(c in part for c in '*?['):
+            break
+        fixed.append(part)
+    base = f'{prefix}/' if prefix else ''
+    files = []
+    for key, _ in client().list(bucket, base + '/'.join(fixed)):
+        relative = key[len(base):].split('/')
+        if len(relative) == len(parts) and all(fnmatch.fnmatchcase(a, b) for a, b in zip(relative, parts)):
+            files.append(f's3://{bucket}/{key}')
+    return sorted(files)
+
+
+def stat(path):
+    """(大小, 修改时间), 本地文件和 s3:// 对象都可以."""
+    if not is_remote(path):
+        result = os.stat(path)
+        return result.st_size, result.st_mtime
+    return client().head(*split_url(path))
+
+
+class StandInHandler(BaseHTTPRequestHandler):
+    """把一个本地目录当成 S3 服务: <root>/<bucket>/<key>."""
+
+    root = '.'
+    page_size = 1000
+
+    def log_message(self, *args):
+        pass
+
+    def _path(self):
+        bucket, _, key = unquote(urlsplit(self.path).path).lstrip('/').partition('/')
+        return bucket, key, os.path.join(self.root, bucket, *key.split('/'))
+
+    def _send(self, status, body=b'', headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        if self.command != 'HEAD':
+            self.wfile.write(body)
+
+    def do_HEAD(self):
+        _, _, path = self._path()
+        if not os.path.isfile(path):
+            return self._send(404)
+        self.send_response(200)
+        self.send_header('Content-Length', str(os.path.getsize(path)))
+        self.send_header('Last-Modified', email.utils.formatdate(os.path.getmtime(path), usegmt=True))
+        self.end_headers()
+
+    def do_GET(self):
+        bucket, key, path = self._path()
+        query = parse_qs(urlsplit(self.path).query)
+        if not key and 'list-type' in query:
+            return self._list(bucket, query)
+        if not os.path.isfile(path):
+            return self._send(404)
+        size = os.path.getsize(path)
+        with open(path, 'rb') as f:
+            if 'Range' not in self.headers:
+                return self._send(200, f.read())
+            start, _, end = self.headers['Range'][len('bytes='):].partition('-')
+            if not start:  # bytes=-N: 最后 N 个字节
+                start, end = max(size - int(end), 0), size - 1
+            else:
+                start, end = int(start), min(int(end) if end else size - 1, size - 1)
+            if start > end:
+                return self._send(416, headers={'Content-Range': f'bytes */{size}'})
+            # 只读请求的那一段, 预读的每个 Range GET 不再读整个文件
+            f.seek(start)
+            self._send(206, f.read(end - start + 1), {'Content-Range': f'bytes {start}-{end}/{size}'})
+
+    def _list(self, bucket, query):
+        prefix = query.get('prefix', [''])[0]
+        start = int(query.get('continuation-token', ['0'])[0])
+        base = os.path.join(self.root, bucket)
+        keys = sorted(os.path.relpath(os.path.join(directory, name), base).replace(os.sep, '/')
+                      for directory, _, names in os.walk(base) for name in names)
+        keys = [key for key in keys if key.startswith(prefix)]
+        page = keys[start:start + self.page_size]
+        root = ET.Element('ListBucketResult', xmlns='http://s3.amazonaws.com/doc/2006-03-01/')
+        ET.SubElement(root, 'IsTruncated').text = 'true' if start + self.page_size < len(keys) else 'false'
+        if start + self.page_size < len(keys):
+            ET.SubElement(root, 'NextContinuationToken').text = str(start + self.page_size)
+        for key in page:
+            contents = ET.SubElement(root, 'Contents')
+            ET.SubElement(contents, 'Key').text = key
+            ET.SubElement(contents, 'Size').text = str(os.path.getsize(os.path.join(base, *key.split('/'))))
+        self._send(200, ET.tostring(root), {'Content-Type': 'application/xml'})
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Serve a local directory as a minimal S3-compatible store for testing.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    serve = subparsers.add_parser('serve')
+    serve.add_argument('root', help='directory containing <bucket>/<key> files')
+    serve.add_argument('--host', default='127.0.0.1')
+    serve.add_argument('--port', type=int, default=9000)
+    serve.add_argument('--page-size', type=int, default=1000, help='keys per ListObjectsV2 page')
+    args = parser.parse_args()
+
+    StandInHandler.root = args.root
+    StandInHandler.page_size = args.page_size
+    print(f'serving {args.root} on http://{args.host}:{args.port}')
+    ThreadingHTTPServer((args.host, args.port), StandInHandler).serve_forever()
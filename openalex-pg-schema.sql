@@ -317,12 +317,33 @@ CREATE TABLE openalex.works_best_oa_locations (
 --
 CREATE TABLE openalex.works_authorships (
     work_id text,
+    author_ordinal integer,
     author_position text,
     author_id text,
     institution_id text,
     raw_affiliation_string text
 );
 --
+-- Name: works_abstracts; Type: TABLE; Schema: openalex; Owner: -
+--
+-- Only written with --abstracts json / text / binary; works.abstract_inverted_index then stays NULL.
+-- For --abstracts binary, before loading:
+--   ALTER TABLE openalex.works_abstracts ALTER COLUMN abstract TYPE bytea USING abstract::bytea;
+CREATE TABLE openalex.works_abstracts (
+    work_id text NOT NULL,
+    abstract text
+);
+--
+-- Name: works_authorships_institutions; Type: TABLE; Schema: openalex; Owner: -
+--
+-- Only written with --normalize-authorships: works_authorships then has one row per
+-- (work_id, author_ordinal) and institution_id stays NULL.
+CREATE TABLE openalex.works_authorships_institutions (
+    work_id text,
+    author_ordinal integer,
+    institution_id text
+);
+--
 -- Name: works_biblio; Type: TABLE; Schema: openalex; Owner: -
 --
 CREATE TABLE openalex.works_biblio (
@@ -496,6 +517,15 @@ CREATE TABLE openalex.works_related_works (work_id text, related_work_id text);
 --
 --
 ----
+---- Name: works_authorships works_authorships_pkey; Type: CONSTRAINT; Schema: openalex; Owner: -
+---- (--normalize-authorships only)
+----
+--
+--ALTER TABLE ONLY openalex.works_authorships
+--    ADD CONSTRAINT works_authorships_pkey PRIMARY KEY (work_id, author_ordinal);
+--
+--
+----
 ---- Name: works_ids works_ids_pkey; Type: CONSTRAINT; Schema: openalex; Owner: -
 ----
 --
@@ -566,4 +596,28 @@ CREATE TABLE openalex.works_more_info (
     citation_normalized_percentile real,
     top1_percentile boolean,
     top10_percentile boolean
-);
\ No newline at end of file
+);
+
+-- Aggregates computed while flattening works (works_aggregates.py, --aggregates)
+CREATE TABLE openalex.agg_author_works_by_year (
+    author_id text,
+    publication_year integer,
+    works_count integer,
+    cited_by_count bigint
+);
+CREATE TABLE openalex.agg_institution_citations (
+    institution_id text,
+    works_count integer,
+    cited_by_count bigint
+);
+CREATE TABLE openalex.agg_source_works_by_year (
+    source_id text,
+    publication_year integer,
+    works_count integer,
+    cited_by_count bigint
+);
+CREATE TABLE openalex.agg_coauthor_counts (
+    author_id text,
+    coauthor_id text,
+    works_count integer
+);
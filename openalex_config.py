@@ -0,0 +1,193 @@
+import argparse
+import json
+import os
+
+import multi_node
+import object_store
+
+# 所有脚本共用的运行配置. 优先级 (从低到高):
+#   内置默认值 < 脚本自己的默认值 < 配置文件 (--config / OPENALEX_CONFIG, JSON)
+#   < 环境变量 OPENALEX_<KEY> < 命令行参数 --<key>
+#
+# 配置文件示例:
+# {
+#     "snapshot_dir": "/data/openalex-snapshot",
+#     "csv_dir": "/nvme/openalex-csv",
+#     "temp_dir": "/nvme/tmp",
+#     "parsers": 12,
+#     "compresslevel": 6
+# }
+
+DEFAULTS = {
+    'snapshot_dir': 'openalex-snapshot',  # 包含 data/<entity>/updated_date=*/part_*.gz
+    'csv_dir': 'csv-files',
+    'temp_dir': None,  # 溢写/排序等临时文件目录, 默认使用 csv_dir
+    'log_path': None,  # 默认 csv_dir/log.json
+    'readers': 1,
+    'parsers': 2,
+    'workers': None,  # ProcessPoolExecutor 的进程数, None 表示 CPU 核数
+    'chunk_size': 100,  # reader 每次读取的行数
+    'queue_size': 50000,
+    'ring_size': 64,  # 每个共享内存 ring 的大小 (MB)
+    'ring_memory': 1024,  # 所有共享内存 ring 合计的上限 (MB), ring 多时每个 ring 相应缩小, 0 表示不限
+    'compresslevel': 9,
+    'shard_output': False,
+    'files_per_entity': 0,
+    'arrow_entities': '',  # 用 arrow 引擎展开的实体, 逗号分隔, 或 all
+    'where': '',  # 行过滤条件, 见 row_filter.py
+    'citation_graph': '',  # 引用图 CSR 输出目录, 空表示不导出
+    'graph_memory': 1024,  # 构建 CSR 时的内存上限 (MB)
+    'aggregates': '',  # 展开 works 时计算的聚合表, 逗号分隔, 或 all
+    'aggregate_partitions': 16,  # 聚合溢写的分区数, 越大 reduce 时内存越小
+    'dictionary_encode': '',  # 改成整数编码 + 维表的字符串列, 逗号分隔, 或 all
+    'normalize_authorships': False,  # works_authorships 每个 authorship 一行, 机构写到链接表
+    'abstracts': 'inline',  # 摘要格式 inline / json / text / binary, 见 abstract_encoding.py
+    'sort_output': False,  # 每个表按第一列排序 (外部归并排序), 见 sort_output.py
+    'hash_partitions': 0,  # 每个表按第一列哈希分成 N 个文件, 0 表示不分
+    'sort_memory': 1024,  # 排序时内存里保留的行的上限 (MB), 超过就溢写
+    'year_partitions': '',  # works 表按 publication_year 分区的边界, 例如 2000,2010,2020
+    'change_store': '',  # 记录哈希的 sqlite 文件, 设置后只输出新增/变化的记录, 见 change_detection.py
+    'merged_ids': False,  # 丢弃 merged_ids/ 里被合并掉的 id, 并写出删除脚本, 见 merged_ids.py
+    's3_endpoint': '',  # snapshot_dir 是 s3:// URL 时对象存储的地址, 空表示 AWS, 见 object_store.py
+    's3_region': 'us-east-1',
+    'prefetch_size': 8,  # 读对象存储时每个 Range GET 的大小 (MB)
+    'prefetch_requests': 4,  # 每个文件同时在途的 Range GET 数
+    'io_threads': False,  # 单进程展开时在后台线程里解压输入、压缩输出, 见 threaded_io.py
+    'progress_interval': 30,  # 每隔多少秒打印一次进度 (速度/ETA), 0 表示不打印, 见 progress.py
+    'metrics_port': 0,  # Prometheus 指标的本地 HTTP 端口, 0 表示不提供
+    'autotune': False,  # 运行开始时按队列占用和利用率调整 reader/filter 个数, 见 autotune.py
+    'autotune_seconds': 180,  # 自动调整持续的秒数
+    'node_index': 0,  # 多机展开时本节点的编号, 见 multi_node.py
+    'node_count': 1,  # 多机展开的节点数, 1 表示不分节点
+}
+
+HELP = {
+    'snapshot_dir': 'snapshot root containing data/<entity>/',
+    'csv_dir': 'output directory for the .csv.gz files',
+    'temp_dir': 'directory for spill and temporary files (default: csv_dir)',
+    'log_path': 'coordinator log file (default: csv_dir/log.json)',
+    'readers': 'number of reader processes',
+    'parsers': 'number of parser (filter) processes',
+    'workers': 'number of process-pool workers (default: CPU count)',
+    'chunk_size': 'lines per batch sent from readers to parsers',
+    'queue_size': 'maximum number of batches buffered per queue',
+    'ring_size': 'shared-memory ring size per reader/parser pair, in MB',
+    'ring_memory': 'upper bound in MB on all shared-memory rings together; rings shrink when there are many '
+                   'reader/parser pairs (0 = no limit)',
+    'compresslevel': 'gzip compression level of the output files (1-9)',
+    'shard_output': 'write one output shard per input part file',
+    'files_per_entity': 'stop after this many input files per entity (0 = all)',
+    'arrow_entities': 'comma-separated entities to flatten with the pyarrow engine, or "all"',
+    'where': 'only flatten records matching e.g. "publication_year>=2015 and type=article"',
+    'citation_graph': 'also write the citation graph as CSR binary files into this directory',
+    'graph_memory': 'approximate memory budget in MB for building the CSR graph',
+    'aggregates': 'comma-separated aggregate tables to compute while flattening works, or "all"',
+    'aggregate_partitions': 'number of spill partitions for aggregates (more = less memory when merging)',
+    'dictionary_encode': 'comma-separated dimensions (license, version, raw_affiliation_string, oa_status, '
+                         'mesh_descriptor_name) to write as integer codes plus dim_* tables, or "all"',
+    'normalize_authorships': 'write one works_authorships row per authorship and the institutions to '
+                             'works_authorships_institutions',
+    'abstracts': 'inline (JSON in works), or json / text / binary in a separate works_abstracts table',
+    'sort_output': 'rewrite each output table sorted by its first column (external merge sort)',
+    'hash_partitions': 'rewrite each output table as N files hash-partitioned by its first column (0 = off)',
+    'sort_memory': 'approximate memory budget in MB for --sort-output before spilling sorted runs',
+    'year_partitions': 'comma-separated publication_year boundaries, e.g. 2000,2010,2020: write the works tables '
+                       'per year range plus partition-schema.sql',
+    'change_store': 'sqlite file with per-record content hashes: only write records that are new or changed '
+                    'since the previous run, plus works_changes.csv.gz and changes-works.sql',
+    'merged_ids': 'skip records whose ids are listed in <snapshot_dir>/merged_ids/<entity>/ and write '
+                  'merged_<entity>.csv.gz plus delete-merged-<entity>.sql',
+    's3_endpoint': 'endpoint URL of the S3-compatible store when snapshot_dir is an s3:// URL (default: AWS)',
+    's3_region': 'region used to sign object-store requests',
+    'prefetch_size': 'size in MB of each ranged GET when reading from the object store',
+    'prefetch_requests': 'number of ranged GETs in flight per part file when reading from the object store',
+    'io_threads': 'in the serial flatten-openalex-jsonl.py, decompress input and compress each output table on '
+                  'background threads',
+    'progress_interval': 'seconds between progress lines with throughput and ETA (0 = off)',
+    'metrics_port': 'serve Prometheus metrics on http://127.0.0.1:<port>/metrics while running (0 = off)',
+    'autotune': 'in multiprocess_works_add.py / multiprocess_authors.py, start with --readers/--parsers and '
+                'add or retire readers and parsers from queue occupancy and utilization',
+    'autotune_seconds': 'how long --autotune keeps rebalancing after the start of the run',
+    'node_index': 'index of this node (0 .. --node-count - 1) when the run is split across nodes',
+    'node_count': 'split the part files across this many nodes by size; each node writes to <csv_dir>/node-<index>/',
+}
+
+# 兼容旧的环境变量名
+LEGACY_ENV = {
+    'files_per_entity': 'OPENALEX_DEMO_FILES_PER_ENTITY',
+}
+
+
+def _convert(key, value):
+    default = DEFAULTS[key]
+    if isinstance(default, bool):
+        if isinstance(value, str):
+            return value.strip().lower() in ('1', 'true', 'yes', 'on')
+        return bool(value)
+    if isinstance(default, int) or key == 'workers':
+        return int(value) if value not in (None, '') else None
+    return value
+
+
+def build_parser(description=None):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument('--config', default=os.environ.get('OPENALEX_CONFIG'),
+                        help='JSON config file (env: OPENALEX_CONFIG)')
+    for key in DEFAULTS:
+        flag = '--' + key.replace('_', '-')
+        if isinstance(DEFAULTS[key], bool):
+            parser.add_argument(flag, dest=key, action='store_true',
+                                default=None, help=HELP[key])
+        else:
+            parser.add_argument(flag, dest=key, default=None,
+                                help=f'{HELP[key]} (env: OPENALEX_{key.upper()})')
+    return parser
+
+
+def load_config(argv=None, description=None, defaults=None, parser=None, multi_node_output=False):
+    """按优先级合并默认值、配置文件、环境变量和命令行参数, 返回配置 dict.
+
+    有自己参数的脚本先在 build_parser() 的 parser 上添加, 再用 parser= 传进来;
+    未知参数 (例如拼错的 --csvdir) 直接报错退出, 不会悄悄用默认值运行.
+    multi_node_output: 脚本会写 manifest-*.json, 可以用 --node-count 分节点运行 (见 multi_node.py).
+    """
+    parser = parser or build_parser(description)
+    args = parser.parse_args(argv)
+
+    config = dict(DEFAULTS)
+    config.update(defaults or {})
+    if args.config:
+        with open(args.config, encoding='utf-8') as f:
+            config.update(json.load(f))
+
+    for key in DEFAULTS:
+        env_value = os.environ.get(f'OPENALEX_{key.upper()}')
+        if env_value is None and key in LEGACY_ENV:
+            env_value = os.environ.get(LEGACY_ENV[key])
+        if env_value is not None:
+            config[key] = env_value
+        if getattr(args, key) is not None:
+            config[key] = getattr(args, key)
+
+    for key in DEFAULTS:
+        config[key] = _convert(key, config[key])
+    if config['node_count'] > 1:
+        # 每个节点写自己的子目录, 多个节点可以共用同一个 csv_dir
+        multi_node.check_options(config, multi_node_output)
+        config['csv_dir'] = multi_node.node_dir(config['csv_dir'], config['node_index'])
+    config['temp_dir'] = config['temp_dir'] or config['csv_dir']
+    config['log_path'] = config['log_path'] or os.path.join(config['csv_dir'],
+                                                            'log.json')
+    config['args'] = args
+    object_store.configure(config)
+    return config
+
+
+def snapshot_files(config, entity):
+    # 快照目录结构: <snapshot_dir>/data/<entity>/updated_date=*/part_*.gz,
+    # snapshot_dir 也可以是 s3://bucket/prefix
+    files = object_store.find_files(config['snapshot_dir'], f'data/{entity}/*/*.gz')
+    if config['files_per_entity']:
+        files = files[:config['files_per_entity']]
+    # --node-count 时只返回分给本节点的文件
+    return multi_node.node_files(config, entity, files)
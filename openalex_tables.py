@@ -0,0 +1,370 @@
+import os
+
+# 所有实体/表的输出文件和列定义, 各个脚本共用.
+# csv_files[entity][key] = {'name': <输出文件>, 'columns': [...]},
+# 输出文件名 (去掉 .csv.gz) 就是 openalex-pg-schema.sql 里的表名.
+
+
+def short_id(openalex_id):
+    # https://openalex.org/A5023888391 或 A5023888391 -> 5023888391,
+    # 用于按实体保存大量 id 时节省内存/空间
+    if not openalex_id:
+        return None
+    tail = openalex_id[openalex_id.rfind('/') + 1:]
+    return int(tail[1:]) if tail[1:].isdigit() else tail
+
+
+# 各实体 id 的首字母, 用于从 short_id 还原完整 id
+ID_LETTERS = {
+    'works': 'W', 'authors': 'A', 'sources': 'S', 'institutions': 'I', 'concepts': 'C',
+    'publishers': 'P', 'funders': 'F', 'topics': 'T',
+}
+
+
+def long_id(entity, number):
+    # 5023888391 -> https://openalex.org/A5023888391
+    return f'https://openalex.org/{ID_LETTERS[entity]}{number}'
+
+
+def build_csv_files(csv_dir, normalize_authorships=False, abstracts='inline'):
+    csv_files = {
+        'authors': {
+            'authors': {
+                'name': os.path.join(csv_dir, 'authors.csv.gz'),
+                'columns': [
+                    'id', 'orcid', 'display_name', 'display_name_alternatives',
+                    'works_count', 'cited_by_count',
+                    'last_known_institution', 'works_api_url', 'updated_date',
+                ]
+            },
+            'ids': {
+                'name': os.path.join(csv_dir, 'authors_ids.csv.gz'),
+                'columns': [
+                    'author_id', 'openalex', 'orcid', 'scopus', 'twitter',
+                    'wikipedia', 'mag'
+                ]
+            },
+            'counts_by_year': {
+                'name': os.path.join(csv_dir, 'authors_counts_by_year.csv.gz'),
+                'columns': [
+                    'author_id', 'year', 'works_count', 'cited_by_count',
+                    'oa_works_count'
+                ]
+            }
+        },
+        'concepts': {
+            'concepts': {
+                'name': os.path.join(csv_dir, 'concepts.csv.gz'),
+                'columns': [
+                    'id', 'wikidata', 'display_name', 'level', 'description',
+                    'works_count', 'cited_by_count', 'image_url',
+                    'image_thumbnail_url', 'works_api_url', 'updated_date'
+                ]
+            },
+            'ancestors': {
+                'name': os.path.join(csv_dir, 'concepts_ancestors.csv.gz'),
+                'columns': ['concept_id', 'ancestor_id']
+            },
+            'counts_by_year': {
+                'name': os.path.join(csv_dir, 'concepts_counts_by_year.csv.gz'),
+                'columns': ['concept_id', 'year', 'works_count', 'cited_by_count',
+                            'oa_works_count']
+            },
+            'ids': {
+                'name': os.path.join(csv_dir, 'concepts_ids.csv.gz'),
+                'columns': ['concept_id', 'openalex', 'wikidata', 'wikipedia',
+                            'umls_aui', 'umls_cui', 'mag']
+            },
+            'related_concepts': {
+                'name': os.path.join(csv_dir, 'concepts_related_concepts.csv.gz'),
+                'columns': ['concept_id', 'related_concept_id', 'score']
+            }
+        },
+        'topics': {
+            'topics': {
+                'name': os.path.join(csv_dir, 'topics.csv.gz'),
+                'columns': ['id', 'display_name', 'subfield_id',
+                            'subfield_display_name', 'field_id',
+                            'field_display_name',
+                            'domain_id', 'domain_display_name', 'description',
+                            'keywords', 'works_api_url', 'wikipedia_id',
+                            'works_count', 'cited_by_count', 'updated_date', 'siblings']
+            }
+        },
+        'institutions': {
+            'institutions': {
+                'name': os.path.join(csv_dir, 'institutions.csv.gz'),
+                'columns': [
+                    'id', 'ror', 'display_name', 'country_code', 'type',
+                    'homepage_url', 'image_url', 'image_thumbnail_url',
+                    'display_name_acronyms', 'display_name_alternatives',
+                    'works_count', 'cited_by_count', 'works_api_url',
+                    'updated_date'
+                ]
+            },
+            'ids': {
+                'name': os.path.join(csv_dir, 'institutions_ids.csv.gz'),
+                'columns': [
+                    'institution_id', 'openalex', 'ror', 'grid', 'wikipedia',
+                    'wikidata', 'mag'
+                ]
+            },
+            'geo': {
+                'name': os.path.join(csv_dir, 'institutions_geo.csv.gz'),
+                'columns': [
+                    'institution_id', 'city', 'geonames_city_id', 'region',
+                    'country_code', 'country', 'latitude',
+                    'longitude'
+                ]
+            },
+            'associated_institutions': {
+                'name': os.path.join(csv_dir,
+                                     'institutions_associated_institutions.csv.gz'),
+                'columns': [
+                    'institution_id', 'associated_institution_id', 'relationship'
+                ]
+            },
+            'counts_by_year': {
+                'name': os.path.join(csv_dir, 'institutions_counts_by_year.csv.gz'),
+                'columns': [
+                    'institution_id', 'year', 'works_count', 'cited_by_count',
+                    'oa_works_count'
+                ]
+            }
+        },
+        'publishers': {
+            'publishers': {
+                'name': os.path.join(csv_dir, 'publishers.csv.gz'),
+                'columns': [
+                    'id', 'display_name', 'alternate_titles', 'country_codes',
+                    'hierarchy_level', 'parent_publisher',
+                    'works_count', 'cited_by_count', 'sources_api_url',
+                    'updated_date'
+                ]
+            },
+            'counts_by_year': {
+                'name': os.path.join(csv_dir, 'publishers_counts_by_year.csv.gz'),
+                'columns': ['publisher_id', 'year', 'works_count', 'cited_by_count',
+                            'oa_works_count']
+            },
+            'ids': {
+                'name': os.path.join(csv_dir, 'publishers_ids.csv.gz'),
+                'columns': ['publisher_id', 'openalex', 'ror', 'wikidata']
+            },
+        },
+        'sources': {
+            'sources': {
+                'name': os.path.join(csv_dir, 'sources.csv.gz'),
+                'columns': [
+                    'id', 'issn_l', 'issn', 'display_name', 'publisher',
+                    'works_count', 'cited_by_count', 'is_oa',
+                    'is_in_doaj', 'homepage_url', 'works_api_url', 'updated_date'
+                ]
+            },
+            'ids': {
+                'name': os.path.join(csv_dir, 'sources_ids.csv.gz'),
+                'columns': ['source_id', 'openalex', 'issn_l', 'issn', 'mag',
+                            'wikidata', 'fatcat']
+            },
+            'counts_by_year': {
+                'name': os.path.join(csv_dir, 'sources_counts_by_year.csv.gz'),
+                'columns': ['source_id', 'year', 'works_count', 'cited_by_count',
+                            'oa_works_count']
+            },
+        },
+        'works': {
+            'works': {
+                'name': os.path.join(csv_dir, 'works.csv.gz'),
+                'columns': [
+                    'id', 'doi', 'title', 'display_name', 'publication_year',
+                    'publication_date', 'type', 'cited_by_count',
+                    'is_retracted', 'is_paratext', 'cited_by_api_url',
+                    'abstract_inverted_index', 'language'
+                ]
+            },
+            'primary_locations': {
+                'name': os.path.join(csv_dir, 'works_primary_locations.csv.gz'),
+                'columns': [
+                    'work_id', 'source_id', 'landing_page_url', 'pdf_url', 'is_oa',
+                    'version', 'license'
+                ]
+            },
+            'locations': {
+                'name': os.path.join(csv_dir, 'works_locations.csv.gz'),
+                'columns': [
+                    'work_id', 'source_id', 'landing_page_url', 'pdf_url', 'is_oa',
+                    'version', 'license'
+                ]
+            },
+            'best_oa_locations': {
+                'name': os.path.join(csv_dir, 'works_best_oa_locations.csv.gz'),
+                'columns': [
+                    'work_id', 'source_id', 'landing_page_url', 'pdf_url', 'is_oa',
+                    'version', 'license'
+                ]
+            },
+            'authorships': {
+                'name': os.path.join(csv_dir, 'works_authorships.csv.gz'),
+                'columns': [
+                    'work_id', 'author_position', 'author_id', 'institution_id',
+                    'raw_affiliation_string'
+                ]
+            },
+            'biblio': {
+                'name': os.path.join(csv_dir, 'works_biblio.csv.gz'),
+                'columns': [
+                    'work_id', 'volume', 'issue', 'first_page', 'last_page'
+                ]
+            },
+            'topics': {
+                'name': os.path.join(csv_dir, 'works_topics.csv.gz'),
+                'columns': [
+                    'work_id', 'topic_id', 'score'
+                ]
+            },
+            'concepts': {
+                'name': os.path.join(csv_dir, 'works_concepts.csv.gz'),
+                'columns': [
+                    'work_id', 'concept_id', 'score'
+                ]
+            },
+            'ids': {
+                'name': os.path.join(csv_dir, 'works_ids.csv.gz'),
+                'columns': [
+                    'work_id', 'openalex', 'doi', 'mag', 'pmid', 'pmcid'
+                ]
+            },
+            'mesh': {
+                'name': os.path.join(csv_dir, 'works_mesh.csv.gz'),
+                'columns': [
+                    'work_id', 'descriptor_ui', 'descriptor_name', 'qualifier_ui',
+                    'qualifier_name', 'is_major_topic'
+                ]
+            },
+            'open_access': {
+                'name': os.path.join(csv_dir, 'works_open_access.csv.gz'),
+                'columns': [
+                    'work_id', 'is_oa', 'oa_status', 'oa_url',
+                    'any_repository_has_fulltext'
+                ]
+            },
+            'referenced_works': {
+                'name': os.path.join(csv_dir, 'works_referenced_works.csv.gz'),
+                'columns': [
+                    'work_id', 'referenced_work_id'
+                ]
+            },
+            'related_works': {
+                'name': os.path.join(csv_dir, 'works_related_works.csv.gz'),
+                'columns': [
+                    'work_id', 'related_work_id'
+                ]
+            },
+            'grants': {
+                'name': os.path.join(csv_dir, 'works_grants.csv.gz'),
+                'columns': [
+                    'work_id', 'funder', 'funder_display_name', 'award_id',
+                ]
+            },
+            'counts_by_year': {
+                'name': os.path.join(csv_dir, 'works_counts_by_year.csv.gz'),
+                'columns': [
+                    'work_id', 'year', 'cited_by_count'
+                ]
+            },
+            'more_info': {
+                'name': os.path.join(csv_dir, 'works_more_info.csv.gz'),
+                'columns': [
+                    'work_id', 'institutions_distinct_count',
+                    'countries_distinct_count', 'authors_count', 'fwci',
+                    'citation_normalized_percentile', 'top1_percentile',
+                    'top10_percentile'
+                ]
+            },
+        },
+        # 展开 works 时顺带计算的聚合表, 见 works_aggregates.py
+        'aggregates': {
+            'author_works_by_year': {
+                'name': os.path.join(csv_dir, 'agg_author_works_by_year.csv.gz'),
+                'columns': ['author_id', 'publication_year', 'works_count',
+                            'cited_by_count']
+            },
+            'institution_citations': {
+                'name': os.path.join(csv_dir, 'agg_institution_citations.csv.gz'),
+                'columns': ['institution_id', 'works_count', 'cited_by_count']
+            },
+            'source_works_by_year': {
+                'name': os.path.join(csv_dir, 'agg_source_works_by_year.csv.gz'),
+                'columns': ['source_id', 'publication_year', 'works_count',
+                            'cited_by_count']
+            },
+            'coauthor_counts': {
+                'name': os.path.join(csv_dir, 'agg_coauthor_counts.csv.gz'),
+                'columns': ['author_id', 'coauthor_id', 'works_count']
+            },
+        },
+        # 字典编码的维表 (id, value), 见 dictionary_encoding.py
+        'dimensions': {
+            dimension: {
+                'name': os.path.join(csv_dir, f'dim_{dimension}.csv.gz'),
+                'columns': ['id', 'value']
+            }
+            for dimension in ('license', 'version', 'raw_affiliation_string',
+                              'oa_status', 'mesh_descriptor_name')
+        },
+        'funders': {
+            'funders': {
+                'name': os.path.join(csv_dir, 'funders.csv.gz'),
+                'columns': ['id', 'display_name', 'country_code', 'country_id',
+                            'description', 'grants_count', 'works_count',
+                            'homepage_url']
+            },
+            'funders_id': {
+                'name': os.path.join(csv_dir, 'funders_id.csv.gz'),
+                'columns': ['funder_id', 'crossref_id', 'doi', 'ror',
+                            'wikidata']
+            }
+        },
+    }
+    if normalize_authorships:
+        csv_files['works'] = normalized_works(csv_files['works'], csv_dir)
+    if abstracts != 'inline':
+        csv_files['works'] = separate_abstracts(csv_files['works'], csv_dir, abstracts)
+    return csv_files
+
+
+def normalized_works(works, csv_dir):
+    # works_authorships 每个 authorship 只写一行, 以 (work_id, author_ordinal) 为键,
+    # 多个机构写到窄的链接表 works_authorships_institutions, 不再重复整行
+    normalized = {}
+    for key, spec in works.items():
+        if key != 'authorships':
+            normalized[key] = spec
+            continue
+        normalized['authorships'] = {
+            'name': spec['name'],
+            'columns': [
+                'work_id', 'author_ordinal', 'author_position', 'author_id',
+                'raw_affiliation_string'
+            ]
+        }
+        normalized['authorships_institutions'] = {
+            'name': os.path.join(csv_dir, 'works_authorships_institutions.csv.gz'),
+            'columns': ['work_id', 'author_ordinal', 'institution_id']
+        }
+    return normalized
+
+
+def separate_abstracts(works, csv_dir, abstracts):
+    # 摘要写到单独的 works_abstracts 表, works 表只剩窄列; 格式见 abstract_encoding.py
+    if abstracts not in ('json', 'text', 'binary'):
+        raise ValueError(f'unknown abstracts format: {abstracts} (choose from inline, json, text, binary)')
+    works = dict(works)
+    works['works'] = dict(works['works'], columns=[
+        c for c in works['works']['columns'] if c != 'abstract_inverted_index'])
+    works['abstracts'] = {
+        'name': os.path.join(csv_dir, 'works_abstracts.csv.gz'),
+        'columns': ['work_id', 'abstract'],
+        'format': abstracts,
+    }
+    return works
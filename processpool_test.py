@@ -1,475 +1,259 @@
 from concurrent.futures import ProcessPoolExecutor, as_completed
 import time
 import os
-import json
-import glob
-import csv
-import gzip
-
-SNAPSHOT_DIR = 'E:/openalex_data'
-CSV_DIR = 'E:/openalex_csv'
-
-csv_files = {
-    'works': {
-        'works': {
-            'name': os.path.join(CSV_DIR, 'works.csv.gz'),
-            'columns': [
-                'id', 'doi', 'title', 'display_name', 'publication_year',
-                'publication_date', 'type', 'cited_by_count',
-                'is_retracted', 'is_paratext', 'cited_by_api_url',
-                'abstract_inverted_index', 'language'
-            ]
-        },
-        'primary_locations': {
-            'name': os.path.join(CSV_DIR, 'works_primary_locations.csv.gz'),
-            'columns': [
-                'work_id', 'source_id', 'landing_page_url', 'pdf_url', 'is_oa',
-                'version', 'license'
-            ]
-        },
-        'locations': {
-            'name': os.path.join(CSV_DIR, 'works_locations.csv.gz'),
-            'columns': [
-                'work_id', 'source_id', 'landing_page_url', 'pdf_url', 'is_oa',
-                'version', 'license'
-            ]
-        },
-        'best_oa_locations': {
-            'name': os.path.join(CSV_DIR, 'works_best_oa_locations.csv.gz'),
-            'columns': [
-                'work_id', 'source_id', 'landing_page_url', 'pdf_url', 'is_oa',
-                'version', 'license'
-            ]
-        },
-        'authorships': {
-            'name': os.path.join(CSV_DIR, 'works_authorships.csv.gz'),
-            'columns': [
-                'work_id', 'author_position', 'author_id', 'institution_id',
-                'raw_affiliation_string'
-            ]
-        },
-        'biblio': {
-            'name': os.path.join(CSV_DIR, 'works_biblio.csv.gz'),
-            'columns': [
-                'work_id', 'volume', 'issue', 'first_page', 'last_page'
-            ]
-        },
-        'topics': {
-            'name': os.path.join(CSV_DIR, 'works_topics.csv.gz'),
-            'columns': [
-                'work_id', 'topic_id', 'score'
-            ]
-        },
-        'concepts': {
-            'name': os.path.join(CSV_DIR, 'works_concepts.csv.gz'),
-            'columns': [
-                'work_id', 'concept_id', 'score'
-            ]
-        },
-        'ids': {
-            'name': os.path.join(CSV_DIR, 'works_ids.csv.gz'),
-            'columns': [
-                'work_id', 'openalex', 'doi', 'mag', 'pmid', 'pmcid'
-            ]
-        },
-        'mesh': {
-            'name': os.path.join(CSV_DIR, 'works_mesh.csv.gz'),
-            'columns': [
-                'work_id', 'descriptor_ui', 'descriptor_name', 'qualifier_ui',
-                'qualifier_name', 'is_major_topic'
-            ]
-        },
-        'open_access': {
-            'name': os.path.join(CSV_DIR, 'works_open_access.csv.gz'),
-            'columns': [
-                'work_id', 'is_oa', 'oa_status', 'oa_url',
-                'any_repository_has_fulltext'
-            ]
-        },
-        'referenced_works': {
-            'name': os.path.join(CSV_DIR, 'works_referenced_works.csv.gz'),
-            'columns': [
-                'work_id', 'referenced_work_id'
-            ]
-        },
-        'related_works': {
-            'name': os.path.join(CSV_DIR, 'works_related_works.csv.gz'),
-            'columns': [
-                'work_id', 'related_work_id'
-            ]
-        },
-    },
-}
+import shutil
+
+import arrow_engine
+import change_detection
+import citation_graph
+import dictionary_encoding
+import merged_ids
+import progress
+import sort_output
+import works_aggregates
+import year_partitions
+from gz_members import rows_to_member
+from object_store import stat
+from openalex_config import load_config, snapshot_files
+from openalex_tables import build_csv_files
+from row_filter import compile_filter
+from shard_manifest import (ShardFile, add_shard, generate_load_scripts,
+                            new_manifest, table_name, write_manifest)
+from works_extract import extract_file
+
+config = load_config(description='Flatten OpenAlex works with a process pool.', multi_node_output=True)
+SNAPSHOT_DIR = config['snapshot_dir']
+CSV_DIR = config['csv_dir']
+COMPRESSLEVEL = config['compresslevel']
+
+# 每个输入文件单独输出一组分片, 而不是每个表合并成一个文件
+SHARD_OUTPUT = config['shard_output']
+
+# --where 过滤条件, 被拒绝的记录不做 json.loads; --merged-ids 时同时丢弃被合并掉的 id
+ROW_FILTER = merged_ids.entity_filter(config, 'works', compile_filter(config['where']))
+
+# 引用图 CSR 输出目录 (见 citation_graph.py), 空表示不导出
+CITATION_GRAPH = config['citation_graph']
+if CITATION_GRAPH:
+    citation_graph.check_memory(config['graph_memory'])
+
+# 展开时顺带计算的聚合表 (见 works_aggregates.py), 部分结果溢写到临时目录
+AGGREGATES = works_aggregates.parse_aggregates(config['aggregates'])
+AGGREGATE_PARTITIONS = config['aggregate_partitions']
+SPILL_DIR = os.path.join(config['temp_dir'], 'aggregates-spill')
+
+# 字典编码的维度 (见 dictionary_encoding.py), 编码表先用局部编码溢写, 最后换成全局编码
+DIMENSIONS = dictionary_encoding.parse_dimensions(config['dictionary_encode'])
+DICTIONARY_SPILL_DIR = os.path.join(config['temp_dir'], 'dictionary-spill')
+
+# 输出按第一列排序 / 哈希分区 (见 sort_output.py), 在所有表写完后进行
+SORT_OUTPUT = config['sort_output']
+HASH_PARTITIONS = config['hash_partitions']
+
+# 按 publication_year 区间分区输出 (见 year_partitions.py), 每个表每个区间一个文件
+YEAR_BOUNDARIES = year_partitions.parse_boundaries(config['year_partitions'])
+PARTITIONER = year_partitions.YearPartitioner(YEAR_BOUNDARIES) if YEAR_BOUNDARIES else None
+
+# 增量输出 (见 change_detection.py): 只处理变化的 part 文件, 只写新增/变化的记录
+CHANGE_STORE = config['change_store']
+if CHANGE_STORE:
+    change_detection.check_options(config)
+
+csv_files = build_csv_files(CSV_DIR, config['normalize_authorships'], config['abstracts'])
+# 输出的列定义: 编码列改名为 <列名>_id, 分区时子表末尾加 publication_year
+output_spec = dictionary_encoding.encoded_spec(csv_files['works'], DIMENSIONS)
+if PARTITIONER:
+    output_spec = year_partitions.partitioned_spec(output_spec)
+
+
+def output_keys():
+    # 分区时 key 是 (表 key, 区间名)
+    if PARTITIONER:
+        return [(key, part) for key in output_spec for part in PARTITIONER.parts]
+    return list(output_spec)
+
+
+def output_file(key):
+    """输出 key -> (文件名, 列)."""
+    spec = output_spec[year_partitions.table_key(key)]
+    if isinstance(key, tuple):
+        return year_partitions.partition_path(spec['name'], key[1]), spec['columns']
+    return spec['name'], spec['columns']
 
-def flatten_works():
-    file_spec = csv_files['works']
-
-    with gzip.open(file_spec['works']['name'], 'wt',
-                   encoding='utf-8') as works_csv, \
-            gzip.open(file_spec['primary_locations']['name'], 'wt',
-                      encoding='utf-8') as primary_locations_csv, \
-            gzip.open(file_spec['locations']['name'], 'wt',
-                      encoding='utf-8') as locations, \
-            gzip.open(file_spec['best_oa_locations']['name'], 'wt',
-                      encoding='utf-8') as best_oa_locations, \
-            gzip.open(file_spec['authorships']['name'], 'wt',
-                      encoding='utf-8') as authorships_csv, \
-            gzip.open(file_spec['biblio']['name'], 'wt',
-                      encoding='utf-8') as biblio_csv, \
-            gzip.open(file_spec['topics']['name'], 'wt',
-                      encoding='utf-8') as topics_csv, \
-            gzip.open(file_spec['concepts']['name'], 'wt',
-                      encoding='utf-8') as concepts_csv, \
-            gzip.open(file_spec['ids']['name'], 'wt',
-                      encoding='utf-8') as ids_csv, \
-            gzip.open(file_spec['mesh']['name'], 'wt',
-                      encoding='utf-8') as mesh_csv, \
-            gzip.open(file_spec['open_access']['name'], 'wt',
-                      encoding='utf-8') as open_access_csv, \
-            gzip.open(file_spec['referenced_works']['name'], 'wt',
-                      encoding='utf-8') as referenced_works_csv, \
-            gzip.open(file_spec['related_works']['name'], 'wt',
-                      encoding='utf-8') as related_works_csv:
-
-        works_writer = init_dict_writer(works_csv, file_spec['works'],
-                                        extrasaction='ignore')
-        primary_locations_writer = init_dict_writer(primary_locations_csv,
-                                                    file_spec[
-                                                        'primary_locations'])
-        locations_writer = init_dict_writer(locations, file_spec['locations'])
-        best_oa_locations_writer = init_dict_writer(best_oa_locations,
-                                                    file_spec[
-                                                        'best_oa_locations'])
-        authorships_writer = init_dict_writer(authorships_csv,
-                                              file_spec['authorships'])
-        biblio_writer = init_dict_writer(biblio_csv, file_spec['biblio'])
-        topics_writer = init_dict_writer(topics_csv, file_spec['topics'])
-        concepts_writer = init_dict_writer(concepts_csv, file_spec['concepts'])
-        ids_writer = init_dict_writer(ids_csv, file_spec['ids'],
-                                      extrasaction='ignore')
-        mesh_writer = init_dict_writer(mesh_csv, file_spec['mesh'])
-        open_access_writer = init_dict_writer(open_access_csv,
-                                              file_spec['open_access'])
-        referenced_works_writer = init_dict_writer(referenced_works_csv,
-                                                   file_spec[
-                                                       'referenced_works'])
-        related_works_writer = init_dict_writer(related_works_csv,
-                                                file_spec['related_works'])
-
-        for jsonl_file_name in glob.glob(
-                os.path.join(SNAPSHOT_DIR, 'data', 'works', '*', '*.gz')):
-            print(jsonl_file_name)
-            with gzip.open(jsonl_file_name, 'r') as works_jsonl:
-                for work_json in works_jsonl:
-                    if not work_json.strip():
-                        continue
-
-                    work = json.loads(work_json)
-
-                    if not (work_id := work.get('id')):
-                        continue
-
-                    # works
-                    if (abstract := work.get(
-                            'abstract_inverted_index')) is not None:
-                        work['abstract_inverted_index'] = json.dumps(abstract,
-                                                                     ensure_ascii=False)
-
-                    works_writer.writerow(work)
-
-                    # primary_locations
-                    if primary_location := (work.get('primary_location') or {}):
-                        if primary_location.get(
-                                'source') and primary_location.get(
-                                'source').get('id'):
-                            primary_locations_writer.writerow({
-                                'work_id': work_id,
-                                'source_id': primary_location['source']['id'],
-                                'landing_page_url': primary_location.get(
-                                    'landing_page_url'),
-                                'pdf_url': primary_location.get('pdf_url'),
-                                'is_oa': primary_location.get('is_oa'),
-                                'version': primary_location.get('version'),
-                                'license': primary_location.get('license'),
-                            })
-
-                    # locations
-                    if locations := work.get('locations'):
-                        for location in locations:
-                            if location.get('source') and location.get(
-                                    'source').get('id'):
-                                locations_writer.writerow({
-                                    'work_id': work_id,
-                                    'source_id': location['source']['id'],
-                                    'landing_page_url': location.get(
-                                        'landing_page_url'),
-                                    'pdf_url': location.get('pdf_url'),
-                                    'is_oa': location.get('is_oa'),
-                                    'version': location.get('version'),
-                                    'license': location.get('license'),
-                                })
-
-                    # best_oa_locations
-                    if best_oa_location := (work.get('best_oa_location') or {}):
-                        if best_oa_location.get(
-                                'source') and best_oa_location.get(
-                                'source').get('id'):
-                            best_oa_locations_writer.writerow({
-                                'work_id': work_id,
-                                'source_id': best_oa_location['source']['id'],
-                                'landing_page_url': best_oa_location.get(
-                                    'landing_page_url'),
-                                'pdf_url': best_oa_location.get('pdf_url'),
-                                'is_oa': best_oa_location.get('is_oa'),
-                                'version': best_oa_location.get('version'),
-                                'license': best_oa_location.get('license'),
-                            })
-
-                    # authorships
-                    if authorships := work.get('authorships'):
-                        for authorship in authorships:
-                            if author_id := authorship.get('author', {}).get(
-                                    'id'):
-                                institutions = authorship.get('institutions')
-                                institution_ids = [i.get('id') for i in
-                                                   institutions]
-                                institution_ids = [i for i in institution_ids if
-                                                   i]
-                                institution_ids = institution_ids or [None]
-
-                                for institution_id in institution_ids:
-                                    authorships_writer.writerow({
-                                        'work_id': work_id,
-                                        'author_position': authorship.get(
-                                            'author_position'),
-                                        'author_id': author_id,
-                                        'institution_id': institution_id,
-                                        'raw_affiliation_string': authorship.get(
-                                            'raw_affiliation_string'),
-                                    })
-
-                    # biblio
-                    if biblio := work.get('biblio'):
-                        biblio['work_id'] = work_id
-                        biblio_writer.writerow(biblio)
-
-                    # topics
-                    for topic in work.get('topics', []):
-                        if topic_id := topic.get('id'):
-                            topics_writer.writerow({
-                                'work_id': work_id,
-                                'topic_id': topic_id,
-                                'score': topic.get('score')
-                            })
-
-                    # concepts
-                    for concept in work.get('concepts'):
-                        if concept_id := concept.get('id'):
-                            concepts_writer.writerow({
-                                'work_id': work_id,
-                                'concept_id': concept_id,
-                                'score': concept.get('score'),
-                            })
-
-                    # ids
-                    if ids := work.get('ids'):
-                        ids['work_id'] = work_id
-                        ids_writer.writerow(ids)
-
-                    # mesh
-                    for mesh in work.get('mesh'):
-                        mesh['work_id'] = work_id
-                        mesh_writer.writerow(mesh)
-
-                    # open_access
-                    if open_access := work.get('open_access'):
-                        open_access['work_id'] = work_id
-                        open_access_writer.writerow(open_access)
-
-                    # referenced_works
-                    for referenced_work in work.get('referenced_works'):
-                        if referenced_work:
-                            referenced_works_writer.writerow({
-                                'work_id': work_id,
-                                'referenced_work_id': referenced_work
-                            })
-
-                    # related_works
-                    for related_work in work.get('related_works'):
-                        if related_work:
-                            related_works_writer.writerow({
-                                'work_id': work_id,
-                                'related_work_id': related_work
-                            })
-
-
-def init_dict_writer(csv_file, file_spec, **kwargs):
-    writer = csv.DictWriter(
-        csv_file, fieldnames=file_spec['columns'], **kwargs
-    )
-    writer.writeheader()
-    return writer
 
 def process_file(jsonl_file_name):
     file_spec = csv_files['works']
-    results = []
-
-    with gzip.open(jsonl_file_name, 'r') as works_jsonl:
-        for work_json in works_jsonl:
-            if not work_json.strip():
-                continue
-
-            work = json.loads(work_json)
-
-            if not (work_id := work.get('id')):
-                continue
-
-            # works
-            if (abstract := work.get('abstract_inverted_index')) is not None:
-                work['abstract_inverted_index'] = json.dumps(abstract, ensure_ascii=False)
-
-            results.append(('works', work))
-
-            # primary_locations
-            if primary_location := (work.get('primary_location') or {}):
-                if primary_location.get('source') and primary_location.get('source').get('id'):
-                    results.append(('primary_locations', {
-                        'work_id': work_id,
-                        'source_id': primary_location['source']['id'],
-                        'landing_page_url': primary_location.get('landing_page_url'),
-                        'pdf_url': primary_location.get('pdf_url'),
-                        'is_oa': primary_location.get('is_oa'),
-                        'version': primary_location.get('version'),
-                        'license': primary_location.get('license'),
-                    }))
-
-            # locations
-            if locations := work.get('locations'):
-                for location in locations:
-                    if location.get('source') and location.get('source').get('id'):
-                        results.append(('locations', {
-                            'work_id': work_id,
-                            'source_id': location['source']['id'],
-                            'landing_page_url': location.get('landing_page_url'),
-                            'pdf_url': location.get('pdf_url'),
-                            'is_oa': location.get('is_oa'),
-                            'version': location.get('version'),
-                            'license': location.get('license'),
-                        }))
-
-            # best_oa_locations
-            if best_oa_location := (work.get('best_oa_location') or {}):
-                if best_oa_location.get('source') and best_oa_location.get('source').get('id'):
-                    results.append(('best_oa_locations', {
-                        'work_id': work_id,
-                        'source_id': best_oa_location['source']['id'],
-                        'landing_page_url': best_oa_location.get('landing_page_url'),
-                        'pdf_url': best_oa_location.get('pdf_url'),
-                        'is_oa': best_oa_location.get('is_oa'),
-                        'version': best_oa_location.get('version'),
-                        'license': best_oa_location.get('license'),
-                    }))
-
-            # authorships
-            if authorships := work.get('authorships'):
-                for authorship in authorships:
-                    if author_id := authorship.get('author', {}).get('id'):
-                        institutions = authorship.get('institutions')
-                        institution_ids = [i.get('id') for i in institutions]
-                        institution_ids = [i for i in institution_ids if i]
-                        institution_ids = institution_ids or [None]
-
-                        for institution_id in institution_ids:
-                            results.append(('authorships', {
-                                'work_id': work_id,
-                                'author_position': authorship.get('author_position'),
-                                'author_id': author_id,
-                                'institution_id': institution_id,
-                                'raw_affiliation_string': authorship.get('raw_affiliation_string'),
-                            }))
-
-            # biblio
-            if biblio := work.get('biblio'):
-                biblio['work_id'] = work_id
-                results.append(('biblio', biblio))
-
-            # topics
-            for topic in work.get('topics', []):
-                if topic_id := topic.get('id'):
-                    results.append(('topics', {
-                        'work_id': work_id,
-                        'topic_id': topic_id,
-                        'score': topic.get('score')
-                    }))
-
-            # concepts
-            for concept in work.get('concepts'):
-                if concept_id := concept.get('id'):
-                    results.append(('concepts', {
-                        'work_id': work_id,
-                        'concept_id': concept_id,
-                        'score': concept.get('score'),
-                    }))
-
-            # ids
-            if ids := work.get('ids'):
-                ids['work_id'] = work_id
-                results.append(('ids', ids))
-
-            # mesh
-            for mesh in work.get('mesh'):
-                mesh['work_id'] = work_id
-                results.append(('mesh', mesh))
-
-            # open_access
-            if open_access := work.get('open_access'):
-                open_access['work_id'] = work_id
-                results.append(('open_access', open_access))
-
-            # referenced_works
-            for referenced_work in work.get('referenced_works'):
-                if referenced_work:
-                    results.append(('referenced_works', {
-                        'work_id': work_id,
-                        'referenced_work_id': referenced_work
-                    }))
-
-            # related_works
-            for related_work in work.get('related_works'):
-                if related_work:
-                    results.append(('related_works', {
-                        'work_id': work_id,
-                        'related_work_id': related_work
-                    }))
-
-    return jsonl_file_name, results
-
-def custom_callback(future):
-    jsonl_file_name, results = future.result()
-    base_name = os.path.basename(jsonl_file_name).replace('.gz', '')
-    output_dir = os.path.join(CSV_DIR, base_name)
-    os.makedirs(output_dir, exist_ok=True)
-
-    writers = {}
-    for key, file_spec in csv_files['works'].items():
-        file_path = os.path.join(output_dir, f"{key}.csv.gz")
-        writers[key] = init_dict_writer(gzip.open(file_path, 'wt', encoding='utf-8'), file_spec)
-
-    for result_type, result in results:
-        writers[result_type].writerow(result)
-
-    for writer in writers.values():
-        writer.writer.writer.close()
+    encoder = dictionary_encoding.LocalEncoder(DIMENSIONS) if DIMENSIONS else None
+    if arrow_engine.use_arrow(config, 'works'):
+        # 多个块的 member 直接拼接, 仍然是合法的 gzip 数据
+        members = arrow_engine.flatten_file_members('works', jsonl_file_name, file_spec, COMPRESSLEVEL,
+                                                   row_filter=ROW_FILTER, encoder=encoder,
+                                                   partitioner=PARTITIONER, output_spec=output_spec)
+        members = {key: (sum(rows for rows, _ in table_members),
+                         b''.join(member for _, member in table_members))
+                   for key, table_members in members.items() if table_members}
+        results = None
+    else:
+        # 一次读取同时产出 csv_files['works'] 的全部 16 个表
+        results = extract_file(jsonl_file_name, file_spec, ROW_FILTER)
+        if encoder is not None:
+            results = {key: encoder.encode_rows(key, rows) for key, rows in results.items()}
+
+        # 每个表在 worker 进程里各自压缩成一个 gzip member, 主进程只负责追加写入
+        parts = PARTITIONER.split_rows(results) if PARTITIONER else results
+        members = {key: (len(rows), rows_to_member(rows, output_file(key)[1], COMPRESSLEVEL))
+                   for key, rows in parts.items() if rows}
+
+    # 引用图和聚合按表读取, 各年份区间的 member 拼接起来即可
+    tables = year_partitions.join_parts(members) if PARTITIONER else members
+    if CITATION_GRAPH:
+        citation_graph.write_run(CITATION_GRAPH, shard_name(jsonl_file_name), tables, output_spec)
+    if AGGREGATES:
+        works_aggregates.map_file(tables, output_spec, results, SPILL_DIR, shard_name(jsonl_file_name),
+                                  AGGREGATES, AGGREGATE_PARTITIONS)
+    if encoder is not None:
+        encoded = {key: members.pop(key) for key in list(members)
+                   if year_partitions.table_key(key) in encoder.columns}
+        dictionary_encoding.spill_shard(DICTIONARY_SPILL_DIR, shard_name(jsonl_file_name), encoded,
+                                        encoder.dictionaries())
+    if CHANGE_STORE:
+        members, hashes, changes = change_detection.filter_members(members, CHANGE_STORE, 'works', COMPRESSLEVEL)
+        return jsonl_file_name, members, (hashes, changes)
+    return jsonl_file_name, members, None
+
+
+def shard_name(jsonl_file_name):
+    # updated_date=2024-01-01/part_000.gz -> updated_date=2024-01-01_part_000
+    partition = os.path.basename(os.path.dirname(jsonl_file_name))
+    return f"{partition}_{os.path.basename(jsonl_file_name).replace('.gz', '')}"
+
+
+def custom_callback(future, outfiles, manifest, store=None, changes_file=None):
+    jsonl_file_name, members, changes = future.result()
+    print(jsonl_file_name)
+    write_members(shard_name(jsonl_file_name), members, outfiles, manifest)
+    progress.add('files')
+    progress.add('bytes', stat(jsonl_file_name)[0])
+    if changes is not None:
+        hashes, rows = changes
+        store.record(jsonl_file_name, hashes)
+        if rows:
+            changes_file.write(rows_to_member(rows, change_detection.CHANGES_COLUMNS, COMPRESSLEVEL), len(rows))
+
+
+def write_members(shard_name, members, outfiles, manifest):
+    for key, (rows, member) in members.items():
+        progress.add(f'rows:{table_name(output_file(key)[0])}', rows)
+        if SHARD_OUTPUT:
+            # 每个输入文件一个分片: CSV_DIR/<table>/<shard>.csv.gz
+            name, columns = output_file(key)
+            table = table_name(name)
+            shard = ShardFile(os.path.join(CSV_DIR, table, f'{shard_name}.csv.gz'), columns, COMPRESSLEVEL)
+            shard.write(member, rows)
+            add_shard(manifest, table, columns, shard.close())
+        else:
+            outfiles[key].write(member, rows)
+
+
+def encode_dimensions(outfiles, manifest):
+    # 按分片名顺序合并局部字典 (全局编码与 worker 完成的先后无关), 同时并行替换编码
+    dictionary = dictionary_encoding.GlobalDictionary(DIMENSIONS)
+    with ProcessPoolExecutor(max_workers=config['workers']) as executor:
+        futures = []
+        for shard in dictionary_encoding.spilled_shards(DICTIONARY_SPILL_DIR):
+            mapping = dictionary.merge(dictionary_encoding.load_dictionaries(DICTIONARY_SPILL_DIR, shard))
+            futures.append(executor.submit(dictionary_encoding.remap_shard, DICTIONARY_SPILL_DIR, shard,
+                                           mapping, csv_files['works'], DIMENSIONS, COMPRESSLEVEL))
+        for future in as_completed(futures):
+            shard, members = future.result()
+            write_members(shard, members, outfiles, manifest)
+
+    for dimension, entry in dictionary.write(csv_files['dimensions'], COMPRESSLEVEL).items():
+        spec = csv_files['dimensions'][dimension]
+        add_shard(manifest, table_name(spec['name']), spec['columns'], entry)
+    with open(os.path.join(CSV_DIR, 'dictionary-schema.sql'), 'w') as f:
+        f.write(dictionary_encoding.dictionary_schema(DIMENSIONS, csv_files))
 
 
 def flatten_works():
-    with ProcessPoolExecutor() as executor:
-        futures = [executor.submit(process_file, jsonl_file_name) for jsonl_file_name in glob.glob(os.path.join(SNAPSHOT_DIR, 'data', 'works', '*', '*.gz'))]
-        for future in as_completed(futures):
-            future.add_done_callback(custom_callback)
+    manifest = new_manifest()
+    if CITATION_GRAPH:
+        # 上一次运行留下的 run 文件会混进新的图
+        shutil.rmtree(os.path.join(CITATION_GRAPH, 'runs'), ignore_errors=True)
+    if AGGREGATES:
+        works_aggregates.clear_spill(SPILL_DIR)
+    if DIMENSIONS:
+        dictionary_encoding.clear_spill(DICTIONARY_SPILL_DIR)
+    # 不分片时每个表只有一个 .csv.gz, 由多个 gzip member 拼接而成, 表头只写一次
+    outfiles = {} if SHARD_OUTPUT else {
+        key: ShardFile(*output_file(key), COMPRESSLEVEL) for key in output_keys()
+    }
+    input_files = snapshot_files(config, 'works')
+    store = changes_file = changes_path = None
+    if CHANGE_STORE:
+        store = change_detection.ChangeStore(CHANGE_STORE, 'works', SNAPSHOT_DIR)
+        input_files = store.plan(input_files)
+        print(f'{len(input_files)} new or changed file(s)')
+        changes_file = ShardFile(os.path.join(CSV_DIR, 'works_changes.csv.gz'),
+                                 change_detection.CHANGES_COLUMNS, COMPRESSLEVEL)
+    # 进度计数器在共享内存里, worker 进程通过 initializer 拿到
+    counters = progress.Counters(sorted({table_name(output_file(key)[0]) for key in output_keys()}))
+    reporter = progress.Reporter(counters, 'works', len(input_files),
+                                 sum(stat(path)[0] for path in input_files),
+                                 config['progress_interval'], config['metrics_port']).start()
+    try:
+        with ProcessPoolExecutor(max_workers=config['workers'], initializer=progress.attach,
+                                 initargs=(counters,)) as executor:
+            futures = [executor.submit(process_file, jsonl_file_name) for jsonl_file_name in input_files]
+            for future in as_completed(futures):
+                custom_callback(future, outfiles, manifest, store, changes_file)
+        if CHANGE_STORE:
+            rows = change_detection.deleted_rows('works', store.deleted())
+            if rows:
+                changes_file.write(rows_to_member(rows, change_detection.CHANGES_COLUMNS, COMPRESSLEVEL), len(rows))
+            changes_path = changes_file.close()['path']
+            with open(os.path.join(CSV_DIR, 'changes-works.sql'), 'w') as f:
+                f.write(change_detection.changes_script(changes_path, csv_files['works']))
+        if DIMENSIONS:
+            encode_dimensions(outfiles, manifest)
+            dictionary_encoding.clear_spill(DICTIONARY_SPILL_DIR)
+    finally:
+        reporter.stop()
+        for key, outfile in outfiles.items():
+            name, columns = output_file(key)
+            add_shard(manifest, table_name(name), columns, outfile.close())
+
+    # reduce: 合并所有文件的部分聚合
+    for aggregate in AGGREGATES:
+        spec = csv_files['aggregates'][aggregate]
+        entry = works_aggregates.reduce_aggregate(SPILL_DIR, aggregate, spec, AGGREGATE_PARTITIONS, COMPRESSLEVEL)
+        add_shard(manifest, table_name(spec['name']), spec['columns'], entry)
+    if AGGREGATES:
+        works_aggregates.clear_spill(SPILL_DIR)
+
+    if SORT_OUTPUT or HASH_PARTITIONS:
+        manifest = sort_output.reorganize(manifest, CSV_DIR, SORT_OUTPUT, HASH_PARTITIONS, config['temp_dir'],
+                                          config['sort_memory'], COMPRESSLEVEL, config['workers'])
+
+    if PARTITIONER:
+        with open(os.path.join(CSV_DIR, 'partition-schema.sql'), 'w') as f:
+            f.write(PARTITIONER.schema(csv_files['works']))
+
+    write_manifest(manifest, os.path.join(CSV_DIR, 'manifest-works.json'))
+    if config['merged_ids']:
+        merged_ids.write_entity_deletes(config, 'works', csv_files['works'], ROW_FILTER)
+    # 分区后每个 psql 脚本导入一部分分区; 增量运行时校验脚本只检查变化的记录
+    generate_load_scripts(manifest, os.path.join(CSV_DIR, 'load-works.sql'), max(HASH_PARTITIONS, 1),
+                          changes_path=changes_path)
+
+    if CITATION_GRAPH:
+        citation_graph.build_csr(CITATION_GRAPH, config['temp_dir'], config['graph_memory'])
+    if CHANGE_STORE:
+        store.commit()
 
 
 if __name__ == '__main__':
+    os.makedirs(CSV_DIR, exist_ok=True)
     start = time.time()
     flatten_works()
     print(f"Time taken: {time.time() - start:.2f} seconds.")
\ No newline at end of file
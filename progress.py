@@ -0,0 +1,158 @@
+import multiprocessing
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# 运行进度 (--progress-interval 秒, --metrics-port 端口):
+#   计数器放在共享内存里 (multiprocessing.Array), 各个 worker 进程直接累加:
+#     files / bytes   处理完的输入文件数和它们的压缩字节数
+#     records         解析的记录数
+#     rows:<表名>     写出的行数
+#   主进程的后台线程定期打印一行进度: 速度按整个运行的平均值计算,
+#   ETA = 剩余输入文件的压缩字节数 / 平均字节速度. 超过 STALL_INTERVALS 个周期
+#   没有任何计数变化时提示可能卡住.
+#   --metrics-port 时在 127.0.0.1:<端口>/metrics 提供 Prometheus 文本格式的指标.
+
+STALL_INTERVALS = 6
+METRIC_PREFIX = 'openalex_flatten'
+
+_counters = None
+
+
+class Counters:
+    """跨进程的计数器, 作为参数或 initializer 参数传给子进程."""
+
+    def __init__(self, tables=()):
+        self.names = ['files', 'bytes', 'records'] + [f'rows:{table}' for table in tables]
+        self.index = {name: i for i, name in enumerate(self.names)}
+        self.values = multiprocessing.Array('q', len(self.names))
+
+    def add(self, name, n=1):
+        i = self.index.get(name)
+        if i is None or not n:
+            return
+        with self.values.get_lock():
+            self.values[i] += n
+
+    def snapshot(self):
+        with self.values.get_lock():
+            return dict(zip(self.names, self.values[:]))
+
+
+def attach(counters):
+    # 子进程里调用 (ProcessPoolExecutor 的 initializer), 之后 add() 写入共享计数器
+    global _counters
+    _counters = counters
+
+
+def add(name, n=1):
+    if _counters is not None:
+        _counters.add(name, n)
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    return f'{seconds // 3600}:{seconds // 60 % 60:02d}:{seconds % 60:02d}'
+
+
+class Reporter:
+    """主进程里的进度线程, 可选同时提供 /metrics."""
+
+    def __init__(self, counters, entity, total_files, total_bytes, interval=10, port=0):
+        self.counters = counters
+        self.entity = entity
+        self.total_files = total_files
+        self.total_bytes = total_bytes
+        self.interval = interval
+        self.port = port
+        self.started = time.time()
+        self.stop_event = threading.Event()
+        self.thread = None
+        self.server = None
+
+    def start(self):
+        attach(self.counters)
+        if self.interval:
+            self.thread = threading.Thread(target=self._run, daemon=True)
+            self.thread.start()
+        if self.port:
+            reporter = self
+
+            class Handler(BaseHTTPRequestHandler):
+                def log_message(self, *args):
+                    pass
+
+                def do_GET(self):
+                    if self.path.split('?')[0] != '/metrics':
+                        self.send_error(404)
+                        return
+                    body = reporter.metrics().encode('utf-8')
+                    self.send_response(200)
+                    self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+
+            self.server = ThreadingHTTPServer(('127.0.0.1', self.port), Handler)
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+            print(f'metrics on http://127.0.0.1:{self.port}/metrics')
+        return self
+
+    def stop(self):
+        self.stop_event.set()
+        if self.thread:
+            self.thread.join()
+        if self.server:
+            self.server.shutdown()
+        print(self.line(self.counters.snapshot()))
+
+    def eta(self, values):
+        elapsed = time.time() - self.started
+        if not values['bytes'] or not elapsed:
+            return None
+        return max(self.total_bytes - values['bytes'], 0) / (values['bytes'] / elapsed)
+
+    def line(self, values):
+        elapsed = max(time.time() - self.started, 1e-9)
+        rows = sum(value for name, value in values.items() if name.startswith('rows:'))
+        percent = 100 * values['bytes'] / self.total_bytes if self.total_bytes else 100.0
+        eta = self.eta(values)
+        return (f"[{self.entity}] {values['files']}/{self.total_files} files, "
+                f"{values['bytes'] / 1e9:.2f}/{self.total_bytes / 1e9:.2f} GB ({percent:.1f}%), "
+                f"{values['bytes'] / elapsed / 1e6:.1f} MB/s, {values['records'] / elapsed:,.0f} records/s, "
+                f"{rows / elapsed:,.0f} rows/s, elapsed {format_duration(elapsed)}"
+                + (f', ETA {format_duration(eta)}' if eta is not None else ''))
+
+    def _run(self):
+        previous = None
+        idle = 0
+        while not self.stop_event.wait(self.interval):
+            values = self.counters.snapshot()
+            idle = idle + 1 if values == previous else 0
+            previous = values
+            print(self.line(values) + (' (no progress, stalled?)' if idle >= STALL_INTERVALS else ''),
+                  flush=True)
+
+    def metrics(self):
+        values = self.counters.snapshot()
+        label = f'entity="{self.entity}"'
+        lines = []
+
+        def metric(name, kind, value, labels=label):
+            if not any(line.startswith(f'# TYPE {METRIC_PREFIX}_{name} ') for line in lines):
+                lines.append(f'# TYPE {METRIC_PREFIX}_{name} {kind}')
+            lines.append(f'{METRIC_PREFIX}_{name}{{{labels}}} {value}')
+
+        metric('input_files_total', 'counter', values['files'])
+        metric('input_files', 'gauge', self.total_files)
+        metric('input_bytes_total', 'counter', values['bytes'])
+        metric('input_bytes', 'gauge', self.total_bytes)
+        metric('records_total', 'counter', values['records'])
+        for name, value in values.items():
+            if name.startswith('rows:'):
+                metric('rows_total', 'counter', value, f'{label},table="{name[len("rows:"):]}"')
+        metric('elapsed_seconds', 'gauge', f'{time.time() - self.started:.1f}')
+        eta = self.eta(values)
+        if eta is not None:
+            metric('eta_seconds', 'gauge', f'{eta:.1f}')
+        return '\n'.join(lines) + '\n'
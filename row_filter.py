@@ -0,0 +1,168 @@
+import argparse
+import gzip
+import json
+import operator
+import re
+from json.decoder import scanstring
+
+# 行级过滤 (--where), 在完整 json.loads 之前尽量便宜地丢掉不需要的记录:
+#
+#   --where "publication_year>=2015 and type=article"
+#   --where "works_count>0"
+#   --where "primary_location.source.id=https://openalex.org/S137773608"
+#
+# 条件是 <字段><运算符><值>, 用 and 连接; 运算符为 = (==), !=, >, >=, <, <=.
+# 值按 JSON 解析 (2015, true, null, "a b"), 解析失败时当作字符串.
+# 字段不存在或为 null 时, 除 != 以外的条件都不成立.
+#
+# 每条记录分两步判断:
+#   1. 原始字节: 用正则找出该字段名 (点号路径的最后一段) 在整行里所有的标量值.
+#      顶层字段的值一定在其中, 如果没有一个候选值满足条件, 直接丢弃.
+#      候选值可能来自嵌套对象, 所以这一步只用来拒绝, 不用来接受.
+#   2. 部分解析: 从行首逐个扫描顶层 key, 只解析到条件涉及的字段都找到为止,
+#      后面的 authorships / abstract 等大字段不会被解析.
+
+OPERATORS = {
+    '=': operator.eq,
+    '==': operator.eq,
+    '!=': operator.ne,
+    '>': operator.gt,
+    '>=': operator.ge,
+    '<': operator.lt,
+    '<=': operator.le,
+}
+
+CONDITION = re.compile(r'^\s*([\w.]+)\s*(==|!=|>=|<=|=|>|<)\s*(.*?)\s*$')
+SCALAR = rb'("(?:[^"\\]|\\.)*"|-?\d[\d.eE+-]*|true|false|null)'
+WHITESPACE = re.compile(r'[ \t\n\r]*')
+
+_scan_once = json.JSONDecoder().scan_once
+
+
+class Condition:
+    def __init__(self, path, op, value):
+        self.path = path.split('.')
+        self.op = op
+        self.compare = OPERATORS[op]
+        self.value = value
+        self.raw = re.compile(b'"' + re.escape(self.path[-1].encode()) +
+                              rb'"\s*:\s*' + SCALAR)
+
+    def test(self, value):
+        if value is None or isinstance(value, (dict, list)):
+            return self.op == '!=' and value != self.value
+        try:
+            return self.compare(value, self.value)
+        except TypeError:  # 类型不同 (例如字符串和数字比较大小) 视为不满足
+            return self.op == '!='
+
+    def may_match(self, line):
+        # 第 1 步: 没有任何候选值满足条件时可以确定丢弃
+        if self.op == '!=':
+            return True
+        for match in self.raw.finditer(line):
+            try:
+                if self.test(json.loads(match.group(1))):
+                    return True
+            except ValueError:
+                return True  # 看不懂的写法交给部分解析
+        return False
+
+    def __repr__(self):
+        return f"{'.'.join(self.path)}{self.op}{self.value!r}"
+
+
+def parse_value(text):
+    try:
+        return json.loads(text)
+    except ValueError:
+        return text
+
+
+def parse_where(expression):
+    conditions = []
+    for part in re.split(r'\s+and\s+', expression.strip(), flags=re.IGNORECASE):
+        match = CONDITION.match(part)
+        if not match:
+            raise ValueError(f'cannot parse filter condition: {part!r}')
+        path, op, value = match.groups()
+        conditions.append(Condition(path, op, parse_value(value)))
+    return conditions
+
+
+def top_level_values(text, keys):
+    """从行首扫描顶层对象, keys 都找到后立即返回, 不解析剩余部分."""
+    found = {}
+    pos = WHITESPACE.match(text, 0).end()
+    if text[pos:pos + 1] != '{':
+        raise ValueError('record is not a JSON object')
+    pos = WHITESPACE.match(text, pos + 1).end()
+    if text[pos:pos + 1] == '}':
+        return found
+    while True:
+        key, pos = scanstring(text, pos + 1)
+        pos = WHITESPACE.match(text, pos).end()  # ':'
+        pos = WHITESPACE.match(text, pos + 1).end()
+        try:
+            value, pos = _scan_once(text, pos)
+        except StopIteration:
+            raise ValueError(f'invalid JSON value at {pos}')
+        if key in keys:
+            found[key] = value
+            if len(found) == len(keys):
+                return found
+        pos = WHITESPACE.match(text, pos).end()
+        if text[pos:pos + 1] != ',':
+            return found
+        pos = WHITESPACE.match(text, pos + 1).end()
+
+
+class RowFilter:
+    def __init__(self, expression):
+        self.expression = expression
+        self.conditions = parse_where(expression)
+        self.keys = {condition.path[0] for condition in self.conditions}
+
+    def __call__(self, line):
+        """line 为一行 JSON (bytes 或 str), 返回是否保留这条记录."""
+        raw = line.encode('utf-8') if isinstance(line, str) else line
+        for condition in self.conditions:
+            if not condition.may_match(raw):
+                return False
+
+        text = line if isinstance(line, str) else line.decode('utf-8')
+        values = top_level_values(text, self.keys)
+        for condition in self.conditions:
+            value = values.get(condition.path[0])
+            for name in condition.path[1:]:
+                value = value.get(name) if isinstance(value, dict) else None
+            if not condition.test(value):
+                return False
+        return True
+
+    def __repr__(self):
+        return f'RowFilter({self.expression!r})'
+
+
+def compile_filter(expression):
+    # 空表达式返回 None, 调用方用 `if row_filter and not row_filter(line)` 判断
+    return RowFilter(expression) if expression and expression.strip() else None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Count the records of part files that pass a --where filter.')
+    parser.add_argument('where')
+    parser.add_argument('files', nargs='+')
+    args = parser.parse_args()
+
+    row_filter = compile_filter(args.where)
+    for path in args.files:
+        kept = total = 0
+        with gzip.open(path, 'rb') as jsonl:
+            for line in jsonl:
+                if not line.strip():
+                    continue
+                total += 1
+                kept += row_filter(line)
+        print(f'{path}: {kept} / {total}')
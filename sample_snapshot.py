@@ -0,0 +1,203 @@
+import gzip
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from object_store import open_part
+from openalex_config import build_parser, load_config, snapshot_files
+from openalex_tables import short_id
+from row_filter import compile_filter, top_level_values
+
+# 生成开发用的小快照: 按 work id 的哈希值确定性地抽取一部分 works,
+# 再只保留这些 works 引用到的 authors / institutions / sources / topics /
+# concepts, 输出目录结构与原快照相同 (data/<entity>/updated_date=*/part_*.gz),
+# 之后用 --snapshot-dir 指向它即可用任何脚本展开, 各表之间可以正常 join.
+#
+#   python sample_snapshot.py --fraction 0.01 --out openalex-sample
+#   python processpool_test.py --snapshot-dir openalex-sample --csv-dir csv-sample
+#
+# 同一个 --fraction / --salt 每次抽到的 works 相同, 并且 fraction 小的样本
+# 是 fraction 大的样本的子集. publishers 和 funders 很小, 原样复制.
+# works_referenced_works / works_related_works 里会有指向样本外 work 的 id.
+# institutions / concepts 再多扫一遍, 加上关联机构、上级概念和相关概念;
+# 这一遍加进来的记录自己的关联机构/相关概念不再追加 (上级概念列表是完整的, 不受影响).
+
+parser = build_parser('Write a referentially consistent sample of the snapshot.')
+parser.add_argument('--fraction', type=float, default=0.01,
+                    help='fraction of works to keep (default: 0.01)')
+parser.add_argument('--salt', default='',
+                    help='changes which works are picked, for a different sample of the same size')
+parser.add_argument('--out', default='openalex-sample',
+                    help='output snapshot root (default: openalex-sample)')
+config = load_config(parser=parser)
+SNAPSHOT_DIR = config['snapshot_dir']
+COMPRESSLEVEL = config['compresslevel']
+ROW_FILTER = compile_filter(config['where'])
+FRACTION = config['args'].fraction
+SALT = config['args'].salt.encode('utf-8')
+OUT_DIR = config['args'].out
+
+# 引用到的 id 按实体分别保存, 只存数字部分以节省内存
+_keep_ids = set()
+
+
+def in_sample(work_id):
+    digest = hashlib.blake2b(work_id.encode('utf-8'), digest_size=8,
+                             key=SALT).digest()
+    return int.from_bytes(digest, 'big') < FRACTION * 2 ** 64
+
+
+def output_path(jsonl_file_name):
+    # 保持 data/<entity>/updated_date=*/part_*.gz 的相对路径
+    return os.path.join(OUT_DIR, os.path.relpath(jsonl_file_name, SNAPSHOT_DIR))
+
+
+def work_references(work):
+    refs = {'authors': set(), 'institutions': set(), 'sources': set(),
+            'topics': set(), 'concepts': set()}
+    for authorship in work.get('authorships') or []:
+        refs['authors'].add(short_id((authorship.get('author') or {}).get('id')))
+        for institution in authorship.get('institutions') or []:
+            refs['institutions'].add(short_id(institution.get('id')))
+    locations = [work.get('primary_location'), work.get('best_oa_location')]
+    for location in locations + (work.get('locations') or []):
+        refs['sources'].add(short_id(((location or {}).get('source') or {}).get('id')))
+    for key in ('topics', 'concepts'):
+        for item in work.get(key) or []:
+            refs[key].add(short_id(item.get('id')))
+    if primary_topic := work.get('primary_topic'):
+        refs['topics'].add(short_id(primary_topic.get('id')))
+    for ids in refs.values():
+        ids.discard(None)
+    return refs
+
+
+def author_references(author):
+    institutions = [author.get('last_known_institution')]
+    institutions += author.get('last_known_institutions') or []
+    return {'institutions': {short_id(i.get('id')) for i in institutions
+                             if i and i.get('id')}}
+
+
+def institution_references(institution):
+    return {'institutions': {short_id(i.get('id')) for i in institution.get('associated_institutions') or []
+                             if i and i.get('id')}}
+
+
+def concept_references(concept):
+    concepts = (concept.get('ancestors') or []) + (concept.get('related_concepts') or [])
+    return {'concepts': {short_id(c.get('id')) for c in concepts if c and c.get('id')}}
+
+
+def sample_file(jsonl_file_name, select, references=None):
+    """把 select(line) 为真的行原样写到输出快照, 返回 (文件名, 行数, 被引用的 id)."""
+    refs = {}
+    kept = 0
+    out_path = output_path(jsonl_file_name)
+    os.makedirs(os.path.dirname(out_path), exist_ok=True)
+    with open_part(jsonl_file_name, 'rb') as jsonl, \
+            gzip.open(out_path, 'wb', compresslevel=COMPRESSLEVEL) as out:
+        for line in jsonl:
+            if not line.strip() or not select(line):
+                continue
+            out.write(line if line.endswith(b'\n') else line + b'\n')
+            kept += 1
+            if references:
+                for entity, ids in references(json.loads(line)).items():
+                    refs.setdefault(entity, set()).update(ids)
+    return jsonl_file_name, kept, refs
+
+
+def record_id(line):
+    # id 是每条记录的第一个字段, 只做部分解析
+    return top_level_values(line.decode('utf-8'), {'id'}).get('id')
+
+
+def select_work(line):
+    work_id = record_id(line)
+    return bool(work_id) and in_sample(work_id) and \
+        (ROW_FILTER is None or ROW_FILTER(line))
+
+
+def select_referenced(line):
+    return short_id(record_id(line)) in _keep_ids
+
+
+def select_all(line):
+    return True
+
+
+def sample_works_file(jsonl_file_name):
+    return sample_file(jsonl_file_name, select_work, work_references)
+
+
+def sample_authors_file(jsonl_file_name):
+    return sample_file(jsonl_file_name, select_referenced, author_references)
+
+
+def sample_referenced_file(jsonl_file_name):
+    return sample_file(jsonl_file_name, select_referenced)
+
+
+def sample_institutions_file(jsonl_file_name):
+    return sample_file(jsonl_file_name, select_referenced, institution_references)
+
+
+def sample_concepts_file(jsonl_file_name):
+    return sample_file(jsonl_file_name, select_referenced, concept_references)
+
+
+def sample_all_file(jsonl_file_name):
+    return sample_file(jsonl_file_name, select_all)
+
+
+def init_keep_ids(ids):
+    global _keep_ids
+    _keep_ids = ids
+
+
+def sample_entity(entity, process_file, keep_ids=None):
+    refs = {}
+    total = 0
+    with ProcessPoolExecutor(max_workers=config['workers'],
+                             initializer=init_keep_ids,
+                             initargs=(keep_ids or set(),)) as executor:
+        for jsonl_file_name, kept, file_refs in executor.map(
+                process_file, snapshot_files(config, entity)):
+            print(f'{jsonl_file_name}: {kept}')
+            total += kept
+            for key, ids in file_refs.items():
+                refs.setdefault(key, set()).update(ids)
+    print(f'{entity}: {total} records')
+    return refs
+
+
+def sample_closed(entity, process_file, keep_ids):
+    # 样本里的记录引用到的同类记录不在样本里时, 加上它们重新扫一遍 (输出文件整个重写)
+    refs = sample_entity(entity, process_file, keep_ids)
+    extra = refs.get(entity, set()) - keep_ids
+    if extra:
+        print(f'{entity}: adding {len(extra)} referenced records')
+        sample_entity(entity, process_file, keep_ids | extra)
+
+
+def sample_snapshot():
+    refs = sample_entity('works', sample_works_file)
+    author_refs = sample_entity('authors', sample_authors_file,
+                                refs.get('authors', set()))
+    institutions = refs.get('institutions', set()) | \
+        author_refs.get('institutions', set())
+    sample_closed('institutions', sample_institutions_file, institutions)
+    sample_closed('concepts', sample_concepts_file, refs.get('concepts', set()))
+    for entity in ('sources', 'topics'):
+        sample_entity(entity, sample_referenced_file, refs.get(entity, set()))
+    for entity in ('publishers', 'funders'):
+        sample_entity(entity, sample_all_file)
+
+
+if __name__ == '__main__':
+    start = time.time()
+    sample_snapshot()
+    print(f"Time taken: {time.time() - start:.2f} seconds.")
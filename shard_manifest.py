@@ -0,0 +1,165 @@
+import argparse
+import hashlib
+import json
+import os
+import time
+
+from gz_members import header_member
+
+# 分片清单 (manifest): 记录每个表输出了哪些分片文件, 以及每个分片的行数、
+# 字节数和 sha256, 并据此生成 psql 的 \copy 导入脚本和行数校验脚本.
+#
+# manifest.json 结构:
+# {
+#   "created": "...",
+#   "tables": {
+#     "works_locations": {
+#       "columns": [...],
+#       "shards": [{"path": ..., "rows": ..., "bytes": ..., "sha256": ...}]
+#     }
+#   }
+# }
+
+
+class ShardFile:
+    """一个分片输出文件: 写入表头后追加 gzip member, 同时统计行数/字节数/校验和."""
+
+    def __init__(self, path, columns, compresslevel=9):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.path = path
+        self.outfile = open(path, 'wb')
+        self.sha256 = hashlib.sha256()
+        self.rows = 0
+        self.bytes = 0
+        self._write(header_member(columns, compresslevel))
+
+    def _write(self, data):
+        self.outfile.write(data)
+        self.sha256.update(data)
+        self.bytes += len(data)
+
+    def write(self, member, rows):
+        self._write(member)
+        self.rows += rows
+
+    def close(self):
+        self.outfile.close()
+        return {
+            'path': self.path,
+            'rows': self.rows,
+            'bytes': self.bytes,
+            'sha256': self.sha256.hexdigest(),
+        }
+
+
+def table_name(path):
+    # csv_files 里的文件名就是数据库表名, 例如 works_locations.csv.gz
+    return os.path.basename(path).split('.')[0]
+
+
+def new_manifest():
+    return {'created': time.strftime('%Y-%m-%dT%H:%M:%S'), 'tables': {}}
+
+
+def add_shard(manifest, table, columns, entry):
+    table_entry = manifest['tables'].setdefault(
+        table, {'columns': list(columns), 'shards': []})
+    table_entry['shards'].append(entry)
+
+
+def merge_manifests(manifests):
+    merged = new_manifest()
+    for manifest in manifests:
+        for table, table_entry in manifest['tables'].items():
+            for entry in table_entry['shards']:
+                add_shard(merged, table, table_entry['columns'], entry)
+    return merged
+
+
+def write_manifest(manifest, path):
+    for table_entry in manifest['tables'].values():
+        table_entry['shards'].sort(key=lambda entry: entry['path'])
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+
+
+def read_manifest(path):
+    with open(path, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def copy_command(table, columns, path, schema='openalex'):
+    return (f"\\copy {schema}.{table} ({', '.join(columns)}) "
+            f"from program 'gzip -d -c {path}' csv header")
+
+
+def generate_load_scripts(manifest, out_path, jobs=1, schema='openalex', changes_path=None):
+    """生成导入脚本. jobs > 1 时按字节数均衡地把分片分到多个脚本, 可以开多个 psql 并行导入.
+
+    changes_path: 增量输出 (--change-store) 的 <entity>_changes.csv.gz, 校验脚本只数这些 id 的行.
+    """
+    shards = [
+        (entry['bytes'], copy_command(table, table_entry['columns'],
+                                      entry['path'], schema))
+        for table, table_entry in manifest['tables'].items()
+        for entry in table_entry['shards']
+    ]
+    # 最大的分片优先分配给当前最空闲的脚本
+    scripts = [[0, []] for _ in range(jobs)]
+    for size, command in sorted(shards, key=lambda shard: -shard[0]):
+        script = min(scripts, key=lambda s: s[0])
+        script[0] += size
+        script[1].append(command)
+
+    base, ext = os.path.splitext(out_path)
+    paths = [out_path] if jobs == 1 else [f'{base}-{i}{ext}' for i in range(jobs)]
+    for path, (_, commands) in zip(paths, scripts):
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write('\n'.join(commands) + '\n')
+
+    verify_path = f'{base}-verify{ext}'
+    with open(verify_path, 'w', encoding='utf-8') as f:
+        f.write(verify_query(manifest, schema, changes_path))
+    return paths, verify_path
+
+
+def verify_query(manifest, schema='openalex', changes_path=None):
+    # 导入后对比数据库行数和 manifest 记录的行数.
+    # 增量输出只包含 inserted/changed 记录的行, 这时只数 changes 里列出的 id 的行,
+    # 应该正好等于新导入的行数 (changed/deleted 记录的旧行没删掉时会多)
+    lines = []
+    if changes_path:
+        lines = [
+            'DROP TABLE IF EXISTS pg_temp.verify_changes;',
+            'CREATE TEMP TABLE verify_changes (id text PRIMARY KEY, change text);',
+            f"\\copy verify_changes (id, change) from program 'gzip -d -c {changes_path}' csv header",
+        ]
+    selects = []
+    for table, table_entry in manifest['tables'].items():
+        loaded = f'SELECT count(*) FROM {schema}.{table}'
+        if changes_path:
+            loaded += f" WHERE {table_entry['columns'][0]} IN (SELECT id FROM verify_changes)"
+        selects.append(f"SELECT '{table}' AS table_name, "
+                       f"{sum(entry['rows'] for entry in table_entry['shards'])} AS expected, "
+                       f"({loaded}) AS loaded")
+    lines.append('SELECT table_name, expected, loaded, expected = loaded AS ok FROM (\n'
+                 + '\nUNION ALL\n'.join(selects) + '\n) counts ORDER BY table_name;')
+    return '\n'.join(lines) + '\n'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Generate psql load scripts from a flatten manifest.')
+    parser.add_argument('manifest', nargs='+',
+                        help='manifest.json (several are merged)')
+    parser.add_argument('--out', default='load-openalex-csv.sql')
+    parser.add_argument('--jobs', type=int, default=1)
+    parser.add_argument('--schema', default='openalex')
+    args = parser.parse_args()
+
+    manifest = merge_manifests([read_manifest(p) for p in args.manifest])
+    paths, verify_path = generate_load_scripts(manifest, args.out, args.jobs,
+                                               args.schema)
+    for path in paths:
+        print(path)
+    print(verify_path)
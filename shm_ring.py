@@ -0,0 +1,146 @@
+import os
+import re
+import shutil
+import struct
+import time
+from multiprocessing import shared_memory, resource_tracker
+
+# 共享内存环形缓冲区: reader 把解压后的字节直接写入共享内存,
+# filter 原地读取, 队列里只传 (ring_index, start, length) 这样的偏移量,
+# 不再对整块数据做 pickle/unpickle. filter 拿到的是共享内存上的 memoryview,
+# 按行切分时才把每一行复制成 bytes (json.loads 需要), 整块处理完再 release,
+# 在此之前 reader 不会覆盖这块区域.
+#
+# 每个 ring 只有一个生产者 (reader) 和一个消费者 (filter), 头部两个
+# uint64 计数器分别由生产者和消费者独占写入, 因此不需要加锁.
+
+HEADER_SIZE = 16  # write_pos, read_pos
+DEFAULT_RING_SIZE = 64 * 1024 * 1024
+MIN_RING_SIZE = 1024 * 1024
+SHM_DIR = '/dev/shm'  # Linux 上 SharedMemory 的位置 (tmpfs, 默认内存的一半, Docker 里只有 64 MB)
+
+
+class ShmRing:
+    def __init__(self, size=DEFAULT_RING_SIZE, name=None):
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True,
+                                                  size=HEADER_SIZE + size)
+            struct.pack_into('QQ', self.shm.buf, 0, 0, 0)
+            self.owner = True
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            # 子进程只是 attach, 由创建者负责 unlink
+            resource_tracker.unregister(self.shm._name, 'shared_memory')
+            self.owner = False
+        self.size = size
+        self.data = self.shm.buf[HEADER_SIZE:HEADER_SIZE + size]
+
+    def __reduce__(self):
+        return self.__class__, (self.size, self.shm.name)
+
+    def _positions(self):
+        return struct.unpack_from('QQ', self.shm.buf, 0)
+
+    def write(self, payload):
+        """生产者: 写入一块字节, 返回其绝对起始位置; 放不下则返回 None."""
+        length = len(payload)
+        if length > self.size:
+            return None
+        write_pos, read_pos = self._positions()
+        offset = write_pos % self.size
+        if offset + length > self.size:
+            # 尾部空间不够, 跳到下一圈的开头, 中间的空隙由消费者释放时一并越过
+            write_pos += self.size - offset
+            offset = 0
+        while write_pos + length - self._positions()[1] > self.size:
+            time.sleep(0.001)
+        self.data[offset:offset + length] = payload
+        struct.pack_into('Q', self.shm.buf, 0, write_pos + length)
+        return write_pos
+
+    def view(self, start, length):
+        """消费者: 原地取出一块字节 (memoryview, 不复制), 用完后调用 release."""
+        offset = start % self.size
+        return self.data[offset:offset + length]
+
+    def release(self, start, length):
+        """消费者: 释放已处理完的区域, 之后生产者才能覆盖. 必须按写入顺序释放."""
+        struct.pack_into('Q', self.shm.buf, 8, start + length)
+
+    def used(self):
+        """已写入但还没被消费的比例 (0~1)."""
+        write_pos, read_pos = self._positions()
+        return (write_pos - read_pos) / self.size
+
+    def close(self):
+        self.data.release()
+        self.shm.close()
+        if self.owner:
+            self.shm.unlink()
+
+
+def ring_bytes(ring_size_mb, ring_memory_mb, pairs):
+    """每个 ring 的字节数: 不超过 --ring-size, pairs 个 ring 合计不超过 --ring-memory.
+
+    ring 用久了整块都会被写到, tmpfs 不够时进程会收到 SIGBUS, 所以 /dev/shm 放不下时直接报错.
+    """
+    size = ring_size_mb * 1024 * 1024
+    if ring_memory_mb:
+        size = min(size, ring_memory_mb * 1024 * 1024 // pairs)
+    size = max(size, MIN_RING_SIZE)
+    if os.path.isdir(SHM_DIR):
+        free = shutil.disk_usage(SHM_DIR).free
+        if (size + HEADER_SIZE) * pairs > free:
+            raise ValueError(f'{pairs} shared-memory rings of {size / 2 ** 20:.0f} MB need '
+                             f'{size * pairs / 2 ** 20:.0f} MB but {SHM_DIR} has {free / 2 ** 20:.0f} MB free; '
+                             f'lower --ring-memory / --ring-size or enlarge {SHM_DIR}')
+    return size
+
+
+_fallback_warned = False
+
+
+def put_chunk(ring, ring_index, data_queue, chunk):
+    # 超过 ring 容量的块退回到普通队列传输 (pickle), 每个 reader 第一次发生时提示;
+    # ring 比一个 chunk 小时 (例如 --autotune 的 ring 很多, 被 --ring-memory 压到 1 MB) 所有块都会走队列
+    global _fallback_warned
+    start = ring.write(chunk)
+    if start is None:
+        if not _fallback_warned:
+            _fallback_warned = True
+            print(f'warning: a {len(chunk) / 2 ** 20:.1f} MB chunk does not fit the {ring.size / 2 ** 20:.1f} MB '
+                  f'shared-memory ring and is sent through the queue instead; raise --ring-memory / --ring-size '
+                  f'or lower --chunk-size', flush=True)
+        data_queue.put(chunk)
+    else:
+        data_queue.put((ring_index, start, len(chunk)))
+
+
+def flush_queues(data_queues):
+    # reader 结束前调用: 等本进程放进队列的数据 (特别是走队列的大块) 都写进管道后再通知 coordinator,
+    # 否则 coordinator 发出的 DONE 可能先到 filter, 剩下的块丢失, reader 也会卡在退出时
+    for data_queue in data_queues:
+        data_queue.close()
+        data_queue.join_thread()
+
+
+LINE = re.compile(rb'[^\n]+')
+
+
+def get_chunk(rings, message):
+    if isinstance(message, bytes):
+        return message
+    ring_index, start, length = message
+    return rings[ring_index].view(start, length)
+
+
+def release_chunk(rings, message):
+    if not isinstance(message, bytes):
+        ring_index, start, length = message
+        rings[ring_index].release(start, length)
+
+
+def iter_lines(chunk):
+    # bytes 和 memoryview 都可以, 每行复制成 bytes, 整块不复制
+    for match in LINE.finditer(chunk):
+        yield match.group()
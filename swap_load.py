@@ -0,0 +1,193 @@
+import argparse
+import os
+
+from shard_manifest import generate_load_scripts, merge_manifests, read_manifest
+
+# 影子表导入 + 事务内换表, 导入期间线上表照常查询:
+#   swap-1-prepare.sql   在影子 schema 里按线上表结构 (LIKE) 建空表
+#   swap-2-load*.sql     \copy 进影子表, --jobs N 时按字节数分成 N 个脚本并行执行
+#   swap-3-index*.sql    按线上表的主键/唯一约束和索引在影子表上重建, 然后 ANALYZE
+#   swap-4-swap.sql      一个事务: 影子表行数与 manifest 对比, 不一致则报错回滚;
+#                        一致则把线上表移到 old schema, 影子表移进线上 schema
+#   swap-5-cleanup.sql   确认无误后删除 old schema 里的旧表 (之前可以换回去)
+#
+# 线上表是分区 (--year-partitions) 时, 换表时先 DETACH 旧分区, 再用同样的边界 ATTACH 新分区;
+# 索引步骤给影子表加上与分区约束相同的 CHECK, ATTACH 时不用再扫描整张表.
+# 只有 ALTER TABLE ... SET SCHEMA 需要短暂的排它锁, lock_timeout 内拿不到锁则整个事务回滚.
+#
+#   python swap_load.py csv-files/manifest-works.json --jobs 4
+
+SHADOW_SCHEMA = 'openalex_shadow'
+OLD_SCHEMA = 'openalex_old'
+PARTITION_CHECK = 'swap_partition_check'
+
+
+def sql_array(names):
+    return 'ARRAY[' + ', '.join(f"'{name}'" for name in names) + ']::text[]'
+
+
+def balance(sizes, jobs):
+    """{表: 字节数} -> jobs 组表名, 最大的表优先分给当前最少的一组."""
+    groups = [[0, []] for _ in range(jobs)]
+    for table, size in sorted(sizes.items(), key=lambda item: -item[1]):
+        group = min(groups, key=lambda g: g[0])
+        group[0] += size
+        group[1].append(table)
+    return [tables for _, tables in groups if tables]
+
+
+def prepare_script(tables, schema, shadow):
+    lines = [f'CREATE SCHEMA IF NOT EXISTS {shadow};']
+    for table in tables:
+        lines += [
+            f'DROP TABLE IF EXISTS {shadow}.{table};',
+            f'CREATE TABLE {shadow}.{table} (LIKE {schema}.{table} INCLUDING DEFAULTS INCLUDING GENERATED);',
+        ]
+    return '\n'.join(lines) + '\n'
+
+
+def index_script(tables, schema, shadow):
+    # 约束和索引定义从 pg_catalog 读取, 与线上表保持一致, 不需要在这里重复一遍 DDL
+    return f'''DO $$
+DECLARE
+    r record;
+BEGIN
+    FOR r IN
+        SELECT t.relname, c.conname, pg_get_constraintdef(c.oid) AS def
+        FROM pg_constraint c
+        JOIN pg_class t ON t.oid = c.conrelid
+        JOIN pg_namespace n ON n.oid = t.relnamespace
+        WHERE n.nspname = '{schema}' AND t.relname = ANY ({sql_array(tables)}) AND c.contype IN ('p', 'u')
+    LOOP
+        EXECUTE format('ALTER TABLE %I.%I ADD CONSTRAINT %I %s', '{shadow}', r.relname, r.conname, r.def);
+    END LOOP;
+
+    FOR r IN
+        SELECT i.tablename, i.indexdef
+        FROM pg_indexes i
+        WHERE i.schemaname = '{schema}' AND i.tablename = ANY ({sql_array(tables)})
+          AND NOT EXISTS (SELECT 1 FROM pg_constraint c
+                          WHERE c.conindid = format('%I.%I', i.schemaname, i.indexname)::regclass)
+    LOOP
+        EXECUTE regexp_replace(r.indexdef, ' ON (ONLY )?{schema}\\.', ' ON \\1{shadow}.');
+    END LOOP;
+
+    FOR r IN
+        SELECT t.relname, pg_get_partition_constraintdef(t.oid) AS def
+        FROM pg_class t
+        JOIN pg_namespace n ON n.oid = t.relnamespace
+        WHERE n.nspname = '{schema}' AND t.relname = ANY ({sql_array(tables)}) AND t.relispartition
+    LOOP
+        EXECUTE format('ALTER TABLE %I.%I ADD CONSTRAINT %I CHECK (%s)',
+                       '{shadow}', r.relname, '{PARTITION_CHECK}', r.def);
+    END LOOP;
+END $$;
+''' + ''.join(f'ANALYZE {shadow}.{table};\n' for table in tables)
+
+
+def swap_script(manifest, schema, shadow, old, lock_timeout='10s'):
+    expected = ',\n            '.join(
+        f"('{table}', {sum(entry['rows'] for entry in table_entry['shards'])})"
+        for table, table_entry in manifest['tables'].items())
+    tables = list(manifest['tables'])
+    return f'''BEGIN;
+SET LOCAL lock_timeout = '{lock_timeout}';
+
+-- 影子表的行数必须与 manifest 一致, 否则回滚, 线上表不变
+DO $$
+DECLARE
+    r record;
+    loaded bigint;
+BEGIN
+    FOR r IN
+        SELECT * FROM (VALUES
+            {expected}
+        ) AS v (name, expected)
+    LOOP
+        EXECUTE format('SELECT count(*) FROM %I.%I', '{shadow}', r.name) INTO loaded;
+        IF loaded <> r.expected THEN
+            RAISE EXCEPTION '%: expected % rows, loaded %', r.name, r.expected, loaded;
+        END IF;
+    END LOOP;
+END $$;
+
+CREATE SCHEMA IF NOT EXISTS {old};
+
+DO $$
+DECLARE
+    t text;
+    parent text;
+    bound text;
+BEGIN
+    FOREACH t IN ARRAY {sql_array(tables)}
+    LOOP
+        parent := NULL;
+        SELECT i.inhparent::regclass::text, pg_get_expr(c.relpartbound, c.oid) INTO parent, bound
+        FROM pg_class c
+        JOIN pg_inherits i ON i.inhrelid = c.oid
+        WHERE c.oid = format('%I.%I', '{schema}', t)::regclass AND c.relispartition;
+        IF parent IS NOT NULL THEN
+            EXECUTE format('ALTER TABLE %s DETACH PARTITION %I.%I', parent, '{schema}', t);
+        END IF;
+        EXECUTE format('DROP TABLE IF EXISTS %I.%I', '{old}', t);
+        EXECUTE format('ALTER TABLE %I.%I SET SCHEMA %I', '{schema}', t, '{old}');
+        EXECUTE format('ALTER TABLE %I.%I SET SCHEMA %I', '{shadow}', t, '{schema}');
+        IF parent IS NOT NULL THEN
+            EXECUTE format('ALTER TABLE %s ATTACH PARTITION %I.%I %s', parent, '{schema}', t, bound);
+            EXECUTE format('ALTER TABLE %I.%I DROP CONSTRAINT IF EXISTS %I', '{schema}', t, '{PARTITION_CHECK}');
+        END IF;
+    END LOOP;
+END $$;
+
+COMMIT;
+'''
+
+
+def cleanup_script(old):
+    return f'DROP SCHEMA IF EXISTS {old} CASCADE;\n'
+
+
+def generate_swap_scripts(manifest, out_dir, jobs=1, schema='openalex', shadow=SHADOW_SCHEMA, old=OLD_SCHEMA):
+    """写出 swap-1 ... swap-5 脚本, 返回路径列表 (按执行顺序)."""
+    tables = list(manifest['tables'])
+    sizes = {table: sum(entry['bytes'] for entry in table_entry['shards'])
+             for table, table_entry in manifest['tables'].items()}
+
+    def write(name, text):
+        path = os.path.join(out_dir, name)
+        with open(path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        return path
+
+    paths = [write('swap-1-prepare.sql', prepare_script(tables, schema, shadow))]
+    load_paths, verify_path = generate_load_scripts(manifest, os.path.join(out_dir, 'swap-2-load.sql'),
+                                                    jobs, shadow)
+    os.remove(verify_path)  # 校验在 swap-4 的事务里做
+    paths += load_paths
+    groups = balance(sizes, jobs)
+    if len(groups) == 1:
+        paths.append(write('swap-3-index.sql', index_script(groups[0], schema, shadow)))
+    else:
+        paths += [write(f'swap-3-index-{i}.sql', index_script(group, schema, shadow))
+                  for i, group in enumerate(groups)]
+    paths.append(write('swap-4-swap.sql', swap_script(manifest, schema, shadow, old)))
+    paths.append(write('swap-5-cleanup.sql', cleanup_script(old)))
+    return paths
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='Generate psql scripts that load a flatten manifest into shadow tables and swap them in.')
+    parser.add_argument('manifest', nargs='+', help='manifest.json (several are merged)')
+    parser.add_argument('--out-dir', default=None, help='directory for the scripts (default: next to the first manifest)')
+    parser.add_argument('--jobs', type=int, default=1, help='number of parallel load / index scripts')
+    parser.add_argument('--schema', default='openalex')
+    parser.add_argument('--shadow-schema', default=SHADOW_SCHEMA)
+    parser.add_argument('--old-schema', default=OLD_SCHEMA)
+    args = parser.parse_args()
+
+    manifest = merge_manifests([read_manifest(p) for p in args.manifest])
+    out_dir = args.out_dir or os.path.dirname(args.manifest[0]) or '.'
+    for path in generate_swap_scripts(manifest, out_dir, args.jobs, args.schema,
+                                      args.shadow_schema, args.old_schema):
+        print(path)
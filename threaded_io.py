@@ -0,0 +1,146 @@
+import gzip
+import io
+import os
+import queue
+import threading
+
+from object_store import open_part
+
+# 单进程展开时的重叠 I/O (--io-threads):
+#   输入: 后台线程读文件并解压, 解压好的块放进有界队列, 主线程只按行切分和解析
+#   输出: 每个表一个后台线程, 主线程写入的 CSV 文本攒够一块后放进有界队列,
+#         由该线程编码、压缩并写文件
+# zlib 压缩/解压时释放 GIL, 所以解压、各个表的压缩和主线程的解析可以同时进行.
+# 队列有界, 某一边慢时另一边阻塞等待, 内存占用最多约 (QUEUE_BLOCKS + 2) * BLOCK_SIZE 每个文件.
+# 输出与 gzip.open(..., 'wt') 写出的内容解压后相同.
+
+BLOCK_SIZE = 1024 * 1024
+QUEUE_BLOCKS = 8
+_DONE = object()
+
+
+class _Failure:
+    def __init__(self, error):
+        self.error = error
+
+
+class _QueueReader(io.RawIOBase):
+    """从队列里取后台线程解压好的块."""
+
+    def __init__(self, blocks):
+        self.blocks = blocks
+        self.buffer = memoryview(b'')
+        self.finished = False
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while not self.buffer:
+            if self.finished:
+                return 0
+            block = self.blocks.get()
+            if block is _DONE:
+                self.finished = True
+                return 0
+            if isinstance(block, _Failure):
+                self.finished = True
+                raise block.error
+            self.buffer = memoryview(block)
+        n = min(len(b), len(self.buffer))
+        b[:n] = self.buffer[:n]
+        self.buffer = self.buffer[n:]
+        return n
+
+
+class ThreadedReader(io.BufferedReader):
+    """与 open_part(path, 'rb') 相同的逐行读取, 读文件和解压在后台线程里."""
+
+    def __init__(self, path, queue_blocks=QUEUE_BLOCKS, block_size=BLOCK_SIZE):
+        self.blocks = queue.Queue(queue_blocks)
+        self.stopped = threading.Event()
+        super().__init__(_QueueReader(self.blocks), block_size)
+        self.thread = threading.Thread(target=self._read, args=(path, block_size), daemon=True)
+        self.thread.start()
+
+    def _put(self, item):
+        # 主线程提前关闭时不再阻塞
+        while not self.stopped.is_set():
+            try:
+                self.blocks.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _read(self, path, block_size):
+        try:
+            with open_part(path, 'rb') as f:
+                while block := f.read(block_size):
+                    if not self._put(block):
+                        return
+            self._put(_DONE)
+        except BaseException as e:
+            self._put(_Failure(e))
+
+    def close(self):
+        self.stopped.set()
+        super().close()
+        self.thread.join()
+
+
+class ThreadedWriter(io.TextIOBase):
+    """可以交给 csv.DictWriter 的文本文件: 编码、压缩和写文件在后台线程里."""
+
+    def __init__(self, path, compresslevel=9, queue_blocks=QUEUE_BLOCKS, block_size=BLOCK_SIZE):
+        self.path = path
+        self.block_size = block_size
+        self.parts = []
+        self.size = 0
+        self.error = None
+        self.blocks = queue.Queue(queue_blocks)
+        # 与文本模式的 gzip.open 一致: \n 按平台换行符写出
+        self.linesep = os.linesep if os.linesep != '\n' else None
+        self.thread = threading.Thread(target=self._write, args=(compresslevel,), daemon=True)
+        self.thread.start()
+
+    def writable(self):
+        return True
+
+    def write(self, text):
+        if self.error:
+            raise self.error
+        self.parts.append(text)
+        self.size += len(text)
+        if self.size >= self.block_size:
+            self._flush_block()
+        return len(text)
+
+    def _flush_block(self):
+        if self.parts:
+            self.blocks.put(''.join(self.parts))
+            self.parts = []
+            self.size = 0
+
+    def _write(self, compresslevel):
+        try:
+            with gzip.open(self.path, 'wb', compresslevel=compresslevel) as f:
+                while (text := self.blocks.get()) is not _DONE:
+                    if self.linesep:
+                        text = text.replace('\n', self.linesep)
+                    f.write(text.encode('utf-8'))
+        except BaseException as e:
+            self.error = e
+            # 继续取走队列里的块, 主线程不会因为队列满而卡住
+            while self.blocks.get() is not _DONE:
+                pass
+
+    def close(self):
+        if self.closed:
+            return
+        self._flush_block()
+        self.blocks.put(_DONE)
+        self.thread.join()
+        super().close()
+        if self.error:
+            raise self.error
@@ -0,0 +1,152 @@
+import csv
+import glob
+import gzip
+import io
+import os
+import pickle
+import shutil
+import zlib
+from collections import defaultdict
+from itertools import combinations
+
+from gz_members import rows_to_member
+from shard_manifest import ShardFile
+
+# 展开 works 时顺带计算的聚合表 (map-combine-reduce), 省去导入后对
+# works_authorships 等大表做 GROUP BY:
+#   map/combine: 每个 worker 处理完一个 part 文件后, 在内存里按 key 合并出
+#                该文件的部分聚合, 按 key 的哈希分成 N 个分区写到溢写目录
+#   reduce:      所有文件处理完后, 逐个分区读入所有文件的部分结果并求和,
+#                内存里同时只有一个分区的 key
+#
+# 聚合表的输出文件和列定义在 openalex_tables.py 的 csv_files['aggregates'].
+# 各聚合以 work 为单位计数: 一个作者在同一篇 work 里有多个机构也只算一次.
+
+# 作者数超过这个值的 work (大型合作论文) 不计入 coauthor_counts,
+# 否则一篇上千作者的论文就会产生上百万个作者对
+MAX_COAUTHORS = 100
+
+AGGREGATES = ['author_works_by_year', 'institution_citations',
+              'source_works_by_year', 'coauthor_counts']
+
+
+def to_int(value):
+    return int(value) if value not in (None, '') else None
+
+
+def member_rows(member, columns):
+    # arrow 引擎只有 CSV member, 没有行 dict
+    return csv.DictReader(io.StringIO(gzip.decompress(member).decode('utf-8')),
+                          fieldnames=columns)
+
+
+def map_tables(tables, aggregates):
+    """tables: {表 key: 行 (dict) 的可迭代对象}, 返回 {聚合名: {key: [计数, ...]}}."""
+    works = {}
+    for row in tables.get('works', []):
+        works[row['id']] = (to_int(row.get('publication_year')),
+                            to_int(row.get('cited_by_count')) or 0)
+    authors = defaultdict(set)
+    institutions = defaultdict(set)
+    for row in tables.get('authorships', []):
+        if row.get('author_id'):
+            authors[row['work_id']].add(row['author_id'])
+        if row.get('institution_id'):
+            institutions[row['work_id']].add(row['institution_id'])
+    for row in tables.get('authorships_institutions', []):
+        # --normalize-authorships 时机构在单独的链接表里
+        institutions[row['work_id']].add(row['institution_id'])
+    sources = {row['work_id']: row['source_id']
+               for row in tables.get('primary_locations', []) if row.get('source_id')}
+
+    partial = {name: defaultdict(lambda: [0, 0]) for name in aggregates}
+
+    def add(name, key, cited, works_count=1):
+        if name in partial:
+            values = partial[name][key]
+            values[0] += works_count
+            values[1] += cited
+
+    for work_id, (year, cited) in works.items():
+        for author_id in authors.get(work_id, ()):
+            add('author_works_by_year', (author_id, year), cited)
+        for institution_id in institutions.get(work_id, ()):
+            add('institution_citations', (institution_id,), cited)
+        if work_id in sources:
+            add('source_works_by_year', (sources[work_id], year), cited)
+        work_authors = authors.get(work_id, ())
+        if 'coauthor_counts' in partial and len(work_authors) <= MAX_COAUTHORS:
+            for pair in combinations(sorted(work_authors), 2):
+                partial['coauthor_counts'][pair][0] += 1
+    return partial
+
+
+def partition_of(key, partitions):
+    # 不能用 hash(): 每个进程的字符串哈希种子不同
+    return zlib.crc32(str(key[0]).encode('utf-8')) % partitions
+
+
+def spill(partial, spill_dir, name, partitions):
+    """把一个文件的部分聚合按分区写到 spill_dir/<聚合>/<name>.<分区>.pickle."""
+    for aggregate, values in partial.items():
+        buckets = [{} for _ in range(partitions)]
+        for key, value in values.items():
+            buckets[partition_of(key, partitions)][key] = value
+        aggregate_dir = os.path.join(spill_dir, aggregate)
+        os.makedirs(aggregate_dir, exist_ok=True)
+        for index, bucket in enumerate(buckets):
+            if bucket:
+                path = os.path.join(aggregate_dir, f'{name}.{index}.pickle')
+                with open(path + '.tmp', 'wb') as f:
+                    pickle.dump(bucket, f, protocol=pickle.HIGHEST_PROTOCOL)
+                os.replace(path + '.tmp', path)
+
+
+def map_file(members, file_spec, results, spill_dir, name, aggregates, partitions):
+    """在 worker 里调用. Python 路径直接用 results 里的行, arrow 路径从 CSV member 读回."""
+    if results is not None:
+        tables = results
+    else:
+        tables = {key: member_rows(members[key][1], file_spec[key]['columns'])
+                  for key in ('works', 'authorships', 'authorships_institutions', 'primary_locations')
+                  if key in members}
+    spill(map_tables(tables, aggregates), spill_dir, name, partitions)
+
+
+def reduce_aggregate(spill_dir, aggregate, spec, partitions, compresslevel=9):
+    """合并一个聚合的所有分区, 写出 spec['name'], 返回 manifest 分片条目."""
+    outfile = ShardFile(spec['name'], spec['columns'], compresslevel)
+    try:
+        for index in range(partitions):
+            merged = {}
+            for path in glob.glob(os.path.join(spill_dir, aggregate, f'*.{index}.pickle')):
+                with open(path, 'rb') as f:
+                    for key, values in pickle.load(f).items():
+                        if key in merged:
+                            merged[key] = [a + b for a, b in zip(merged[key], values)]
+                        else:
+                            merged[key] = values
+            rows = []
+            for key in sorted(merged, key=lambda k: tuple('' if v is None else str(v) for v in k)):
+                row = dict(zip(spec['columns'], key + tuple(merged[key])))
+                rows.append(row)
+            if rows:
+                outfile.write(rows_to_member(rows, spec['columns'], compresslevel), len(rows))
+    finally:
+        entry = outfile.close()
+    return entry
+
+
+def parse_aggregates(value):
+    names = [name.strip() for name in (value or '').split(',') if name.strip()]
+    if 'all' in names:
+        return list(AGGREGATES)
+    unknown = set(names) - set(AGGREGATES)
+    if unknown:
+        raise ValueError(f"unknown aggregates: {', '.join(sorted(unknown))} "
+                         f"(choose from {', '.join(AGGREGATES)} or all)")
+    return names
+
+
+def clear_spill(spill_dir):
+    shutil.rmtree(spill_dir, ignore_errors=True)
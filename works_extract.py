@@ -0,0 +1,222 @@
+import json
+
+from abstract_encoding import encode_abstract
+import progress
+from object_store import open_part
+
+# works 一次解析, 产出 csv_files['works'] 里所有 16 个表的行.
+# results 是 {表 key: 行列表} 的 dict, 只有 results 里出现的表才会被提取,
+# 这样只需要部分表的脚本 (例如 multiprocess_works_add.py) 也能复用同一套逻辑.
+
+PROGRESS_RECORDS = 10000  # 每解析这么多条记录更新一次进度计数器
+
+
+def new_results(tables):
+    return {key: [] for key in tables}
+
+
+def abstract_format(tables):
+    # --abstracts 不是 inline 时, 摘要写到 works_abstracts 表
+    return tables['abstracts']['format'] if 'abstracts' in tables else None
+
+
+def extract_file(jsonl_file_name, tables, row_filter=None):
+    # 读取一个 works part 文件, 返回 {表 key: 行列表}
+    results = new_results(tables)
+    abstracts = abstract_format(tables)
+    records = 0
+    with open_part(jsonl_file_name, 'r') as works_jsonl:
+        for work_json in works_jsonl:
+            if not work_json.strip():
+                continue
+            if row_filter and not row_filter(work_json):
+                continue
+
+            extract_work(json.loads(work_json), results, abstracts)
+            records += 1
+            if records == PROGRESS_RECORDS:
+                progress.add('records', records)
+                records = 0
+    progress.add('records', records)
+    return results
+
+
+def extract_work(work, results, abstracts=None):
+    if not (work_id := work.get('id')):
+        return False
+
+    # works
+    abstract = work.get('abstract_inverted_index')
+    if 'works' in results:
+        if abstract is not None and not abstracts:
+            work['abstract_inverted_index'] = json.dumps(abstract, ensure_ascii=False)
+        results['works'].append(work)
+
+    # abstracts
+    if 'abstracts' in results and abstract is not None:
+        results['abstracts'].append({
+            'work_id': work_id,
+            'abstract': encode_abstract(abstract, abstracts),
+        })
+
+    # primary_locations
+    if 'primary_locations' in results:
+        if primary_location := (work.get('primary_location') or {}):
+            if primary_location.get('source') and primary_location.get('source').get('id'):
+                results['primary_locations'].append(location_row(work_id, primary_location))
+
+    # locations
+    if 'locations' in results:
+        if locations := work.get('locations'):
+            for location in locations:
+                if location.get('source') and location.get('source').get('id'):
+                    results['locations'].append(location_row(work_id, location))
+
+    # best_oa_locations
+    if 'best_oa_locations' in results:
+        if best_oa_location := (work.get('best_oa_location') or {}):
+            if best_oa_location.get('source') and best_oa_location.get('source').get('id'):
+                results['best_oa_locations'].append(location_row(work_id, best_oa_location))
+
+    # authorships
+    if 'authorships_institutions' in results:
+        # 规范化输出: 每个 authorship 一行, 机构写到链接表
+        for ordinal, authorship in enumerate(work.get('authorships') or [], 1):
+            if author_id := authorship.get('author', {}).get('id'):
+                if 'authorships' in results:
+                    results['authorships'].append({
+                        'work_id': work_id,
+                        'author_ordinal': ordinal,
+                        'author_position': authorship.get('author_position'),
+                        'author_id': author_id,
+                        'raw_affiliation_string': authorship.get('raw_affiliation_string'),
+                    })
+                for institution in authorship.get('institutions'):
+                    if institution_id := institution.get('id'):
+                        results['authorships_institutions'].append({
+                            'work_id': work_id,
+                            'author_ordinal': ordinal,
+                            'institution_id': institution_id,
+                        })
+    elif 'authorships' in results:
+        if authorships := work.get('authorships'):
+            for authorship in authorships:
+                if author_id := authorship.get('author', {}).get('id'):
+                    institutions = authorship.get('institutions')
+                    institution_ids = [i.get('id') for i in institutions]
+                    institution_ids = [i for i in institution_ids if i]
+                    institution_ids = institution_ids or [None]
+
+                    for institution_id in institution_ids:
+                        results['authorships'].append({
+                            'work_id': work_id,
+                            'author_position': authorship.get('author_position'),
+                            'author_id': author_id,
+                            'institution_id': institution_id,
+                            'raw_affiliation_string': authorship.get('raw_affiliation_string'),
+                        })
+
+    # biblio
+    if 'biblio' in results:
+        if biblio := work.get('biblio'):
+            biblio['work_id'] = work_id
+            results['biblio'].append(biblio)
+
+    # topics
+    if 'topics' in results:
+        for topic in work.get('topics', []):
+            if topic_id := topic.get('id'):
+                results['topics'].append({
+                    'work_id': work_id,
+                    'topic_id': topic_id,
+                    'score': topic.get('score')
+                })
+
+    # concepts
+    if 'concepts' in results:
+        for concept in work.get('concepts'):
+            if concept_id := concept.get('id'):
+                results['concepts'].append({
+                    'work_id': work_id,
+                    'concept_id': concept_id,
+                    'score': concept.get('score'),
+                })
+
+    # ids
+    if 'ids' in results:
+        if ids := work.get('ids'):
+            ids['work_id'] = work_id
+            results['ids'].append(ids)
+
+    # mesh
+    if 'mesh' in results:
+        for mesh in work.get('mesh'):
+            mesh['work_id'] = work_id
+            results['mesh'].append(mesh)
+
+    # open_access
+    if 'open_access' in results:
+        if open_access := work.get('open_access'):
+            open_access['work_id'] = work_id
+            results['open_access'].append(open_access)
+
+    # referenced_works
+    if 'referenced_works' in results:
+        for referenced_work in work.get('referenced_works'):
+            if referenced_work:
+                results['referenced_works'].append({
+                    'work_id': work_id,
+                    'referenced_work_id': referenced_work
+                })
+
+    # related_works
+    if 'related_works' in results:
+        for related_work in work.get('related_works'):
+            if related_work:
+                results['related_works'].append({
+                    'work_id': work_id,
+                    'related_work_id': related_work
+                })
+
+    # grants
+    if 'grants' in results:
+        if grants := work.get('grants'):  # 如果 grants 为空列表,则不执行
+            for grant in grants:
+                grant['work_id'] = work_id
+                results['grants'].append(grant)
+
+    # counts_by_year
+    if 'counts_by_year' in results:
+        if counts := work.get('counts_by_year'):
+            for info in counts:
+                info['work_id'] = work_id
+                results['counts_by_year'].append(info)
+
+    # more_info
+    if 'more_info' in results:
+        # citation_normalized_percentile 为 None 时视为空字典
+        citation_info = work.get('citation_normalized_percentile') or {}
+        results['more_info'].append({
+            'work_id': work_id,
+            'institutions_distinct_count': work.get('institutions_distinct_count'),
+            'countries_distinct_count': work.get('countries_distinct_count'),
+            'authors_count': work.get('authors_count'),
+            'fwci': work.get('fwci'),
+            'citation_normalized_percentile': citation_info.get('value'),
+            'top1_percentile': citation_info.get('is_in_top_1_percent'),
+            'top10_percentile': citation_info.get('is_in_top_10_percent'),
+        })
+
+    return True
+
+
+def location_row(work_id, location):
+    return {
+        'work_id': work_id,
+        'source_id': location['source']['id'],
+        'landing_page_url': location.get('landing_page_url'),
+        'pdf_url': location.get('pdf_url'),
+        'is_oa': location.get('is_oa'),
+        'version': location.get('version'),
+        'license': location.get('license'),
+    }
@@ -0,0 +1,132 @@
+import bisect
+import os
+
+from shard_manifest import table_name
+
+# works 及其子表按 publication_year 分区输出 (--year-partitions 2000,2010,2020):
+#   边界把年份分成若干区间, 例如 y0_1999, y2000_2009, y2010_2019, y2020_9999,
+#   没有年份的 work 在 ynull. 每个表每个区间一个输出文件 <table>_<区间>.csv.gz,
+#   manifest 里的表名就是 PostgreSQL 的分区表名, 导入脚本直接写入各个分区.
+#
+# 子表 (works_locations 等) 没有年份, 分区时在末尾加一列 publication_year,
+# 由同一个 part 文件里的 works 行按 work_id 查到. partition-schema.sql 把 works 和
+# 子表改成 PARTITION BY RANGE (publication_year) 的分区表, ynull 是 DEFAULT 分区.
+#
+# 只重新导入一个年份区间: TRUNCATE 该区间的各个分区, 再执行 manifest 里这些分区的 \copy.
+
+NULL_PART = 'ynull'
+YEAR_COLUMN = 'publication_year'
+
+
+def parse_boundaries(value):
+    return sorted({int(year) for year in (value or '').split(',') if year.strip()})
+
+
+def to_year(value):
+    try:
+        return int(value) if value not in (None, '') else None
+    except (TypeError, ValueError):
+        return None
+
+
+def table_key(key):
+    # 分区后 members / outfiles 的 key 是 (表 key, 区间名)
+    return key[0] if isinstance(key, tuple) else key
+
+
+def partition_path(path, part):
+    return os.path.join(os.path.dirname(path), f'{table_name(path)}_{part}.csv.gz')
+
+
+def partitioned_spec(file_spec):
+    # 子表末尾加 publication_year 列
+    return {key: spec if key == 'works' else dict(spec, columns=spec['columns'] + [YEAR_COLUMN])
+            for key, spec in file_spec.items()}
+
+
+def join_parts(members):
+    """{(表 key, 区间): (行数, member)} -> {表 key: (行数, member)}, gzip member 直接拼接."""
+    joined = {}
+    for (key, _), (rows, member) in members.items():
+        total, data = joined.get(key, (0, b''))
+        joined[key] = (total + rows, data + member)
+    return joined
+
+
+class YearPartitioner:
+
+    def __init__(self, boundaries):
+        self.boundaries = boundaries
+        # (区间名, 下界, 上界 (不含)), None 表示不限
+        self.ranges = []
+        for i in range(len(boundaries) + 1):
+            low = boundaries[i - 1] if i > 0 else None
+            high = boundaries[i] if i < len(boundaries) else None
+            name = f"y{0 if low is None else low}_{9999 if high is None else high - 1}"
+            self.ranges.append((name, low, high))
+        self.parts = [name for name, _, _ in self.ranges] + [NULL_PART]
+
+    def part_of(self, year):
+        if year is None:
+            return NULL_PART
+        return self.ranges[bisect.bisect_right(self.boundaries, year)][0]
+
+    def split_rows(self, results):
+        """Python 路径: {表 key: 行列表} -> {(表 key, 区间): 行列表}."""
+        years = {row['id']: to_year(row.get(YEAR_COLUMN)) for row in results.get('works', [])}
+        parts = {}
+        for key, rows in results.items():
+            for row in rows:
+                if key == 'works':
+                    year = to_year(row.get(YEAR_COLUMN))
+                else:
+                    year = row[YEAR_COLUMN] = years.get(row['work_id'])
+                parts.setdefault((key, self.part_of(year)), []).append(row)
+        return parts
+
+    def split_tables(self, tables):
+        """arrow 路径: 同一块的 {表 key: pa.Table} -> {(表 key, 区间): pa.Table}."""
+        import pyarrow as pa
+        import pyarrow.compute as pc
+        works = tables['works']
+        ids = works['id'].combine_chunks()
+        years = pc.cast(works[YEAR_COLUMN].combine_chunks(), pa.int64())
+        parts = {}
+        for key, table in tables.items():
+            if key == 'works':
+                year = years
+            else:
+                year = pc.take(years, pc.index_in(table['work_id'], value_set=ids))
+                table = table.append_column(YEAR_COLUMN, year)
+            for name, low, high in self.ranges:
+                mask = pc.is_valid(year)
+                if low is not None:
+                    mask = pc.and_(mask, pc.greater_equal(year, low))
+                if high is not None:
+                    mask = pc.and_(mask, pc.less(year, high))
+                parts[(key, name)] = table.filter(mask)
+            parts[(key, NULL_PART)] = table.filter(pc.is_null(year))
+        return parts
+
+    def schema(self, file_spec, schema='openalex'):
+        """把 works 和各子表改成按 publication_year 分区的 DDL.
+
+        在 openalex-pg-schema.sql (以及 dictionary-schema.sql) 之后、导入数据之前执行.
+        """
+        lines = []
+        for key, spec in file_spec.items():
+            table = table_name(spec['name'])
+            year = '' if key == 'works' else f', {YEAR_COLUMN} integer'
+            lines += [
+                f'CREATE TABLE {schema}.{table}_partitioned (LIKE {schema}.{table} INCLUDING ALL{year})',
+                f'    PARTITION BY RANGE ({YEAR_COLUMN});',
+                f'DROP TABLE {schema}.{table};',
+                f'ALTER TABLE {schema}.{table}_partitioned RENAME TO {table};',
+            ]
+            for name, low, high in self.ranges:
+                low = 'MINVALUE' if low is None else low
+                high = 'MAXVALUE' if high is None else high
+                lines.append(f'CREATE TABLE {schema}.{table}_{name} PARTITION OF {schema}.{table} '
+                             f'FOR VALUES FROM ({low}) TO ({high});')
+            lines.append(f'CREATE TABLE {schema}.{table}_{NULL_PART} PARTITION OF {schema}.{table} DEFAULT;')
+        return '\n'.join(lines) + '\n'